@@ -6,8 +6,9 @@ set -e
 # We deal with OpenStack, no need to have anything else
 CLOUD_INFO_MIDDLEWARE=openstack
 
-# use service account for everyone
-ACCESS_TOKEN_FILE="$(mktemp)"
+# use service account for everyone, the token file may be shared with other
+# runs on the same host so the token is only refreshed once
+ACCESS_TOKEN_FILE="${ACCESS_TOKEN_FILE:-$(mktemp)}"
 token-generator --config-dir "$EGI_CONFIG_DIR" "$ACCESS_TOKEN_FILE"
 OS_ACCESS_TOKEN="$(cat "$ACCESS_TOKEN_FILE")"
 export OS_ACCESS_TOKEN
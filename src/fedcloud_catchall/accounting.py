@@ -6,17 +6,22 @@ records for fedcloud sites
 """
 
 import datetime
+import functools
 import json
 import logging
 import os.path
 import subprocess
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dateutil import tz
+from oslo_config import cfg
 
+from . import checkpoints, compaction
 from .config import CONF
-from .discovery import auth_config, load_sites
+from .discovery import auth_config, load_sites, prefetch_secrets
 
 # these are the possible caso configurations
 # the ones to be used are configured in the config file
@@ -25,6 +30,12 @@ caso_run_configs = {
     "compute": {"extractor": "nova", "destination": "eu-egi-cloud-accounting"},
 }
 
+# same as timeout(1) for the commands that did not finish in time
+TIMEOUT_RETURN_CODE = 124
+
+# caso-extract logs the extractors that failed but still exits with 0
+CASO_EXTRACT_ERROR = "cannot extract records for"
+
 caso_config_template = """
 [DEFAULT]
 extractor = {extractor}
@@ -34,6 +45,7 @@ projects = {project_id}
 messengers = ssm
 vo_property = {vo_property}
 spooldir = {spooldir}
+lock_path = {lock_path}
 
 {auth_section}
 
@@ -71,8 +83,14 @@ console: true
 """
 
 
-def caso_config(site, vo, site_dir, vo_property="egi.eu:VO", extractor="nova"):
-    site_name = site["static"].get("accounting").get("site_name", site["name"])
+def accounting_site_name(site):
+    return site["static"].get("accounting").get("site_name", site["name"])
+
+
+def caso_config(
+    site, vo, site_dir, vo_property="egi.eu:VO", extractor="nova", lock_path=None
+):
+    site_name = accounting_site_name(site)
     auth_section = auth_config(site, vo, "keystone_auth")
     return caso_config_template.format(
         site_name=site_name,
@@ -81,15 +99,21 @@ def caso_config(site, vo, site_dir, vo_property="egi.eu:VO", extractor="nova"):
         project_id=vo["id"],
         vo_property=vo_property,
         spooldir=site_dir,
+        lock_path=lock_path or os.path.join(site_dir, f"lock.{vo['id']}"),
         extractor=extractor,
         ssmdir=os.path.join(site_dir, "outgoing"),
     )
 
 
-def ssm_config(site, site_dir, destination="eu-egi-cloud-accounting"):
+def ssm_destination(site, destination):
     # override configuration if provided
     ams_host = site["static"].get("accounting").get("ams_host", "msg.argo.grnet.gr")
     destination = site["static"].get("accounting").get("destination", destination)
+    return ams_host, destination
+
+
+def ssm_config(site, site_dir, destination="eu-egi-cloud-accounting"):
+    ams_host, destination = ssm_destination(site, destination)
     return ssm_config_template.format(
         destination=destination,
         ams_host=ams_host,
@@ -104,57 +128,167 @@ def vo_map(site):
     return json.dumps(vos)
 
 
-def site_caso(site, site_dir):
+def site_logger(site):
+    return logging.getLogger(f"{__name__}.{site['name']}")
+
+
+def command_timeout(deadline=None):
+    # seconds a command may run, bounded by the deadline of its site
+    timeout = CONF.accounting.command_timeout
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.monotonic())
+    return timeout
+
+
+def call(cmd, log, deadline=None, error_marker=None):
+    # output is relayed to the site logger so concurrent sites do not interleave,
+    # a line with the error marker fails the command whatever its return code
+    timeout = command_timeout(deadline)
+    if timeout <= 0:
+        log.warning(f"Site deadline reached, not running {cmd[0]}")
+        return TIMEOUT_RETURN_CODE
+    log.debug(f"Running {' '.join(cmd)}")
+    try:
+        proc = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=timeout,
+        )
+        output, return_code = proc.stdout, proc.returncode
+    except subprocess.TimeoutExpired as e:
+        # subprocess.run kills the child, the partial output is not decoded
+        output = e.output
+        if isinstance(output, bytes):
+            output = output.decode(errors="replace")
+        log.error(f"Killed {cmd[0]} after {timeout:.0f} seconds")
+        return_code = TIMEOUT_RETURN_CODE
+    failed = False
+    for line in (output or "").splitlines():
+        log.info(line)
+        failed = failed or (error_marker is not None and error_marker in line)
+    log.debug(f"Return code {return_code}")
+    if failed and return_code == 0:
+        log.error(f"{cmd[0]} reported errors, considering it failed")
+        return_code = 1
+    return return_code
+
+
+def project_caso(
+    site, project, run_type, run_config, site_dir, window, log, deadline=None
+):
+    extract_from, extract_to = window
+    log.debug(
+        f"Running caso for {run_type} on project {project['id']} "
+        f"({extract_from} to {extract_to})"
+    )
+    caso_run_dir = os.path.join(site_dir, run_type)
+    os.makedirs(caso_run_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        vo_map_file = os.path.join(tmpdirname, "mapping.json")
+        with open(vo_map_file, "w+") as f:
+            f.write(vo_map(site))
+        with open(os.path.join(tmpdirname, "caso.conf"), "w+") as f:
+            f.write(
+                caso_config(
+                    site,
+                    project,
+                    caso_run_dir,
+                    extractor=run_config["extractor"],
+                    # the caso lock would run the windows of a project one at a
+                    # time, these never overlap and the windows are tracked in
+                    # the checkpoint store, so each one gets its own
+                    lock_path=tmpdirname,
+                )
+            )
+        cmd = [
+            "caso-extract",
+            "--config-dir",
+            tmpdirname,
+            "--mapping_file",
+            vo_map_file,
+            "--extract-from",
+            extract_from.isoformat(),
+            "--extract-to",
+            extract_to.isoformat(),
+        ]
+        return_code = call(cmd, log, deadline, CASO_EXTRACT_ERROR)
+    if return_code == 0:
+        checkpoints.get_store().complete_window(
+            site["name"], project["id"], run_config["extractor"], *window
+        )
+    return return_code
+
+
+def extraction_jobs(site, site_dir, now, window=None, log=logging):
+    # (project, run type, run config, window) to extract, with windows of the
+    # given size when backfilling
+    store = checkpoints.get_store()
+    return [
+        (project, run_type, run_config, extract_window)
+        for project in site["projects"]
+        for run_type, run_config in caso_run_configs.items()
+        if run_type in CONF.accounting.caso_runs
+        for extract_window in checkpoints.pending_windows(
+            store,
+            site,
+            project,
+            run_type,
+            run_config["extractor"],
+            site_dir,
+            now,
+            window,
+            log,
+        )
+    ]
+
+
+def collect_return_codes(futures):
+    # a single failed window fails the project
+    return_codes = {}
+    for key, future in futures:
+        return_code = future.result()
+        if return_code != 0 or key not in return_codes:
+            return_codes[key] = return_code
+    return return_codes
+
+
+def site_caso(site, site_dir, log=logging, window=None, deadline=None):
     # running caso for each project independently so we can control the "lastrun"
-    good_run = False
-    # these are the extractors that will run
-    for project in site["projects"]:
-        for run_type, run_config in caso_run_configs.items():
-            if run_type not in CONF.accounting.caso_runs:
-                continue
-            logging.debug(f"Running caso for {run_type}")
-            caso_run_dir = os.path.join(site_dir, run_type)
-            os.makedirs(caso_run_dir, exist_ok=True)
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                vo_map_file = os.path.join(tmpdirname, "mapping.json")
-                with open(vo_map_file, "w+") as f:
-                    f.write(vo_map(site))
-                with open(os.path.join(tmpdirname, "caso.conf"), "w+") as f:
-                    f.write(
-                        caso_config(
-                            site,
-                            project,
-                            caso_run_dir,
-                            extractor=run_config["extractor"],
-                        )
-                    )
-                cmd = [
-                    "caso-extract",
-                    "--config-dir",
-                    tmpdirname,
-                    "--mapping_file",
-                    vo_map_file,
-                ]
-                if not os.path.exists(
-                    os.path.join(caso_run_dir, f"lastrun.{project['id']}")
-                ):
-                    yesterday = datetime.datetime.now(tz.tzutc()) - datetime.timedelta(
-                        days=1
-                    )
-                    cmd.extend(["--extract-from", yesterday.isoformat()])
-                logging.debug(f"Running {' '.join(cmd)}")
-                return_code = subprocess.call(cmd)
-                logging.debug(f"Return code {return_code}")
-                good_run = True
-    return good_run
+    # returns the return code of every (project, run type) extraction
+    now = datetime.datetime.now(tz.tzutc())
+    jobs = extraction_jobs(site, site_dir, now, window, log)
+    workers = (
+        CONF.accounting.backfill_workers if window else CONF.accounting.extract_workers
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (
+                (project["id"], run_type),
+                executor.submit(
+                    project_caso,
+                    site,
+                    project,
+                    run_type,
+                    run_config,
+                    site_dir,
+                    extract_window,
+                    log,
+                    deadline,
+                ),
+            )
+            for project, run_type, run_config, extract_window in jobs
+        ]
+    return collect_return_codes(futures)
 
 
-def site_ssm(site, site_dir):
+def site_ssm(site, site_dir, log=logging, deadline=None):
     good_run = True
     for run_type, run_config in caso_run_configs.items():
         if run_type not in CONF.accounting.caso_runs:
             continue
-        logging.debug(f"Running SSM for {run_type}")
+        log.debug(f"Running SSM for {run_type}")
         caso_run_dir = os.path.join(site_dir, run_type)
         with tempfile.TemporaryDirectory() as tmpdirname:
             ssm_config_file = os.path.join(tmpdirname, "ssm.conf")
@@ -165,33 +299,158 @@ def site_ssm(site, site_dir):
                 "-c",
                 ssm_config_file,
             ]
-            logging.debug(f"Running {' '.join(cmd)}")
-            return_code = subprocess.call(cmd)
+            return_code = call(cmd, log, deadline)
             good_run = return_code == 0 and good_run
     return good_run
 
 
-def run(sites):
-    for _, site in sites.items():
-        site_name = site["name"]
-        logging.info(f"Configuring site {site_name}")
-        accounting_config = site["static"].get("accounting", {})
-        if not accounting_config.get("enabled", False):
-            if CONF.accounting.force_run:
-                logging.info(f"Force run the extraction of records for {site_name}.")
-            else:
-                logging.debug(f"Discarding site {site_name}, accounting not enabled.")
-                continue
-        site_dir = os.path.join(CONF.accounting.spool_dir, site["name"])
-        os.makedirs(site_dir, exist_ok=True)
-        if site_caso(site, site_dir):
-            site_ssm(site, site_dir)
+def run_site(site, window=None, run_deadline=None):
+    # returns None for sites deferred to the next run
+    log = site_logger(site)
+    if run_deadline is not None and time.monotonic() >= run_deadline:
+        log.warning(f"Run deadline reached, deferring site {site['name']}")
+        return None
+    deadline = time.monotonic() + CONF.accounting.site_timeout
+    log.info(f"Configuring site {site['name']}")
+    site_dir = os.path.join(CONF.accounting.spool_dir, site["name"])
+    os.makedirs(site_dir, exist_ok=True)
+    if CONF.accounting.engine == "inprocess":
+        from .caso_engine import site_extract as extract
+    else:
+        extract = site_caso
+    try:
+        checkpoints.get_store().register(
+            site["name"],
+            [
+                (project["id"], run_config["extractor"])
+                for project in site["projects"]
+                for run_type, run_config in caso_run_configs.items()
+                if run_type in CONF.accounting.caso_runs
+            ],
+        )
+        return_codes = extract(site, site_dir, log, window, deadline)
+        failed = [key for key, code in return_codes.items() if code != 0]
+        for project_id, run_type in failed:
+            log.warning(f"caso failed for {run_type} on project {project_id}")
+        if not return_codes:
+            return True
+        if CONF.accounting.compact:
+            compaction.compact_site(site_dir, log)
+        if CONF.accounting.sender == "inprocess":
+            # sent for all the sites at once at the end of the run
+            return not failed
+        # a slow extraction must not leave the records unsent on every run
+        send_deadline = time.monotonic() + CONF.accounting.send_timeout
+        return site_ssm(site, site_dir, log, send_deadline) and not failed
+    except Exception as e:
+        log.exception(f"Unable to run accounting for site {site['name']}: {e}")
+        return False
+
+
+def by_staleness(sites):
+    # sites with the oldest checkpoints first, new ones before everything
+    oldest = checkpoints.get_store().oldest()
+    never = datetime.datetime.min.replace(tzinfo=tz.tzutc())
+    return sorted(sites, key=lambda site: oldest.get(site["name"]) or never)
+
+
+def run(sites, window=None):
+    run_deadline = time.monotonic() + CONF.accounting.run_deadline
+    if CONF.accounting.force_run:
+        logging.info("Force run the extraction of records for all sites.")
+        accounting_sites = list(sites.values())
+    else:
+        accounting_sites = list(sites.accounting_sites())
+    accounting_sites = by_staleness(accounting_sites)
+    prefetch_secrets(accounting_sites)
+    with ThreadPoolExecutor(max_workers=CONF.accounting.site_workers) as executor:
+        results = dict(
+            zip(
+                (site["name"] for site in accounting_sites),
+                executor.map(
+                    functools.partial(
+                        run_site, window=window, run_deadline=run_deadline
+                    ),
+                    accounting_sites,
+                ),
+            )
+        )
+    deferred = [name for name, good_run in results.items() if good_run is None]
+    if deferred:
+        logging.warning(f"Sites deferred to the next run: {', '.join(deferred)}")
+        results = {
+            name: good_run for name, good_run in results.items() if name not in deferred
+        }
+    if CONF.accounting.sender == "inprocess":
+        from .ssm_sender import send
+
+        try:
+            sent = send(accounting_sites)
+        except Exception as e:
+            logging.exception(f"Unable to send the accounting records: {e}")
+            sent = {site["name"]: False for site in accounting_sites}
+        for name, site_sent in sent.items():
+            results[name] = results.get(name, True) and site_sent
+    failed = sorted(name for name, good_run in results.items() if not good_run)
+    if failed:
+        logging.warning(f"Accounting failed for sites: {', '.join(failed)}")
+    return results
+
+
+def status():
+    before = datetime.datetime.now(tz.tzutc()) - datetime.timedelta(
+        seconds=CONF.accounting.stale_after
+    )
+    stale = checkpoints.get_store().stale(before)
+    for site, project, extractor, last_extracted in stale:
+        last = last_extracted.isoformat() if last_extracted else "never"
+        print(f"{site}\t{project}\t{extractor}\t{last}")
+    return stale
+
+
+def add_command_parsers(subparsers):
+    # a plain accounting call runs as it always did
+    subparsers.required = False
+    subparsers.add_parser(
+        "run", help="Extract and send the accounting records (default)"
+    )
+    subparsers.add_parser("status", help="List the projects with stale accounting")
+    subparsers.add_parser(
+        "backfill", help="Extract the missing records in windows, concurrently"
+    )
+    report_parser = subparsers.add_parser(
+        "report", help="Summarise the records waiting in the spool"
+    )
+    report_parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    report_parser.add_argument("--output", help="Write the report to this file")
 
 
 def main():
+    # caso registers its command line options on import
+    from . import caso_engine  # noqa: F401
+
+    CONF.register_cli_opt(
+        cfg.SubCommandOpt("command", handler=add_command_parsers, dest="command")
+    )
     CONF(sys.argv[1:])
     logging.basicConfig(level=logging.DEBUG)
-    run(load_sites())
+    if CONF.command.name == "status":
+        sys.exit(1 if status() else 0)
+    if CONF.command.name == "report":
+        from .spool import selected_queues
+        from .usage_report import report
+
+        report(
+            selected_queues(CONF.accounting.spool_dir),
+            CONF.command.format,
+            CONF.command.output,
+        )
+        return
+    if CONF.command.name == "backfill":
+        run(load_sites(), window=CONF.accounting.backfill_window)
+    else:
+        # run, also when no command is given
+        run(load_sites())
 
 
 if __name__ == "__main__":
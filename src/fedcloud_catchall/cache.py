@@ -0,0 +1,70 @@
+"""
+Local cache shared by the tools
+
+Stores small documents under the configured cache directory so they can be
+reused across the different tools (and runs) on the same host
+"""
+
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from .config import CONF
+
+
+def cache_file(name):
+    if not CONF.cache.cache_dir:
+        return None
+    return os.path.join(CONF.cache.cache_dir, name)
+
+
+def write_atomic(path, content):
+    # write into a temporary file on the same directory and rename it, so
+    # readers never see a half-written file
+    dirname = os.path.dirname(path) or "."
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(name):
+    path = cache_file(name)
+    if not path:
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.debug(f"Unable to load cache file {path}: {e}")
+        return None
+
+
+def store(name, entry):
+    path = cache_file(name)
+    if not path:
+        return
+    entry.setdefault("timestamp", time.time())
+    try:
+        write_atomic(path, json.dumps(entry))
+    except OSError as e:
+        logging.warning(f"Unable to write cache file {path}: {e}")
+
+
+def age(entry):
+    if not entry:
+        return None
+    return time.time() - entry.get("timestamp", 0)
+
+
+def is_fresh(entry, ttl):
+    entry_age = age(entry)
+    return entry_age is not None and entry_age < ttl
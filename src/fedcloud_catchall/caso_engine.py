@@ -0,0 +1,281 @@
+"""
+In-process cASO extraction
+
+Drives the cASO extractors and SSM messenger directly so a whole site is
+extracted in one pass, sharing its Keystone login across projects instead of
+running one caso-extract process per project and extractor.
+
+cASO registers command line options when imported, so this module must be
+imported before the configuration is parsed.
+"""
+
+import contextlib
+import datetime
+import logging
+import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import caso.config  # noqa: F401 registers the logging options used by caso
+import requests
+from caso.extract.openstack import CinderExtractor, NovaExtractor
+from caso.messenger.ssm import SSMMessenger
+from dateutil import tz
+from keystoneauth1 import exceptions as ks_exceptions
+from keystoneauth1 import loading, session
+from keystoneauth1.identity import v3
+from keystoneclient.v3 import client as ks_client_v3
+
+from . import checkpoints
+from .accounting import (
+    TIMEOUT_RETURN_CODE,
+    accounting_site_name,
+    caso_run_configs,
+    collect_return_codes,
+    command_timeout,
+    extraction_jobs,
+)
+from .config import CONF
+from .discovery import get_access_token
+from .registry import APPCRED_AUTH
+from .vault import get_vo_secrets
+
+extractors = {
+    "cinder": CinderExtractor,
+    "nova": NovaExtractor,
+}
+
+# cASO reads the site settings from the global configuration, only held while
+# setting them up, never during the extraction
+_conf_lock = threading.Lock()
+# sites extracting with the site names set in the global configuration
+_conf_users = 0
+
+
+class SiteSessions:
+    """Keystone sessions of a site sharing one connection pool
+
+    Sites using Check-in are logged in once and the unscoped token is then
+    rescoped to every project, or to the system for the user lookups of
+    cASO; application credentials are bound to a project so those get a
+    login per project.
+    """
+
+    def __init__(self, site, deadline=None):
+        self.site = site
+        self.deadline = deadline
+        self.appcred = site["static"].get("auth", None) == APPCRED_AUTH
+        self._http = requests.Session()
+        self._unscoped = None
+        self._sessions = {}
+        self._no_system_scope = False
+        self._lock = threading.Lock()
+
+    def _session(self, auth):
+        # requests to a hung endpoint must not outlive the site budget
+        timeout = max(command_timeout(self.deadline), 1)
+        return session.Session(auth=auth, session=self._http, timeout=timeout)
+
+    def _unscoped_token(self):
+        if self._unscoped is None:
+            auth = v3.OidcClientCredentials(
+                auth_url=self.site["url"],
+                identity_provider="egi.eu",
+                protocol="openid",
+                client_id=CONF.checkin.client_id,
+                client_secret=CONF.checkin.client_secret,
+                scope=CONF.checkin.scopes,
+                discovery_endpoint=CONF.checkin.discovery_endpoint,
+                access_token_type="access_token",
+            )
+            self._unscoped = self._session(auth)
+        return self._unscoped.get_token()
+
+    def _appcred_auth(self, project_id):
+        vo = next(p for p in self.site["projects"] if p["id"] == project_id)
+        options = dict(get_vo_secrets(self.site["url"], vo["name"], get_access_token()))
+        options.update(vo.get("auth", {}))
+        loader = loading.get_plugin_loader(self.site["static"]["auth"])
+        return loader.load_from_options(auth_url=self.site["url"], **options)
+
+    def _get(self, project_id, system_scope=None):
+        key = (project_id, system_scope)
+        with self._lock:
+            if key not in self._sessions:
+                if self.appcred:
+                    auth = self._appcred_auth(project_id)
+                else:
+                    auth = v3.Token(
+                        auth_url=self.site["url"],
+                        token=self._unscoped_token(),
+                        project_id=project_id,
+                        system_scope=system_scope,
+                    )
+                self._sessions[key] = self._session(auth)
+            return self._sessions[key]
+
+    def get(self, project_id, system_scope=None):
+        # application credentials cannot be rescoped
+        if self.appcred or not system_scope or self._no_system_scope:
+            return self._get(project_id)
+        sess = self._get(None, system_scope)
+        try:
+            sess.get_token()
+        except ks_exceptions.ClientException as e:
+            # as cASO does, keep to the project if the site does not allow it
+            logging.debug(f"Unable to get a system scoped token: {e}")
+            self._no_system_scope = True
+            return self._get(project_id)
+        return sess
+
+
+def site_extractor(extractor_cls, sessions):
+    class SiteExtractor(extractor_cls):
+        def _get_keystone_session(self):
+            return sessions.get(self.project)
+
+        def _get_keystone_client(self, project_scoped=True):
+            sess = (
+                sessions.get(self.project)
+                if project_scoped
+                else sessions.get(self.project, system_scope="all")
+            )
+            return ks_client_v3.Client(session=sess, interface="public")
+
+    return SiteExtractor
+
+
+@contextlib.contextmanager
+def caso_site_names(site):
+    # cASO builds the records with the names in the global configuration,
+    # these only need to be valid while any site is extracting as records
+    # get the names of their own site once extracted
+    global _conf_users
+    with _conf_lock:
+        if not _conf_users:
+            CONF.set_override("site_name", accounting_site_name(site))
+            CONF.set_override("service_name", site["hostname"])
+        _conf_users += 1
+    try:
+        yield
+    finally:
+        with _conf_lock:
+            _conf_users -= 1
+            if not _conf_users:
+                CONF.clear_override("service_name")
+                CONF.clear_override("site_name")
+
+
+class SiteExtraction:
+    """Extraction of every configured project and run type of a site"""
+
+    def __init__(self, site, site_dir, log=logging, window=None, deadline=None):
+        self.site = site
+        self.site_dir = site_dir
+        self.log = log
+        self.window = window
+        self.deadline = deadline
+        self.site_name = accounting_site_name(site)
+        self.service_name = site["hostname"]
+        self.now = datetime.datetime.now(tz.tzutc())
+        self.run_types = {
+            run_type: run_config
+            for run_type, run_config in caso_run_configs.items()
+            if run_type in CONF.accounting.caso_runs
+        }
+        sessions = SiteSessions(site, deadline)
+        self.extractors = {
+            name: site_extractor(extractor_cls, sessions)
+            for name, extractor_cls in extractors.items()
+        }
+        self.messengers = {}
+        self.store = checkpoints.get_store()
+
+    def extract_project(self, project, run_type, run_config, window):
+        extractor_name = run_config["extractor"]
+        extract_from, extract_to = window
+        self.log.debug(
+            f"Extracting {run_type} records for project {project['id']} "
+            f"({extract_from} to {extract_to})"
+        )
+        extractor = self.extractors[extractor_name](project["id"], project["name"])
+        records = extractor.extract(extract_from, extract_to)
+        for record in records:
+            record.site_name = self.site_name
+            record.compute_service = self.service_name
+        self.log.info(
+            f"Extracted {len(records)} {run_type} records "
+            f"for project {project['id']}"
+        )
+        self.messengers[run_type].push(records)
+        self.store.complete_window(
+            self.site["name"], project["id"], extractor_name, *window
+        )
+
+    def _extract_project(self, *args):
+        project, run_type = args[:2]
+        # threads cannot be killed, pending jobs are dropped instead
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.log.warning(
+                f"Site deadline reached, not extracting {run_type} records "
+                f"for project {project['id']}"
+            )
+            return TIMEOUT_RETURN_CODE
+        try:
+            self.extract_project(*args)
+            return 0
+        except Exception as e:
+            self.log.exception(
+                f"Unable to extract {run_type} records "
+                f"for project {project['id']}: {e}"
+            )
+            return 1
+
+    def _create_messengers(self):
+        with _conf_lock:
+            try:
+                for run_type in self.run_types:
+                    caso_run_dir = os.path.join(self.site_dir, run_type)
+                    os.makedirs(caso_run_dir, exist_ok=True)
+                    # the messenger opens its queue when created
+                    CONF.set_override(
+                        "output_path",
+                        os.path.join(caso_run_dir, "outgoing"),
+                        group="ssm",
+                    )
+                    self.messengers[run_type] = SSMMessenger()
+            finally:
+                CONF.clear_override("output_path", group="ssm")
+
+    def run(self):
+        self._create_messengers()
+        jobs = extraction_jobs(
+            self.site, self.site_dir, self.now, self.window, self.log
+        )
+        workers = (
+            CONF.accounting.backfill_workers
+            if self.window
+            else CONF.accounting.extract_workers
+        )
+        with caso_site_names(self.site):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    (
+                        (project["id"], run_type),
+                        executor.submit(
+                            self._extract_project,
+                            project,
+                            run_type,
+                            run_config,
+                            extract_window,
+                        ),
+                    )
+                    for project, run_type, run_config, extract_window in jobs
+                ]
+        return collect_return_codes(futures)
+
+
+def site_extract(site, site_dir, log=logging, window=None, deadline=None):
+    # returns the same (project, run type) return codes as site_caso
+    return SiteExtraction(site, site_dir, log, window, deadline).run()
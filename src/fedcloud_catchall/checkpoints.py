@@ -0,0 +1,238 @@
+"""
+Accounting checkpoints
+
+Keeps the last extracted timestamp of every (site, project, extractor) in a
+SQLite database in the spool directory, so extraction can resume exactly
+where it stopped and lagging projects are found with a single query
+"""
+
+import contextlib
+import datetime
+import logging
+import os.path
+import sqlite3
+
+import dateutil.parser
+from dateutil import tz
+
+from .config import CONF
+
+DB_NAME = "checkpoints.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    site TEXT NOT NULL,
+    project TEXT NOT NULL,
+    extractor TEXT NOT NULL,
+    last_extracted TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (site, project, extractor)
+);
+CREATE TABLE IF NOT EXISTS windows (
+    site TEXT NOT NULL,
+    project TEXT NOT NULL,
+    extractor TEXT NOT NULL,
+    window_start TEXT NOT NULL,
+    window_end TEXT NOT NULL,
+    PRIMARY KEY (site, project, extractor, window_start)
+);
+"""
+
+
+def _to_text(timestamp):
+    # fixed width so timestamps sort as text
+    return timestamp.astimezone(tz.tzutc()).isoformat(timespec="microseconds")
+
+
+def _from_text(text):
+    if text is None:
+        return None
+    return datetime.datetime.fromisoformat(text)
+
+
+def read_lastrun(path):
+    # lastrun files as written by caso-extract
+    try:
+        with open(path) as f:
+            lastrun = dateutil.parser.parse(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.warning(f"Ignoring invalid lastrun file {path}")
+        return None
+    if lastrun.tzinfo is None:
+        lastrun = lastrun.replace(tzinfo=tz.tzutc())
+    return lastrun
+
+
+class CheckpointStore:
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a connection per operation keeps the store usable from every worker
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def register(self, site, keys):
+        # projects are known before their first extraction so they show as stale
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO checkpoints (site, project, extractor) "
+                "VALUES (?, ?, ?)",
+                [(site, project, extractor) for project, extractor in keys],
+            )
+
+    def get(self, site, project, extractor):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT last_extracted FROM checkpoints "
+                "WHERE site = ? AND project = ? AND extractor = ?",
+                (site, project, extractor),
+            ).fetchone()
+        return _from_text(row[0]) if row else None
+
+    @staticmethod
+    def _set(conn, key, last_extracted):
+        now = _to_text(datetime.datetime.now(tz.tzutc()))
+        conn.execute(
+            "INSERT INTO checkpoints "
+            "(site, project, extractor, last_extracted, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (site, project, extractor) DO UPDATE SET "
+            "last_extracted = excluded.last_extracted, "
+            "updated_at = excluded.updated_at",
+            (*key, last_extracted, now),
+        )
+
+    def set(self, site, project, extractor, last_extracted):
+        with self._connect() as conn:
+            self._set(conn, (site, project, extractor), _to_text(last_extracted))
+
+    def done_windows(self, site, project, extractor):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT window_start, window_end FROM windows "
+                "WHERE site = ? AND project = ? AND extractor = ?",
+                (site, project, extractor),
+            ).fetchall()
+        return {(_from_text(start), _from_text(end)) for start, end in rows}
+
+    def complete_window(self, site, project, extractor, start, end):
+        # windows may finish in any order, the checkpoint only moves over the
+        # ones following it without holes
+        key = (site, project, extractor)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO windows "
+                "(site, project, extractor, window_start, window_end) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (*key, _to_text(start), _to_text(end)),
+            )
+            row = conn.execute(
+                "SELECT last_extracted FROM checkpoints "
+                "WHERE site = ? AND project = ? AND extractor = ?",
+                key,
+            ).fetchone()
+            last = row[0] if row and row[0] else _to_text(start)
+            while True:
+                row = conn.execute(
+                    "SELECT window_end FROM windows WHERE site = ? AND project = ? "
+                    "AND extractor = ? AND window_start = ?",
+                    (*key, last),
+                ).fetchone()
+                if row is None:
+                    break
+                last = row[0]
+            self._set(conn, key, last)
+            conn.execute(
+                "DELETE FROM windows WHERE site = ? AND project = ? "
+                "AND extractor = ? AND window_end <= ?",
+                (*key, last),
+            )
+
+    def stale(self, before):
+        # every checkpoint older than before, or never extracted at all
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT site, project, extractor, last_extracted FROM checkpoints "
+                "WHERE last_extracted IS NULL OR last_extracted < ? "
+                "ORDER BY last_extracted IS NOT NULL, last_extracted, "
+                "site, project, extractor",
+                (_to_text(before),),
+            ).fetchall()
+        return [
+            (site, project, extractor, _from_text(last_extracted))
+            for site, project, extractor, last_extracted in rows
+        ]
+
+    def oldest(self):
+        # oldest checkpoint of every site, None if a project was never extracted
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT site, MIN(last_extracted), "
+                "COUNT(*) - COUNT(last_extracted) FROM checkpoints GROUP BY site"
+            ).fetchall()
+        return {
+            site: None if never else _from_text(oldest) for site, oldest, never in rows
+        }
+
+
+def get_store():
+    return CheckpointStore(os.path.join(CONF.accounting.spool_dir, DB_NAME))
+
+
+def extract_from(store, site, project, run_type, extractor, site_dir, now, log=logging):
+    # start of the next extraction window for the project
+    last = store.get(site["name"], project["id"], extractor)
+    if last is None:
+        # fall back to the lastrun file of previous runs
+        last = read_lastrun(
+            os.path.join(site_dir, run_type, f"lastrun.{project['id']}")
+        )
+    if last is None:
+        log.warning(
+            f"No checkpoint for {extractor} on project {project['id']}, "
+            "extracting from yesterday"
+        )
+        return now - datetime.timedelta(days=1)
+    gap = now - last
+    if gap.total_seconds() > CONF.accounting.stale_after:
+        log.warning(
+            f"Project {project['id']} is behind by {gap} for {extractor}, "
+            f"extracting since {last.isoformat()}"
+        )
+    return last
+
+
+def pending_windows(
+    store, site, project, run_type, extractor, site_dir, now, size=None, log=logging
+):
+    # windows still to extract for the project, around the ones already done
+    # and no longer than the window size if one is given
+    start = extract_from(store, site, project, run_type, extractor, site_dir, now, log)
+    if store.get(site["name"], project["id"], extractor) is None:
+        # windows only move forward an existing checkpoint
+        store.set(site["name"], project["id"], extractor, start)
+    done = sorted(store.done_windows(site["name"], project["id"], extractor))
+    step = datetime.timedelta(seconds=size) if size else None
+    windows = []
+    # fill the gaps between the done windows, which may not fall on the same
+    # grid (e.g. a partial last window of a previous run)
+    for done_start, done_end in done + [(now, now)]:
+        gap_end = min(done_start, now)
+        while start < gap_end:
+            end = min(start + step, gap_end) if step else gap_end
+            windows.append((start, end))
+            start = end
+        start = max(start, done_end)
+    return windows
@@ -10,7 +10,8 @@ import yaml
 from oslo_config import cfg
 
 from .config import CONF
-from .discovery import get_vo_secrets
+from .discovery import get_access_token, token_manager
+from .vault import get_site_secrets
 
 
 def secretize(site_config_file: str, access_token: str):
@@ -20,13 +21,15 @@ def secretize(site_config_file: str, access_token: str):
     if site_config.get("auth", None) != "v3applicationcredential":
         return site_config
 
-    for vo in site_config.get("vos", {}):
+    vos = site_config.get("vos", {})
+    site_secrets = get_site_secrets(
+        site_config.get("endpoint", ""),
+        [vo.get("name", "") for vo in vos],
+        access_token,
+    )
+    for vo in vos:
         auth = vo.get("auth", {})
-        auth.update(
-            get_vo_secrets(
-                site_config.get("endpoint", ""), vo.get("name", ""), access_token
-            )
-        )
+        auth.update(site_secrets.get(vo.get("name", ""), {}))
     return site_config
 
 
@@ -34,7 +37,9 @@ def main():
     CONF.register_cli_opt(cfg.StrOpt("site_config", positional=True))
     CONF(sys.argv[1:])
     logging.basicConfig(level=logging.DEBUG)
-    print(yaml.dump(secretize(CONF.site_config, os.environ.get("OS_ACCESS_TOKEN", ""))))
+    if os.environ.get("OS_ACCESS_TOKEN"):
+        token_manager.set(os.environ["OS_ACCESS_TOKEN"])
+    print(yaml.dump(secretize(CONF.site_config, get_access_token())))
 
 
 if __name__ == "__main__":
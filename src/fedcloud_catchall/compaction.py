@@ -0,0 +1,137 @@
+"""
+Compaction of accounting messages
+
+Merges the many small messages that cASO leaves in the outgoing queues into
+fewer, larger ones before they are sent, keeping the APEL formats and the
+record limits of each message
+"""
+
+import json
+import logging
+import os.path
+import xml.etree.ElementTree as ETree  # nosec
+
+import dirq.QueueSimple
+
+from .config import CONF
+
+CLOUD_HEADER = b"APEL-cloud-message:"
+CLOUD_SEPARATOR = "\n%%\n"
+STORAGE_NAMESPACE = "http://eu-emi.eu/namespaces/2011/02/storagerecord"
+
+ETree.register_namespace("sr", STORAGE_NAMESPACE)
+
+
+def _parse(data):
+    # returns the group of the message and its records, or None if the
+    # format is not known
+    if data.startswith(CLOUD_HEADER):
+        header, _, body = data.decode("utf-8").partition("\n")
+        records = body.rstrip("\n").split(CLOUD_SEPARATOR) if body.strip() else []
+        return ("cloud", header), records
+    if data.startswith(b"<"):
+        # our own spool, written by cASO
+        root = ETree.fromstring(data)  # nosec
+        if root.tag != f"{{{STORAGE_NAMESPACE}}}StorageUsageRecords":
+            return None
+        return ("storage",), [ETree.tostring(record) for record in root]
+    if data.startswith(b"{"):
+        message = json.loads(data)
+        return ("json", message["Type"], message["Version"]), [
+            json.dumps(record) for record in message["UsageRecords"]
+        ]
+    return None
+
+
+def _build(group, records):
+    if group[0] == "cloud":
+        return f"{group[1]}\n{CLOUD_SEPARATOR.join(records)}\n".encode("utf-8")
+    if group[0] == "storage":
+        root = ETree.Element(f"{{{STORAGE_NAMESPACE}}}StorageUsageRecords")
+        for record in records:
+            root.append(ETree.fromstring(record))  # nosec
+        return ETree.tostring(root)
+    _, msg_type, version = group
+    return json.dumps(
+        {
+            "Type": msg_type,
+            "Version": version,
+            "UsageRecords": [json.loads(record) for record in records],
+        }
+    ).encode("utf-8")
+
+
+def _batches(records):
+    batch, size = [], 0
+    for record in records:
+        if batch and (
+            len(batch) >= CONF.accounting.compact_max_records
+            or size + len(record) > CONF.accounting.compact_max_bytes
+        ):
+            yield batch
+            batch, size = [], 0
+        batch.append(record)
+        size += len(record)
+    if batch:
+        yield batch
+
+
+def compact_queue(path):
+    # returns the number of messages before and after the compaction
+    if not os.path.isdir(path):
+        return 0, 0
+    queue = dirq.QueueSimple.QueueSimple(path)
+    groups = {}
+    locked = []
+    try:
+        for name in queue:
+            if not queue.lock(name):
+                continue
+            locked.append(name)
+            try:
+                parsed = _parse(queue.get(name))
+            except (ValueError, KeyError, TypeError, ETree.ParseError):
+                parsed = None
+            if parsed is None:
+                logging.debug(f"Leaving message {name} of {path} as is")
+                queue.unlock(name)
+                locked.remove(name)
+                continue
+            group, records = parsed
+            names, group_records = groups.setdefault(group, ([], []))
+            names.append(name)
+            group_records.extend(records)
+        before = after = 0
+        for group, (names, records) in groups.items():
+            batches = list(_batches(records))
+            before += len(names)
+            if len(batches) >= len(names):
+                # nothing to gain
+                after += len(names)
+                continue
+            # new messages are in the queue before the old ones go away, a
+            # failure in between would only send some records twice
+            for batch in batches:
+                queue.add(_build(group, batch))
+            for name in names:
+                queue.remove(name)
+                locked.remove(name)
+            after += len(batches)
+    finally:
+        for name in locked:
+            queue.unlock(name)
+    queue.purge()
+    return before, after
+
+
+def compact_site(site_dir, log=logging):
+    # compacts the outgoing queues of the site, returns the number of messages
+    # before and after
+    before = after = 0
+    for run_type in CONF.accounting.caso_runs:
+        b, a = compact_queue(os.path.join(site_dir, run_type, "outgoing"))
+        before += b
+        after += a
+    if before != after:
+        log.info(f"Compacted {before} outgoing messages into {after}")
+    return before, after
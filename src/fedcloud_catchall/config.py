@@ -10,10 +10,52 @@ CONF.register_opts(
     [
         cfg.StrOpt("site_config_dir", default="."),
         cfg.StrOpt("fedcloud_info_system_url", default="https://is.cloud.egi.eu"),
+        cfg.IntOpt("site_info_ttl", default=10 * 60),
+        cfg.IntOpt("site_info_max_stale", default=24 * 60 * 60),
     ],
     group="discovery",
 )
 
+# Selection of sites and VOs for targeted runs
+CONF.register_cli_opts(
+    [
+        cfg.MultiStrOpt(
+            "site",
+            default=[],
+            help="Only process sites matching this glob (may be repeated)",
+        ),
+        cfg.MultiStrOpt(
+            "vo",
+            default=[],
+            help="Only process VOs matching this glob (may be repeated)",
+        ),
+    ]
+)
+
+# HTTP clients configuration
+CONF.register_opts(
+    [
+        cfg.BoolOpt("http2", default=True),
+        cfg.IntOpt("max_connections", default=20),
+        cfg.IntOpt("max_keepalive_connections", default=10),
+        cfg.FloatOpt("keepalive_expiry", default=30),
+        cfg.FloatOpt("connect_timeout", default=5),
+        cfg.FloatOpt("info_system_timeout", default=30),
+        cfg.FloatOpt("checkin_timeout", default=10),
+        cfg.FloatOpt("registry_timeout", default=30),
+        cfg.FloatOpt("ams_timeout", default=60),
+    ],
+    group="http",
+)
+
+# Local cache, disabled if no directory is set
+CONF.register_opts(
+    [
+        cfg.StrOpt("cache_dir"),
+    ],
+    group="cache",
+)
+
 CONF.register_opts(
     [
         cfg.StrOpt("client_id"),
@@ -27,11 +69,30 @@ CONF.register_opts(
             default="https://aai.egi.eu/auth/realms/egi/.well-known/openid-configuration",
         ),
         cfg.IntOpt("access_token_ttl", default=20 * 60),
+        cfg.IntOpt("jwks_ttl", default=24 * 60 * 60),
+        # used if the discovery endpoint does not set max-age
+        cfg.IntOpt("oidc_config_ttl", default=60 * 60),
+        cfg.IntOpt("oidc_config_max_stale", default=7 * 24 * 60 * 60),
+        # Unix socket of the token broker, if running
+        cfg.StrOpt("broker_socket"),
+        cfg.FloatOpt("broker_timeout", default=2),
     ],
     group="checkin",
 )
 
 
+# Vault configuration
+CONF.register_opts(
+    [
+        cfg.IntOpt("secrets_ttl", default=60 * 60),
+        cfg.IntOpt("max_workers", default=8),
+        cfg.BoolOpt("list_secrets", default=True),
+        cfg.IntOpt("token_min_ttl", default=5 * 60),
+    ],
+    group="vault",
+)
+
+
 # Registry configuration
 CONF.register_opts(
     [
@@ -41,6 +102,11 @@ CONF.register_opts(
         cfg.ListOpt("formats", default=[]),
         cfg.StrOpt("registry_user"),
         cfg.StrOpt("registry_password"),
+        # Harbor does not return more than 100 projects per page
+        cfg.IntOpt("registry_page_size", default=100, min=1),
+        cfg.IntOpt("registry_workers", default=4, min=1),
+        # lists of several pages cannot be fully revalidated with one request
+        cfg.IntOpt("registry_projects_ttl", default=6 * 60 * 60),
     ],
     group="sync",
 )
@@ -52,6 +118,50 @@ CONF.register_opts(
         cfg.StrOpt("spool_dir", default="/var/spool/egi"),
         cfg.BoolOpt("force_run", default=False),
         cfg.ListOpt("caso_runs", default=["block", "compute"]),
+        # number of sites processed concurrently
+        cfg.IntOpt("site_workers", default=1, min=1),
+        # number of caso-extract processes running concurrently for a site
+        cfg.IntOpt("extract_workers", default=1, min=1),
+        # run caso-extract per project or extract the whole site in-process
+        cfg.StrOpt("engine", default="subprocess", choices=["subprocess", "inprocess"]),
+        # projects not extracted for longer than this are reported as stale
+        cfg.IntOpt("stale_after", default=2 * 24 * 60 * 60),
+        # size and concurrency of the extraction windows when backfilling
+        cfg.IntOpt("backfill_window", default=24 * 60 * 60, min=60),
+        cfg.IntOpt("backfill_workers", default=4, min=1),
+        # time budgets in seconds, a command is killed once it runs longer than
+        # command_timeout or its site goes over site_timeout, sending with
+        # ssmsend has its own send_timeout once extracted, and sites not
+        # started within run_deadline are left for the next run
+        cfg.IntOpt("command_timeout", default=30 * 60, min=1),
+        cfg.IntOpt("site_timeout", default=60 * 60, min=1),
+        cfg.IntOpt("send_timeout", default=15 * 60, min=1),
+        cfg.IntOpt("run_deadline", default=2 * 60 * 60, min=1),
+        # send the records with ssmsend or with a single in-process sender
+        cfg.StrOpt("sender", default="ssmsend", choices=["ssmsend", "inprocess"]),
+        cfg.StrOpt("host_cert", default="/etc/grid-security/hostcert.pem"),
+        cfg.StrOpt("host_key", default="/etc/grid-security/hostkey.pem"),
+        cfg.StrOpt("ams_project", default="accounting"),
+        cfg.IntOpt("ams_batch_size", default=100, min=1),
+        cfg.BoolOpt(
+            "compact",
+            default=False,
+            help="Merge the outgoing messages of each site before sending them",
+        ),
+        # APEL and the GGUS limits expect at most 100 records per message
+        cfg.IntOpt("compact_max_records", default=100, min=1),
+        cfg.IntOpt("compact_max_bytes", default=1024 * 1024, min=1024),
+        # record-cleaner renames the queues aside and unlinks them in parallel
+        # instead of locking and removing every element
+        cfg.BoolOpt("fast_purge", default=True),
+        cfg.IntOpt("purge_workers", default=8, min=1),
+        # queues scanned in parallel by spool-stats and accounting report
+        cfg.IntOpt("scan_workers", default=8, min=1),
+        # with any of these set, record-cleaner only evicts the oldest records
+        # over the limits instead of purging everything
+        cfg.IntOpt("retention_max_age", help="Seconds to keep queued records"),
+        cfg.IntOpt("retention_site_bytes", help="Bytes of queued records per site"),
+        cfg.IntOpt("retention_quota", help="Bytes of queued records in the spool"),
     ],
     group="accounting",
 )
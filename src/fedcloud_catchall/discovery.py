@@ -2,22 +2,26 @@
 Configuration discovery for the different sites
 """
 
+import fnmatch
 import glob
 import logging
 import os.path
-from urllib.parse import urlparse
+import time
 
 import httpx
-import hvac
-import jwt
 import yaml
-from hvac.exceptions import VaultError
 
+from . import cache
 from .config import CONF
-from .token_generator import generate_token, get_oidc_config
-
-_hvac_client = None
-VAULT_URL = "https://vault.services.fedcloud.eu:8200"
+from .http_client import get_client
+from .registry import APPCRED_AUTH, SiteRegistry
+from .token_generator import (
+    TokenManager,
+    fetch_broker_token,
+    generate_token,
+    get_oidc_config,
+)
+from .vault import get_vo_secrets, prefetch_vo_secrets
 
 OIDC_AUTH_TEMPLATE = """
 auth_type = v3oidcclientcredentials
@@ -36,19 +40,63 @@ APPCRED_AUTH_TEMPLATE = """
 auth_type = {auth_type}
 auth_url = {auth_url}"""
 
-_access_token = None
+SITE_INFO_CACHE = "site-info.json"
+STATIC_SITES_CACHE = "static-sites.json"
+STATIC_SITES_VERSION = 2
 
+# use the much faster libyaml based loader if available
+_yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-def fetch_site_info():
+
+def _fetch_site_listing(cached):
     logging.debug("Fetching site info from cloud-info")
-    # 1 - Get all sites listing
-    r = httpx.get(
-        os.path.join(CONF.discovery.fedcloud_info_system_url, "sites/"),
-        params={"include_projects": True},
-        headers={"Accept": "application/json"},
+    headers = {"Accept": "application/json"}
+    if cached:
+        # revalidate what we have instead of getting everything again
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        r = get_client("info_system").get(
+            os.path.join(CONF.discovery.fedcloud_info_system_url, "sites/"),
+            params={"include_projects": True},
+            headers=headers,
+        )
+        if r.status_code != httpx.codes.NOT_MODIFIED:
+            r.raise_for_status()
+    except httpx.HTTPError as e:
+        if cache.age(cached) is None or (
+            cache.age(cached) > CONF.discovery.site_info_max_stale
+        ):
+            raise
+        logging.warning(f"Unable to fetch site info, using cached copy: {e}")
+        return cached["sites"]
+    if r.status_code == httpx.codes.NOT_MODIFIED:
+        logging.debug("Site info not modified since last fetch")
+        sites = cached["sites"]
+    else:
+        sites = r.json()
+    cache.store(
+        SITE_INFO_CACHE,
+        {
+            "timestamp": time.time(),
+            "etag": r.headers.get("etag"),
+            "last_modified": r.headers.get("last-modified"),
+            "sites": sites,
+        },
     )
-    r.raise_for_status()
-    sites = r.json()
+    return sites
+
+
+def fetch_site_info():
+    # 1 - Get all sites listing, from the local cache if still fresh
+    cached = cache.load(SITE_INFO_CACHE)
+    if cache.is_fresh(cached, CONF.discovery.site_info_ttl):
+        logging.debug("Using cached site info")
+        sites = cached["sites"]
+    else:
+        sites = _fetch_site_listing(cached)
     # 2 - Go one by one getting the shares
     for site in sites:
         # turn this into a more friendly structure for the rest of the code
@@ -56,52 +104,123 @@ def fetch_site_info():
     return sites
 
 
-def get_vo_secrets(endpoint: str, vo_name: str, access_token: str):
-    payload = jwt.decode(access_token, options={"verify_signature": False})
+def _load_site_file(site_file):
+    with open(site_file, "r") as f:
+        return yaml.load(f.read(), Loader=_yaml_loader)
 
-    global _hvac_client
-    if not _hvac_client:
-        _hvac_client = hvac.Client(url=VAULT_URL)
-        _hvac_client.auth.jwt.jwt_login(role="", jwt=access_token)
-    keystone_host = urlparse(endpoint).netloc.split(":", 1)[0]
-    secret_path = os.path.join(
-        "users", payload.get("sub", ""), "cloudmon", keystone_host, vo_name
-    )
+
+def _load_static_snapshot():
+    # plain JSON: the cache directory is writable from other containers, and
+    # anything unexpected in it just means parsing the site files again
+    snapshot = cache.load(STATIC_SITES_CACHE)
     try:
-        return _hvac_client.secrets.kv.v1.read_secret(
-            path=secret_path,
-            mount_point="/secrets/",
-        ).get("data", {})
-    except VaultError as e:
-        logging.debug(f"Ouch {e}")
-        return {}
+        if snapshot.get("version") == STATIC_SITES_VERSION:
+            return {
+                path: (tuple(key), dict(site))
+                for path, (key, site) in snapshot["files"].items()
+            }
+    except Exception as e:
+        logging.debug(f"Unable to load static sites snapshot: {e}")
+    return {}
 
 
-def load_sites():
-    sites = {}
-    api_sites = fetch_site_info()
+def selected(name, patterns):
+    # patterns are globs, each option may also be a comma separated list
+    patterns = [p for pattern in patterns for p in pattern.split(",") if p]
+    return not patterns or any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+
+def load_static_sites(site_patterns=()):
     static_sites = {}
+    use_snapshot = cache.cache_file(STATIC_SITES_CACHE) is not None
+    snapshot = _load_static_snapshot() if use_snapshot else {}
+    files = {}
+    changed = False
     for site_file in glob.iglob("*.yaml", root_dir=CONF.discovery.site_config_dir):
-        with open(os.path.join(CONF.discovery.site_config_dir, site_file), "r") as f:
-            site = yaml.safe_load(f.read())
+        site_path = os.path.join(CONF.discovery.site_config_dir, site_file)
+        # file names do not always match the site, selection goes by the
+        # gocdb name, so new or changed files are always parsed
+        if use_snapshot:
+            st = os.stat(site_path)
+            key = (st.st_mtime_ns, st.st_size)
+            entry = snapshot.get(site_path)
+            if entry and entry[0] == key:
+                site = entry[1]
+            else:
+                logging.debug(f"Parsing {site_path}")
+                site = _load_site_file(site_path)
+                changed = True
+            files[site_path] = (key, site)
+        else:
+            site = _load_site_file(site_path)
+        if selected(site["gocdb"], site_patterns):
             static_sites[site["gocdb"]] = site
+    if use_snapshot and (changed or len(files) != len(snapshot)):
+        cache.store(
+            STATIC_SITES_CACHE, {"version": STATIC_SITES_VERSION, "files": files}
+        )
+    return static_sites
+
+
+def load_sites(site_patterns=None, vo_patterns=None):
+    if site_patterns is None:
+        site_patterns = CONF.site
+    if vo_patterns is None:
+        vo_patterns = CONF.vo
+    sites = SiteRegistry()
+    api_sites = fetch_site_info()
+    static_sites = load_static_sites(site_patterns)
     for site in api_sites:
         site_name = site["name"]
         static_site = static_sites.get(site_name, None)
         if not static_site:
             logging.debug(f"Discarding site {site_name}, not in config.")
             continue
+        if vo_patterns:
+            site["projects"] = [
+                p for p in site["projects"] if selected(p["name"], vo_patterns)
+            ]
+            site["shares"] = {
+                name: share
+                for name, share in site["shares"].items()
+                if selected(name, vo_patterns)
+            }
+            if not site["shares"]:
+                logging.debug(f"Discarding site {site_name}, no selected VOs.")
+                continue
         for vo in static_site["vos"]:
             if vo["name"] in site["shares"]:
                 site["shares"][vo["name"]]["auth"] = vo.get("auth", {})
         site["static"] = static_site
-        sites[site["id"]] = site
+        sites.add(site)
     return sites
 
 
+def _new_access_token():
+    return fetch_broker_token() or generate_token(get_oidc_config())
+
+
+token_manager = TokenManager(_new_access_token)
+
+
+def get_access_token():
+    return token_manager.get()
+
+
+def prefetch_secrets(sites):
+    secrets = [
+        (site["url"], vo_name)
+        for site in sites
+        if site["static"].get("auth", None) == APPCRED_AUTH
+        for vo_name in site["shares"]
+    ]
+    if secrets:
+        prefetch_vo_secrets(secrets, get_access_token())
+
+
 def auth_config(site, vo, section_name):
     cfg = [f"[{section_name}]"]
-    if site["static"].get("auth", None) != "v3applicationcredential":
+    if site["static"].get("auth", None) != APPCRED_AUTH:
         cfg.append(
             OIDC_AUTH_TEMPLATE.format(
                 auth_url=site["url"],
@@ -113,9 +232,7 @@ def auth_config(site, vo, section_name):
             ).strip()
         )
     else:
-        global _access_token
-        if not _access_token:
-            _access_token = generate_token(get_oidc_config())
+        access_token = get_access_token()
         cfg.append(
             APPCRED_AUTH_TEMPLATE.format(
                 auth_url=site["url"],
@@ -125,7 +242,7 @@ def auth_config(site, vo, section_name):
         # secrets
         cfg.extend(
             f"{k} = {v}"
-            for k, v in get_vo_secrets(site["url"], vo["name"], _access_token).items()
+            for k, v in get_vo_secrets(site["url"], vo["name"], access_token).items()
         )
         # other params
         cfg.extend(f"{k} = {v}" for k, v in vo.get("auth", {}).items())
@@ -0,0 +1,59 @@
+"""
+Shared HTTP clients
+
+Keeps a pooled client per upstream service so connections (and TLS
+handshakes) are reused by every module talking to the same hosts
+"""
+
+import atexit
+import importlib.util
+import threading
+
+import httpx
+
+from .config import CONF
+
+# upstream services with their own timeout configuration
+UPSTREAMS = ("info_system", "checkin", "registry", "ams")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _client_args(upstream):
+    if upstream not in UPSTREAMS:
+        raise ValueError(f"Unknown upstream {upstream}")
+    return dict(
+        # HTTP/2 needs the optional h2 package
+        http2=CONF.http.http2 and importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=CONF.http.max_connections,
+            max_keepalive_connections=CONF.http.max_keepalive_connections,
+            keepalive_expiry=CONF.http.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            CONF.http.get(f"{upstream}_timeout"),
+            connect=CONF.http.connect_timeout,
+        ),
+    )
+
+
+def get_client(upstream):
+    with _clients_lock:
+        if upstream not in _clients:
+            _clients[upstream] = httpx.Client(**_client_args(upstream))
+        return _clients[upstream]
+
+
+def new_client(upstream, **kwargs):
+    # a client with the settings of the upstream for callers needing their
+    # own, e.g. to authenticate with a client certificate, they must close it
+    return httpx.Client(**_client_args(upstream), **kwargs)
+
+
+@atexit.register
+def close_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
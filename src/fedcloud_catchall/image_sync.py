@@ -6,54 +6,126 @@ synced in the EGI Fedcloud
 """
 
 import logging
+import math
 import os.path
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import httpx
 import yaml
 
+from . import cache
 from .config import CONF
-from .discovery import auth_config, load_sites
+from .discovery import auth_config, load_sites, prefetch_secrets
+from .http_client import get_client
 
+HARBOR_PROJECTS_CACHE = "harbor-projects.json"
 
-# Harbor interaction
-def fetch_harbor_projects():
-    if not (CONF.sync.registry_user and CONF.sync.registry_password):
-        raise ValueError("Missing credentials for registry")
 
-    auth = httpx.BasicAuth(
-        username=CONF.sync.registry_user, password=CONF.sync.registry_password
+# Harbor interaction
+def _projects_page(client, auth, page, headers=None):
+    url = f"{CONF.sync.registry_base_url}/api/v2.0/projects"
+    logging.debug(f"Fetching page {page} from {url}")
+    r = client.get(
+        url,
+        params=dict(page=page, page_size=CONF.sync.registry_page_size),
+        auth=auth,
+        headers=headers or {},
     )
-    client = httpx.Client(auth=auth)
+    if r.status_code != httpx.codes.NOT_MODIFIED:
+        r.raise_for_status()
+    return r
 
-    projects = []
-    page = 1
-    next_url = "/api/v2.0/projects"
-    params = dict(page=page, page_size=10)
 
+def _follow_links(client, auth, r):
+    # registries not telling the total are walked through the next links
+    projects = []
     last_url = ""
-    while next_url:
-        if last_url == next_url:
-            break
-        url = f"{CONF.sync.registry_base_url}{next_url}"
-        logging.debug(f"Fetching page {page} from {url}")
-        r = client.get(url, params=params)
-        r.raise_for_status()
+    while True:
         data = r.json()
         if not data:
             break
         projects.extend(data)
-        last_url = next_url
         next_url = r.links.get("next", {}).get("url", None)
-        params = {}
-        page += 1
+        if not next_url or next_url == last_url:
+            break
+        last_url = next_url
+        url = f"{CONF.sync.registry_base_url}{next_url}"
+        logging.debug(f"Fetching {url}")
+        r = client.get(url, auth=auth)
+        r.raise_for_status()
+    return projects
+
+
+def fetch_harbor_projects():
+    if not (CONF.sync.registry_user and CONF.sync.registry_password):
+        raise ValueError("Missing credentials for registry")
+
+    auth = httpx.BasicAuth(
+        username=CONF.sync.registry_user, password=CONF.sync.registry_password
+    )
+    client = get_client("registry")
+
+    cached = cache.load(HARBOR_PROJECTS_CACHE)
+    if cached and cached.get("url") != CONF.sync.registry_base_url:
+        cached = None
+    # the ETag and the first page only cover the whole list if it fits in a
+    # page that is not full, otherwise a project renamed or replaced further
+    # on with the same total would go unnoticed, so those lists are only
+    # reused for a limited time
+    if (
+        cached
+        and len(cached.get("projects", [])) >= CONF.sync.registry_page_size
+        and not cache.is_fresh(cached, CONF.sync.registry_projects_ttl)
+    ):
+        cached = None
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    r = _projects_page(client, auth, 1, headers)
+    if r.status_code == httpx.codes.NOT_MODIFIED:
+        logging.debug("Harbor projects not modified since last fetch")
+        return cached["projects"]
+
+    first_page = r.json()
+    total = r.headers.get("x-total-count")
+    if total is None:
+        projects = _follow_links(client, auth, r)
+    else:
+        total = int(total)
+        first_names = [p.get("name") for p in first_page]
+        # without an ETag, same total and first page means nothing changed
+        # (within the limits above)
+        if (
+            cached
+            and not r.headers.get("etag")
+            and cached.get("total") == total
+            and cached["projects"][: len(first_names)] == first_names
+        ):
+            logging.debug("Harbor projects unchanged since last fetch")
+            return cached["projects"]
+        pages = range(2, math.ceil(total / CONF.sync.registry_page_size) + 1)
+        with ThreadPoolExecutor(max_workers=CONF.sync.registry_workers) as executor:
+            rest = executor.map(
+                lambda page: _projects_page(client, auth, page).json(), pages
+            )
+            projects = first_page + [p for data in rest for p in data]
 
     # FIXME: we may want to include some metadata in harbor instead of just
     #        matching names. For now this should work
     project_names = [p.get("name") for p in projects]
     logging.debug(f'Obtained {", ".join(project_names)} from Harbor')
+    cache.store(
+        HARBOR_PROJECTS_CACHE,
+        {
+            "url": CONF.sync.registry_base_url,
+            "etag": r.headers.get("etag"),
+            "total": total,
+            "projects": project_names,
+        },
+    )
     return project_names
 
 
@@ -162,13 +234,9 @@ def run_atrope(site, harbor_projects):
 
 
 def do_sync(sites, harbor_projects):
-    for _, site in sites.items():
-        site_name = site["name"]
-
-        image_config = site["static"].get("images", {})
-        if not image_config.get("sync", False):
-            logging.debug(f"Discarding site {site_name}, no sync set.")
-            continue
+    sync_sites = list(sites.image_sync_sites())
+    prefetch_secrets(sync_sites)
+    for site in sync_sites:
         run_atrope(site, harbor_projects)
 
 
@@ -6,17 +6,17 @@ This is mostly a substitute for SSM while we decide whether to
 actually send the records or not
 """
 
-import glob
 import logging
 import sys
 
 from dirq.QueueSimple import QueueSimple
 
 from .config import CONF
+from .spool import enforce_retention, purge_queues, selected_queues
 
 
-def remove_records(site_dir):
-    for spool_dir in glob.iglob("*/outgoing/*", root_dir=site_dir):
+def remove_records(spool_dir):
+    for _, spool_dir in selected_queues(spool_dir):
         logging.debug(f"Cleaning up {spool_dir}")
         dirq = QueueSimple(spool_dir)
         for name in dirq:
@@ -26,7 +26,38 @@ def remove_records(site_dir):
         dirq.purge()
 
 
+def purge_records(spool_dir):
+    freed = purge_queues(selected_queues(spool_dir))
+    for site, (count, size) in freed.items():
+        logging.info(f"Removed {count} records ({size} bytes) of site {site}")
+    return freed
+
+
+def retention_enabled():
+    return any(
+        limit is not None
+        for limit in (
+            CONF.accounting.retention_max_age,
+            CONF.accounting.retention_site_bytes,
+            CONF.accounting.retention_quota,
+        )
+    )
+
+
+def apply_retention(spool_dir):
+    freed = enforce_retention(selected_queues(spool_dir))
+    for site, (count, size) in freed.items():
+        if count:
+            logging.info(f"Evicted {count} records ({size} bytes) of site {site}")
+    return freed
+
+
 def main():
     CONF(sys.argv[1:])
     logging.basicConfig(level=logging.DEBUG)
-    remove_records(CONF.accounting.spool_dir)
+    if retention_enabled():
+        apply_retention(CONF.accounting.spool_dir)
+    elif CONF.accounting.fast_purge:
+        purge_records(CONF.accounting.spool_dir)
+    else:
+        remove_records(CONF.accounting.spool_dir)
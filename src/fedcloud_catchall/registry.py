@@ -0,0 +1,116 @@
+"""
+Indexed registry of the discovered sites
+
+Keeps the site information as returned by discovery, together with some
+indexes to quickly find the sites to work on
+"""
+
+import collections.abc
+
+from .vault import keystone_host
+
+APPCRED_AUTH = "v3applicationcredential"
+
+
+class SiteEntry:
+    __slots__ = (
+        "id",
+        "name",
+        "keystone_host",
+        "accounting",
+        "image_sync",
+        "appcred",
+        "site",
+    )
+
+    def __init__(self, site):
+        static = site.get("static", {})
+        self.id = site["id"]
+        self.name = site["name"]
+        self.keystone_host = keystone_host(site.get("url", ""))
+        self.accounting = static.get("accounting", {}).get("enabled", False)
+        self.image_sync = static.get("images", {}).get("sync", False)
+        self.appcred = static.get("auth", None) == APPCRED_AUTH
+        self.site = site
+
+
+class SiteRegistry(collections.abc.Mapping):
+    def __init__(self, sites=None):
+        self._entries = {}
+        self._by_name = {}
+        # indexes map to {site id: entry} to keep the order and allow removals
+        self._by_host = collections.defaultdict(dict)
+        self._by_vo = collections.defaultdict(dict)
+        self._accounting = {}
+        self._image_sync = {}
+        self._appcred = {}
+        for site in (sites or {}).values():
+            self.add(site)
+
+    def _flag_indexes(self, entry):
+        return [
+            index
+            for index, flag in (
+                (self._accounting, entry.accounting),
+                (self._image_sync, entry.image_sync),
+                (self._appcred, entry.appcred),
+            )
+            if flag
+        ]
+
+    def _indexes(self, entry):
+        return (
+            [self._by_host[entry.keystone_host]]
+            + [self._by_vo[vo_name] for vo_name in entry.site.get("shares", {})]
+            + self._flag_indexes(entry)
+        )
+
+    def _remove(self, entry):
+        del self._entries[entry.id]
+        if self._by_name.get(entry.name) is entry:
+            del self._by_name[entry.name]
+        for index in self._indexes(entry):
+            index.pop(entry.id, None)
+
+    def add(self, site):
+        entry = SiteEntry(site)
+        # a site added again replaces the previous one, also when only the
+        # name is the same
+        for old in {self._entries.get(entry.id), self._by_name.get(entry.name)}:
+            if old is not None:
+                self._remove(old)
+        self._entries[entry.id] = entry
+        self._by_name[entry.name] = entry
+        for index in self._indexes(entry):
+            index[entry.id] = entry
+
+    def __getitem__(self, site_id):
+        return self._entries[site_id].site
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entries(self):
+        return iter(self._entries.values())
+
+    def get_by_name(self, name):
+        entry = self._by_name.get(name, None)
+        return entry.site if entry else None
+
+    def get_by_host(self, host):
+        return [entry.site for entry in self._by_host.get(host, {}).values()]
+
+    def sites_with_vo(self, vo_name):
+        return (entry.site for entry in self._by_vo.get(vo_name, {}).values())
+
+    def accounting_sites(self):
+        return (entry.site for entry in self._accounting.values())
+
+    def image_sync_sites(self):
+        return (entry.site for entry in self._image_sync.values())
+
+    def appcred_sites(self):
+        return (entry.site for entry in self._appcred.values())
@@ -0,0 +1,376 @@
+"""
+Accounting spool
+
+Walks and purges the outgoing queues that cASO leaves in the spool directory,
+laid out as <site>/<run type>/outgoing, and enforces its retention limits with
+an index of the queued elements that is updated incrementally
+"""
+
+import contextlib
+import glob
+import logging
+import os
+import os.path
+import re
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from dirq.QueueSimple import QueueSimple
+
+from .config import CONF
+from .discovery import selected
+
+# intermediate directories of dirq, named after the time they were created
+ELEMENT_DIR = re.compile(r"^[0-9a-f]{8}$")
+# element files, without the lock or temporary suffixes
+ELEMENT = re.compile(r"^[0-9a-f]{14}$")
+# dirq ignores hidden directories
+TRASH_PREFIX = ".purge-"
+# files unlinked by each task of the pool
+PURGE_CHUNK = 1000
+
+INDEX_NAME = "spool.sqlite"
+# the index is rebuilt from the queues when its layout changes
+INDEX_VERSION = 1
+# directories changed this recently may change again within the same mtime
+# tick, they are scanned again on the next update
+RACY_NS = 2 * 10**9
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    queue TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (queue, dir)
+);
+CREATE TABLE IF NOT EXISTS elements (
+    site TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created REAL NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (queue, dir, name)
+);
+CREATE INDEX IF NOT EXISTS elements_created ON elements (created);
+"""
+
+
+def element_time(name):
+    # creation time of an element from its name, its mtime changes every time
+    # a sender locks it
+    return int(name[:8], 16) + int(name[8:13], 16) / 10**6
+
+
+def site_queues(spool_dir):
+    # (site name, path) of every outgoing queue in the spool
+    for queue in sorted(
+        glob.iglob(os.path.join("*", "*", "outgoing"), root_dir=spool_dir)
+    ):
+        yield queue.split(os.path.sep, 1)[0], os.path.join(spool_dir, queue)
+
+
+def selected_queues(spool_dir):
+    return [
+        (site, queue)
+        for site, queue in site_queues(spool_dir)
+        if selected(site, CONF.site)
+    ]
+
+
+def run_type(queue):
+    return os.path.basename(os.path.dirname(queue))
+
+
+def queue_elements(queue):
+    # (path, stat) of every element of a queue, locked or not
+    with os.scandir(queue) as entries:
+        dirs = [
+            entry.path
+            for entry in entries
+            if ELEMENT_DIR.match(entry.name) and entry.is_dir()
+        ]
+    for path in dirs:
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not ELEMENT.match(entry.name):
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat
+        except FileNotFoundError:
+            # purged while scanning
+            continue
+
+
+def queue_stats(queue):
+    # elements, bytes and oldest element of a queue, without reading any message
+    count = size = 0
+    oldest = None
+    for path, stat in queue_elements(queue):
+        count += 1
+        size += stat.st_size
+        created = element_time(os.path.basename(path))
+        if oldest is None or created < oldest:
+            oldest = created
+    return count, size, oldest
+
+
+def set_aside(queue):
+    # moves the element directories out of the way of dirq, renames are atomic
+    # so the queue never shows half deleted directories
+    trash = []
+    with os.scandir(queue) as entries:
+        names = [entry.name for entry in entries if entry.is_dir()]
+    for name in names:
+        path = os.path.join(queue, name)
+        if ELEMENT_DIR.match(name):
+            target = os.path.join(queue, f"{TRASH_PREFIX}{name}.{uuid.uuid4().hex}")
+            os.rename(path, target)
+            trash.append(target)
+        elif name.startswith(TRASH_PREFIX):
+            # left by an interrupted purge
+            trash.append(path)
+    return trash
+
+
+def _unlink(chunk):
+    count = size = 0
+    for path, element in chunk:
+        try:
+            file_size = os.lstat(path).st_size if element else 0
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        if element:
+            count += 1
+            size += file_size
+    return count, size
+
+
+def purge_queues(queues):
+    # removes every element of the (site name, path) queues, returns the
+    # elements and bytes freed for each site
+    queues = list(queues)
+    trash = [(site, path) for site, queue in queues for path in set_aside(queue)]
+    freed = {site: (0, 0) for site, _ in queues}
+    futures = []
+    with ThreadPoolExecutor(max_workers=CONF.accounting.purge_workers) as executor:
+        for site, path in trash:
+            logging.debug(f"Purging {path}")
+            chunk = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    chunk.append((entry.path, bool(ELEMENT.match(entry.name))))
+                    if len(chunk) >= PURGE_CHUNK:
+                        futures.append((site, executor.submit(_unlink, chunk)))
+                        chunk = []
+            if chunk:
+                futures.append((site, executor.submit(_unlink, chunk)))
+    for site, future in futures:
+        count, size = future.result()
+        freed[site] = (freed[site][0] + count, freed[site][1] + size)
+    for _, path in trash:
+        os.rmdir(path)
+    return freed
+
+
+class SpoolIndex:
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+                conn.executescript(
+                    "DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS elements; "
+                    f"PRAGMA user_version = {INDEX_VERSION};"
+                )
+            conn.executescript(INDEX_SCHEMA)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _scan_dir(conn, site, queue, name):
+        conn.execute("DELETE FROM elements WHERE queue = ? AND dir = ?", (queue, name))
+        rows = []
+        with os.scandir(os.path.join(queue, name)) as entries:
+            for entry in entries:
+                if not ELEMENT.match(entry.name):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                rows.append(
+                    (
+                        site,
+                        queue,
+                        name,
+                        entry.name,
+                        element_time(entry.name),
+                        stat.st_size,
+                    )
+                )
+        conn.executemany(
+            "INSERT INTO elements (site, queue, dir, name, created, size) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def update(self, queues):
+        # only the element directories changed since the last update are
+        # scanned again, dirq adds and removes always change their mtime
+        with self._connect() as conn:
+            for site, queue in queues:
+                known = dict(
+                    conn.execute(
+                        "SELECT dir, mtime_ns FROM dirs WHERE queue = ?", (queue,)
+                    )
+                )
+                with os.scandir(queue) as entries:
+                    dirs = {
+                        entry.name: entry.stat().st_mtime_ns
+                        for entry in entries
+                        if ELEMENT_DIR.match(entry.name) and entry.is_dir()
+                    }
+                now_ns = time.time_ns()
+                for name, mtime_ns in dirs.items():
+                    if known.get(name) == mtime_ns:
+                        continue
+                    self._scan_dir(conn, site, queue, name)
+                    if now_ns - mtime_ns < RACY_NS:
+                        mtime_ns = -1
+                    conn.execute(
+                        "INSERT OR REPLACE INTO dirs (queue, dir, mtime_ns) "
+                        "VALUES (?, ?, ?)",
+                        (queue, name, mtime_ns),
+                    )
+                gone = [(queue, name) for name in known if name not in dirs]
+                conn.executemany("DELETE FROM dirs WHERE queue = ? AND dir = ?", gone)
+                conn.executemany(
+                    "DELETE FROM elements WHERE queue = ? AND dir = ?", gone
+                )
+            # queues of sites that are gone
+            for (queue,) in conn.execute("SELECT DISTINCT queue FROM dirs").fetchall():
+                if not os.path.isdir(queue):
+                    conn.execute("DELETE FROM dirs WHERE queue = ?", (queue,))
+                    conn.execute("DELETE FROM elements WHERE queue = ?", (queue,))
+
+    def evictions(self, before=None, site_bytes=None, quota=None):
+        # elements older than before or over the byte limits, keeping the
+        # newest ones of every site and of the whole spool
+        conditions = []
+        params = []
+        if before is not None:
+            conditions.append("created < ?")
+            params.append(before)
+        if site_bytes is not None:
+            conditions.append("site_newer > ?")
+            params.append(site_bytes)
+        if quota is not None:
+            conditions.append("all_newer > ?")
+            params.append(quota)
+        if not conditions:
+            return []
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT site, queue, dir, name, size FROM ("
+                "SELECT *, "
+                "SUM(size) OVER (PARTITION BY site ORDER BY created DESC, "
+                "queue DESC, dir DESC, name DESC) AS site_newer, "
+                "SUM(size) OVER (ORDER BY created DESC, "
+                "queue DESC, dir DESC, name DESC) AS all_newer "
+                f"FROM elements) WHERE {' OR '.join(conditions)} "
+                "ORDER BY created, queue, dir, name",
+                params,
+            ).fetchall()
+
+    def forget(self, elements):
+        with self._connect() as conn:
+            conn.executemany(
+                "DELETE FROM elements WHERE queue = ? AND dir = ? AND name = ?",
+                [(queue, dir_name, name) for _, queue, dir_name, name, _ in elements],
+            )
+
+    def summary(self):
+        # elements, bytes and oldest element of every indexed queue
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT queue, COUNT(*), SUM(size), MIN(created) FROM elements "
+                "GROUP BY queue"
+            ).fetchall()
+        return {queue: (count, size, oldest) for queue, count, size, oldest in rows}
+
+
+def get_index():
+    return SpoolIndex(os.path.join(CONF.accounting.spool_dir, INDEX_NAME))
+
+
+def enforce_retention(queues):
+    # evicts the oldest elements over the retention limits, returns the
+    # elements and bytes freed for each site
+    queues = list(queues)
+    index = get_index()
+    index.update(queues)
+    before = None
+    if CONF.accounting.retention_max_age is not None:
+        before = time.time() - CONF.accounting.retention_max_age
+    paths = {queue for _, queue in queues}
+    # limits count every indexed site, evictions only the selected ones
+    evicted = [
+        element
+        for element in index.evictions(
+            before,
+            CONF.accounting.retention_site_bytes,
+            CONF.accounting.retention_quota,
+        )
+        if element[1] in paths
+    ]
+    freed = {site: (0, 0) for site, _ in queues}
+    opened = {}
+    for site, queue, dir_name, name, size in evicted:
+        if queue not in opened:
+            opened[queue] = QueueSimple(queue)
+        element = f"{dir_name}/{name}"
+        # elements locked by a sender are left to it
+        if not opened[queue].lock(element):
+            continue
+        opened[queue].remove(element)
+        count, total = freed[site]
+        freed[site] = (count + 1, total + size)
+    # locked elements are indexed again once unlocked, as that changes their
+    # directory
+    index.forget(evicted)
+    for dirq in opened.values():
+        dirq.purge()
+    return freed
+
+
+def spool_stats(queues, incremental=False):
+    # (site, run type, elements, bytes, oldest element) of every queue, from the
+    # index when incremental or scanning the queues in parallel otherwise
+    queues = list(queues)
+    if incremental:
+        index = get_index()
+        index.update(queues)
+        summary = index.summary()
+        stats = [summary.get(queue, (0, 0, None)) for _, queue in queues]
+    else:
+        with ThreadPoolExecutor(max_workers=CONF.accounting.scan_workers) as executor:
+            stats = list(executor.map(queue_stats, [queue for _, queue in queues]))
+    return [
+        (site, run_type(queue), *queue_stat)
+        for (site, queue), queue_stat in zip(queues, stats)
+    ]
@@ -0,0 +1,97 @@
+"""
+Accounting spool statistics
+
+Reports the records, bytes and oldest record queued for every site and run
+type in the accounting spool, as JSON or as a Prometheus textfile
+"""
+
+import json
+import logging
+import os
+import sys
+
+from oslo_config import cfg
+
+from .config import CONF
+from .spool import selected_queues, spool_stats
+
+METRIC_PREFIX = "egi_accounting_spool"
+
+metrics = [
+    ("records", "Records queued for sending"),
+    ("bytes", "Bytes of the records queued for sending"),
+    ("oldest_timestamp_seconds", "Creation time of the oldest queued record"),
+]
+
+
+def json_report(stats):
+    return json.dumps(
+        [
+            {
+                "site": site,
+                "run_type": run_type,
+                "records": count,
+                "bytes": size,
+                "oldest": oldest,
+            }
+            for site, run_type, count, size, oldest in stats
+        ],
+        indent=2,
+    )
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_report(stats):
+    lines = []
+    for i, (name, help_text) in enumerate(metrics):
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+        for site, run_type, *values in stats:
+            # empty queues have no oldest record
+            if values[i] is None:
+                continue
+            labels = f'site="{_label(site)}",run_type="{_label(run_type)}"'
+            lines.append(f"{METRIC_PREFIX}_{name}{{{labels}}} {values[i]}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(report, output=None):
+    if output is None:
+        sys.stdout.write(report)
+        return
+    # the textfile collector must never read a half written file
+    tmp_output = f"{output}.tmp"
+    with open(tmp_output, "w") as f:
+        f.write(report)
+    os.replace(tmp_output, output)
+
+
+def main():
+    CONF.register_cli_opts(
+        [
+            cfg.StrOpt("format", default="json", choices=["json", "prometheus"]),
+            cfg.StrOpt("output", help="Write the report to this file"),
+            cfg.BoolOpt(
+                "incremental",
+                default=False,
+                help="Use the spool index, only scanning changed directories",
+            ),
+        ]
+    )
+    CONF(sys.argv[1:])
+    logging.basicConfig(level=logging.DEBUG)
+    stats = spool_stats(
+        selected_queues(CONF.accounting.spool_dir), incremental=CONF.incremental
+    )
+    if CONF.format == "prometheus":
+        report = prometheus_report(stats)
+    else:
+        report = json_report(stats) + "\n"
+    write_report(report, CONF.output)
+
+
+if __name__ == "__main__":
+    main()
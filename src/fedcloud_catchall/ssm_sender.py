@@ -0,0 +1,185 @@
+"""
+In-process SSM sender
+
+Publishes the messages left by cASO in the outgoing queues of every site to
+the ARGO Messaging Service, as ssmsend does, but loading the host certificate
+once and reusing the connection and token of each AMS host for all the sites
+"""
+
+import base64
+import logging
+import os.path
+import ssl
+
+import certifi
+import dirq.QueueSimple
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.serialization import pkcs7
+
+from .accounting import caso_run_configs, ssm_destination
+from .config import CONF
+from .http_client import get_client, new_client
+
+AUTHN_PORT = 8443
+
+
+class AmsSender:
+    def __init__(self, cert_file, key_file):
+        with open(cert_file, "rb") as f:
+            self.cert = x509.load_pem_x509_certificate(f.read())
+        with open(key_file, "rb") as f:
+            self.key = serialization.load_pem_private_key(f.read(), None)
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self._tokens = {}
+        # authenticates with the host certificate, so not the shared client,
+        # but still one for all the hosts keeping their connections
+        self._authn_client = None
+
+    def sign(self, text):
+        # same S/MIME as "openssl smime -sign -text" used by ssm
+        return (
+            pkcs7.PKCS7SignatureBuilder()
+            .set_data(text)
+            .add_signer(self.cert, self.key, hashes.SHA256())
+            .sign(
+                serialization.Encoding.SMIME,
+                [pkcs7.PKCS7Options.Text, pkcs7.PKCS7Options.DetachedSignature],
+            )
+        )
+
+    def _authn(self):
+        if self._authn_client is None:
+            ssl_context = ssl.create_default_context(cafile=certifi.where())
+            ssl_context.load_cert_chain(self.cert_file, self.key_file)
+            self._authn_client = new_client("ams", verify=ssl_context)
+        return self._authn_client
+
+    def close(self):
+        if self._authn_client is not None:
+            self._authn_client.close()
+            self._authn_client = None
+
+    def token(self, host):
+        if host not in self._tokens:
+            r = self._authn().get(
+                f"https://{host}:{AUTHN_PORT}/v1/service-types/ams/hosts/"
+                f"{host}:authx509"
+            )
+            r.raise_for_status()
+            self._tokens[host] = r.json()["token"]
+        return self._tokens[host]
+
+    def publish(self, host, topic, messages):
+        client = get_client("ams")
+        r = client.post(
+            f"https://{host}/v1/projects/{CONF.accounting.ams_project}"
+            f"/topics/{topic}:publish",
+            headers={"x-api-key": self.token(host)},
+            json={"messages": messages},
+        )
+        r.raise_for_status()
+        return r.json()["messageIds"]
+
+    def _publish_batch(self, host, topic, batch, results):
+        messages = [
+            {
+                "attributes": {"empaid": name},
+                "data": base64.b64encode(self.sign(text)).decode(),
+            }
+            for _, _, name, text in batch
+        ]
+        try:
+            self.publish(host, topic, messages)
+        except (httpx.HTTPError, KeyError, OSError, ValueError) as e:
+            # OSError also covers the TLS errors getting the AMS token
+            logging.error(f"Unable to publish to {topic} at {host}: {e}")
+            for site_name, queue, name, _ in batch:
+                queue.unlock(name)
+                results[site_name] = False
+            return False
+        for _, queue, name, _ in batch:
+            queue.remove(name)
+        logging.debug(f"Published {len(batch)} messages to {topic} at {host}")
+        return True
+
+    def send(self, host, topic, queues, results):
+        # queues are (site name, path) of the same AMS host and destination,
+        # batches mix the messages of all of them
+        batch = []
+        opened = []
+        for site_name, path in queues:
+            results.setdefault(site_name, True)
+            if not os.path.isdir(path):
+                continue
+            try:
+                queue = dirq.QueueSimple.QueueSimple(path)
+                opened.append(queue)
+                for name in queue:
+                    if not queue.lock(name):
+                        continue
+                    try:
+                        data = queue.get(name)
+                    except OSError:
+                        queue.unlock(name)
+                        raise
+                    batch.append((site_name, queue, name, data))
+                    if len(batch) >= CONF.accounting.ams_batch_size:
+                        if not self._publish_batch(host, topic, batch, results):
+                            # do not insist on a failing destination
+                            for other_site, _ in queues:
+                                results.setdefault(other_site, False)
+                            return
+                        batch = []
+            except OSError as e:
+                # the rest of the sites are still sent
+                logging.error(f"Unable to read the outgoing queue {path}: {e}")
+                results[site_name] = False
+        if batch:
+            self._publish_batch(host, topic, batch, results)
+        for queue in opened:
+            try:
+                queue.purge()
+            except OSError as e:
+                logging.warning(f"Unable to purge the outgoing queue {queue.path}: {e}")
+
+
+def outgoing_queues(sites):
+    # outgoing queues of the sites grouped by AMS host and destination
+    groups = {}
+    for site in sites:
+        site_dir = os.path.join(CONF.accounting.spool_dir, site["name"])
+        for run_type, run_config in caso_run_configs.items():
+            if run_type not in CONF.accounting.caso_runs:
+                continue
+            key = ssm_destination(site, run_config["destination"])
+            groups.setdefault(key, []).append(
+                (site["name"], os.path.join(site_dir, run_type, "outgoing"))
+            )
+    return groups
+
+
+def send(sites):
+    # returns whether all the messages of each site were published
+    groups = outgoing_queues(sites)
+    try:
+        sender = AmsSender(CONF.accounting.host_cert, CONF.accounting.host_key)
+    except (OSError, ValueError, TypeError) as e:
+        logging.error(f"Unable to load the host certificate and key: {e}")
+        return {
+            site_name: False for queues in groups.values() for site_name, _ in queues
+        }
+    results = {}
+    try:
+        for (host, destination), queues in groups.items():
+            try:
+                sender.send(host, destination, queues, results)
+            except Exception as e:
+                logging.exception(f"Unable to send to {destination} at {host}: {e}")
+                for site_name, _ in queues:
+                    results[site_name] = False
+    finally:
+        sender.close()
+    return results
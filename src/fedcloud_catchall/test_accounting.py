@@ -3,12 +3,18 @@
 import copy
 import datetime
 import json
-from unittest.mock import mock_open, patch
+import subprocess
+import time
+from unittest.mock import ANY, mock_open, patch
 
+import fixtures
 import testtools
-from oslo_config import fixture
+from dateutil import tz
+from oslo_config import cfg, fixture
 
 from . import accounting as acc
+from . import checkpoints
+from .registry import SiteRegistry
 
 sample_config = """
 [DEFAULT]
@@ -19,6 +25,7 @@ projects = 90c0ce1b2f1545c0b9a05d9a8fd45102
 messengers = ssm
 vo_property = egi.eu:VO
 spooldir = /var
+lock_path = /var/lock.90c0ce1b2f1545c0b9a05d9a8fd45102
 
 [keystone_auth]
 auth_type = v3oidcclientcredentials
@@ -54,6 +61,10 @@ class TestAccounting(testtools.TestCase):
     def setUp(self):
         super().setUp()
         self.conf = self.useFixture(fixture.Config()).conf
+        self.m_store = self.useFixture(
+            fixtures.MockPatch(f"{checkpoints.__name__}.get_store")
+        ).mock
+        self.m_store.return_value.oldest.return_value = {}
 
     def test_vo_map(self):
         m = json.loads(acc.vo_map(sample_site))
@@ -85,13 +96,17 @@ class TestAccounting(testtools.TestCase):
         assert "site_name = FAKE" in (s.strip() for s in cfg.split("\n"))
 
     @patch("tempfile.TemporaryDirectory")
-    @patch("subprocess.call")
-    @patch("os.path.exists")
+    @patch("subprocess.run")
     @patch("fedcloud_catchall.accounting.caso_config")
-    def test_site_caso_with_lastrun(self, m_caso_config, m_exists, m_subp, m_temp):
+    @patch(f"{acc.__name__}.datetime", wraps=datetime)
+    def test_site_caso_with_checkpoint(self, m_date, m_caso_config, m_subp, m_temp):
         m_temp.return_value.__enter__.return_value = "/bar"
-        m_exists.return_value = True
-        m_subp.return_value = 0
+        now = datetime.datetime(2026, 1, 1, tzinfo=tz.tzutc())
+        m_date.datetime.now.return_value = now
+        self.m_store.return_value.get.return_value = datetime.datetime(
+            2025, 12, 30, tzinfo=tz.tzutc()
+        )
+        m_subp.return_value.returncode = 0
         with patch("builtins.open", mock_open()) as m_open:
             acc.site_caso(sample_site, "dir")
             m_open.assert_any_call("/bar/mapping.json", "w+")
@@ -102,30 +117,60 @@ class TestAccounting(testtools.TestCase):
             "/bar",
             "--mapping_file",
             "/bar/mapping.json",
+            "--extract-from",
+            "2025-12-30T00:00:00+00:00",
+            "--extract-to",
+            "2026-01-01T00:00:00+00:00",
         ]
         m_caso_config.assert_any_call(
-            sample_site, sample_site["projects"][0], "dir/block", extractor="cinder"
+            sample_site,
+            sample_site["projects"][0],
+            "dir/block",
+            extractor="cinder",
+            lock_path="/bar",
         )
         m_caso_config.assert_any_call(
-            sample_site, sample_site["projects"][0], "dir/compute", extractor="nova"
+            sample_site,
+            sample_site["projects"][0],
+            "dir/compute",
+            extractor="nova",
+            lock_path="/bar",
+        )
+        m_subp.assert_called_with(
+            caso_cmd_call,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=ANY,
+        )
+        self.m_store.return_value.get.assert_any_call(
+            "CENI", "90c0ce1b2f1545c0b9a05d9a8fd45102", "cinder"
+        )
+        self.m_store.return_value.complete_window.assert_any_call(
+            "CENI",
+            "b106744c783543518f505dda45632697",
+            "nova",
+            datetime.datetime(2025, 12, 30, tzinfo=tz.tzutc()),
+            now,
         )
-        m_subp.assert_called_with(caso_cmd_call)
+        assert self.m_store.return_value.complete_window.call_count == 4
 
     @patch("tempfile.TemporaryDirectory")
-    @patch("subprocess.call")
-    @patch("os.path.exists")
+    @patch("subprocess.run")
+    @patch("fedcloud_catchall.checkpoints.read_lastrun")
     @patch("fedcloud_catchall.accounting.caso_config")
     @patch(f"{acc.__name__}.datetime", wraps=datetime)
-    def test_site_caso_no_lastrun(
-        self, m_date, m_caso_config, m_exists, m_subp, m_temp
+    def test_site_caso_no_checkpoint(
+        self, m_date, m_caso_config, m_lastrun, m_subp, m_temp
     ):
         m_temp.return_value.__enter__.return_value = "/bar"
-        m_exists.return_value = False
         m_date.datetime.now.return_value = datetime.datetime(2026, 1, 1)
-        with patch("builtins.open", mock_open()) as m_open:
-            acc.site_caso(sample_site, "dir")
-            m_open.assert_any_call("/bar/mapping.json", "w+")
-            m_open.assert_any_call("/bar/caso.conf", "w+")
+        self.m_store.return_value.get.return_value = None
+        m_lastrun.return_value = None
+        m_subp.return_value.returncode = 1
+        with patch("builtins.open", mock_open()):
+            return_codes = acc.site_caso(sample_site, "dir")
+        assert set(return_codes.values()) == {1}
         caso_cmd_call = [
             "caso-extract",
             "--config-dir",
@@ -134,18 +179,45 @@ class TestAccounting(testtools.TestCase):
             "/bar/mapping.json",
             "--extract-from",
             "2025-12-31T00:00:00",
+            "--extract-to",
+            "2026-01-01T00:00:00",
         ]
-        m_caso_config.assert_any_call(
-            sample_site, sample_site["projects"][0], "dir/block", extractor="cinder"
+        m_lastrun.assert_any_call(
+            "dir/compute/lastrun.90c0ce1b2f1545c0b9a05d9a8fd45102"
         )
-        m_caso_config.assert_any_call(
-            sample_site, sample_site["projects"][0], "dir/compute", extractor="nova"
+        m_subp.assert_called_with(
+            caso_cmd_call,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=ANY,
         )
-        m_subp.return_value = 0
-        m_subp.assert_called_with(caso_cmd_call)
+        # failed extractions keep the checkpoint
+        self.m_store.return_value.complete_window.assert_not_called()
 
     @patch("tempfile.TemporaryDirectory")
-    @patch("subprocess.call")
+    @patch("subprocess.run")
+    @patch("fedcloud_catchall.accounting.caso_config")
+    def test_site_caso_extractor_error(self, m_caso_config, m_subp, m_temp):
+        m_temp.return_value.__enter__.return_value = "/bar"
+        self.m_store.return_value.get.return_value = datetime.datetime(
+            2025, 12, 30, tzinfo=tz.tzutc()
+        )
+        # caso exits fine even if the extractor failed
+        m_subp.return_value.returncode = 0
+        m_subp.return_value.stdout = (
+            "ERROR caso.extract.manager Extractor nova: cannot extract records "
+            "for 'ops', got the following exception:\n"
+            "keystoneauth1.exceptions.http.Unauthorized\n"
+        )
+        with patch("builtins.open", mock_open()):
+            with self.assertLogs(level="ERROR"):
+                return_codes = acc.site_caso(sample_site, "dir")
+        assert set(return_codes.values()) == {1}
+        self.m_store.return_value.complete_window.assert_not_called()
+
+    @patch("tempfile.TemporaryDirectory")
+    @patch("subprocess.run")
     @patch("fedcloud_catchall.accounting.ssm_config")
     def test_site_ssm(self, m_config, m_subp, m_temp):
         m_temp.return_value.__enter__.return_value = "/bar"
@@ -154,17 +226,41 @@ class TestAccounting(testtools.TestCase):
             m_open.assert_any_call("/bar/ssm.conf", "w+")
         m_config.assert_any_call(sample_site, "dir/compute", "eu-egi-cloud-accounting")
         m_config.assert_any_call(sample_site, "dir/block", "eu-egi-storage-accounting")
-        m_subp.assert_called_with(["ssmsend", "-c", "/bar/ssm.conf"])
+        m_subp.assert_called_with(
+            ["ssmsend", "-c", "/bar/ssm.conf"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=ANY,
+        )
 
     @patch("fedcloud_catchall.accounting.site_caso")
     @patch("fedcloud_catchall.accounting.site_ssm")
     @patch("os.makedirs")
     def test_run_caso(self, m_mkdirs, m_ssm, m_caso):
         self.conf.set_override("spool_dir", "/foo", group="accounting")
-        acc.run({1: sample_site})
+        acc.run(SiteRegistry({1: sample_site}))
         m_mkdirs.assert_called_with("/foo/CENI", exist_ok=True)
-        m_ssm.assert_called_with(sample_site, "/foo/CENI")
-        m_caso.assert_called_with(sample_site, "/foo/CENI")
+        m_ssm.assert_called_with(sample_site, "/foo/CENI", ANY, ANY)
+        m_caso.assert_called_with(sample_site, "/foo/CENI", ANY, None, ANY)
+
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_site_send_budget(self, m_mkdirs, m_ssm, m_caso):
+        self.conf.set_override("site_timeout", 60, group="accounting")
+        self.conf.set_override("send_timeout", 600, group="accounting")
+
+        def caso(site, site_dir, log, window, deadline):
+            # the extraction used the whole site budget
+            assert deadline - time.monotonic() <= 60
+            return {("p", "compute"): 0}
+
+        m_caso.side_effect = caso
+        m_ssm.return_value = True
+        assert acc.run_site(sample_site)
+        send_deadline = m_ssm.call_args.args[3]
+        assert 590 < send_deadline - time.monotonic() <= 600
 
     @patch("fedcloud_catchall.accounting.site_caso")
     @patch("fedcloud_catchall.accounting.site_ssm")
@@ -173,7 +269,7 @@ class TestAccounting(testtools.TestCase):
         self.conf.set_override("spool_dir", "/foo", group="accounting")
         disabled_site = copy.deepcopy(sample_site)
         disabled_site["static"]["accounting"]["enabled"] = False
-        acc.run({1: disabled_site})
+        acc.run(SiteRegistry({1: disabled_site}))
         m_mkdirs.assert_not_called()
         m_ssm.assert_not_called()
         m_caso.assert_not_called()
@@ -186,10 +282,254 @@ class TestAccounting(testtools.TestCase):
         self.conf.set_override("force_run", True, group="accounting")
         disabled_site = copy.deepcopy(sample_site)
         disabled_site["static"]["accounting"]["enabled"] = False
-        acc.run({1: disabled_site})
+        acc.run(SiteRegistry({1: disabled_site}))
         m_mkdirs.assert_called_with("/foo/CENI", exist_ok=True)
-        m_ssm.assert_called_with(disabled_site, "/foo/CENI")
-        m_caso.assert_called_with(disabled_site, "/foo/CENI")
+        m_ssm.assert_called_with(disabled_site, "/foo/CENI", ANY, ANY)
+        m_caso.assert_called_with(disabled_site, "/foo/CENI", ANY, None, ANY)
+
+    @patch("fedcloud_catchall.checkpoints.pending_windows")
+    @patch("fedcloud_catchall.accounting.project_caso")
+    def test_site_caso_return_codes(self, m_project_caso, m_windows):
+        m_windows.return_value = [("from", "to")]
+        self.conf.set_override("extract_workers", 4, group="accounting")
+        m_project_caso.side_effect = lambda site, project, run_type, *args: (
+            1 if run_type == "block" else 0
+        )
+        return_codes = acc.site_caso(sample_site, "dir")
+        assert return_codes == {
+            ("90c0ce1b2f1545c0b9a05d9a8fd45102", "block"): 1,
+            ("90c0ce1b2f1545c0b9a05d9a8fd45102", "compute"): 0,
+            ("b106744c783543518f505dda45632697", "block"): 1,
+            ("b106744c783543518f505dda45632697", "compute"): 0,
+        }
+
+    @patch("fedcloud_catchall.checkpoints.pending_windows")
+    @patch("fedcloud_catchall.accounting.project_caso")
+    def test_site_caso_backfill(self, m_project_caso, m_windows):
+        self.conf.set_override("caso_runs", ["compute"], group="accounting")
+        self.conf.set_override("backfill_workers", 3, group="accounting")
+        m_windows.return_value = [(1, 2), (2, 3), (3, 4)]
+        m_project_caso.side_effect = lambda site, project, rt, rc, sd, window, *args: (
+            1 if window == (2, 3) and project["name"] == "ops" else 0
+        )
+        return_codes = acc.site_caso(sample_site, "dir", window=3600)
+        assert return_codes == {
+            ("90c0ce1b2f1545c0b9a05d9a8fd45102", "compute"): 1,
+            ("b106744c783543518f505dda45632697", "compute"): 0,
+        }
+        assert m_project_caso.call_count == 6
+        assert m_windows.call_args.args[7] == 3600
+
+    @patch("subprocess.run")
+    def test_call_relays_output(self, m_subp):
+        m_subp.return_value.stdout = "line 1\nline 2\n"
+        m_subp.return_value.returncode = 3
+        log = acc.site_logger(sample_site)
+        with self.assertLogs(log, level="INFO") as logs:
+            assert acc.call(["foo"], log) == 3
+        assert logs.records[0].name == "fedcloud_catchall.accounting.CENI"
+        assert [r.getMessage() for r in logs.records] == ["line 1", "line 2"]
+
+    @patch("subprocess.run")
+    def test_call_error_marker(self, m_subp):
+        m_subp.return_value.stdout = "line 1\nsome error here\n"
+        m_subp.return_value.returncode = 0
+        log = acc.site_logger(sample_site)
+        assert acc.call(["foo"], log) == 0
+        with self.assertLogs(log, level="ERROR"):
+            assert acc.call(["foo"], log, error_marker="some error") == 1
+        m_subp.return_value.returncode = 3
+        assert acc.call(["foo"], log, error_marker="some error") == 3
+
+    @patch("subprocess.run")
+    def test_call_timeout(self, m_subp):
+        m_subp.side_effect = subprocess.TimeoutExpired(["foo"], 5, output=b"line 1\n")
+        log = acc.site_logger(sample_site)
+        with self.assertLogs(log, level="INFO") as logs:
+            assert acc.call(["foo"], log) == acc.TIMEOUT_RETURN_CODE
+        assert [r.getMessage() for r in logs.records] == [
+            "Killed foo after 1800 seconds",
+            "line 1",
+        ]
+
+    @patch("subprocess.run")
+    def test_call_deadline(self, m_subp):
+        m_subp.return_value.returncode = 0
+        log = acc.site_logger(sample_site)
+        assert acc.call(["foo"], log, time.monotonic() + 10) == 0
+        assert m_subp.call_args.kwargs["timeout"] <= 10
+        with self.assertLogs(log, level="WARNING"):
+            assert (
+                acc.call(["foo"], log, time.monotonic() - 1) == acc.TIMEOUT_RETURN_CODE
+            )
+        assert m_subp.call_count == 1
+
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_by_staleness(self, m_mkdirs, m_ssm, m_caso):
+        sites = {}
+        for i, name in enumerate(["FRESH", "NEW", "OLD", "UNKNOWN"]):
+            sites[i] = copy.deepcopy(sample_site)
+            sites[i]["id"] = name
+            sites[i]["name"] = name
+        now = datetime.datetime.now(tz.tzutc())
+        self.m_store.return_value.oldest.return_value = {
+            "FRESH": now,
+            "NEW": None,
+            "OLD": now - datetime.timedelta(days=3),
+        }
+        acc.run(SiteRegistry(sites))
+        assert [c.args[0]["name"] for c in m_caso.call_args_list] == [
+            "NEW",
+            "UNKNOWN",
+            "OLD",
+            "FRESH",
+        ]
+
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("os.makedirs")
+    def test_run_site_deferred(self, m_mkdirs, m_caso):
+        with self.assertLogs(level="WARNING"):
+            assert acc.run_site(sample_site, run_deadline=time.monotonic()) is None
+        m_caso.assert_not_called()
+
+    @patch("fedcloud_catchall.accounting.run_site")
+    def test_run_deferred(self, m_run_site):
+        other_site = copy.deepcopy(sample_site)
+        other_site["id"] = "OTHER"
+        other_site["name"] = "OTHER"
+        m_run_site.side_effect = lambda site, **kwargs: (
+            None if site["name"] == "OTHER" else True
+        )
+        with self.assertLogs(level="WARNING"):
+            results = acc.run(SiteRegistry({1: sample_site, 2: other_site}))
+        assert results == {"CENI": True}
+
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_parallel(self, m_mkdirs, m_ssm, m_caso):
+        self.conf.set_override("spool_dir", "/foo", group="accounting")
+        self.conf.set_override("site_workers", 4, group="accounting")
+        other_site = copy.deepcopy(sample_site)
+        other_site["id"] = "OTHER"
+        other_site["name"] = "OTHER"
+        broken_site = copy.deepcopy(sample_site)
+        broken_site["id"] = "BROKEN"
+        broken_site["name"] = "BROKEN"
+        failed_site = copy.deepcopy(sample_site)
+        failed_site["id"] = "FAILED"
+        failed_site["name"] = "FAILED"
+
+        def caso(site, site_dir, log, window, deadline):
+            if site["name"] == "BROKEN":
+                raise ValueError("boom")
+            return {("p", "compute"): 1 if site["name"] == "FAILED" else 0}
+
+        m_caso.side_effect = caso
+        m_ssm.return_value = True
+        results = acc.run(
+            SiteRegistry(
+                {1: sample_site, 2: other_site, 3: broken_site, 4: failed_site}
+            )
+        )
+        assert results == {
+            "CENI": True,
+            "OTHER": True,
+            "BROKEN": False,
+            "FAILED": False,
+        }
+        assert m_ssm.call_count == 3
+
+    @patch("fedcloud_catchall.caso_engine.site_extract")
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_inprocess(self, m_mkdirs, m_ssm, m_caso, m_extract):
+        self.conf.set_override("spool_dir", "/foo", group="accounting")
+        self.conf.set_override("engine", "inprocess", group="accounting")
+        m_extract.return_value = {("p", "compute"): 0}
+        acc.run(SiteRegistry({1: sample_site}))
+        m_caso.assert_not_called()
+        m_extract.assert_called_with(sample_site, "/foo/CENI", ANY, None, ANY)
+        m_ssm.assert_called_with(sample_site, "/foo/CENI", ANY, ANY)
+
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_registers_checkpoints(self, m_mkdirs, m_ssm, m_caso):
+        self.conf.set_override("caso_runs", ["compute"], group="accounting")
+        acc.run(SiteRegistry({1: sample_site}))
+        self.m_store.return_value.register.assert_called_once_with(
+            "CENI",
+            [
+                ("90c0ce1b2f1545c0b9a05d9a8fd45102", "nova"),
+                ("b106744c783543518f505dda45632697", "nova"),
+            ],
+        )
+
+    def test_command_default(self):
+        conf = cfg.ConfigOpts()
+        conf.register_cli_opt(
+            cfg.SubCommandOpt("command", handler=acc.add_command_parsers)
+        )
+        conf([], default_config_files=[])
+        assert conf.command.name is None
+        conf(["report", "--format", "parquet"], default_config_files=[])
+        assert conf.command.name == "report"
+        assert conf.command.format == "parquet"
+
+    @patch("builtins.print")
+    def test_status(self, m_print):
+        last = datetime.datetime(2026, 1, 1, tzinfo=tz.tzutc())
+        self.m_store.return_value.stale.return_value = [
+            ("CENI", "p1", "nova", None),
+            ("CENI", "p2", "cinder", last),
+        ]
+        assert len(acc.status()) == 2
+        m_print.assert_any_call("CENI\tp1\tnova\tnever")
+        m_print.assert_any_call("CENI\tp2\tcinder\t2026-01-01T00:00:00+00:00")
+
+    @patch("fedcloud_catchall.ssm_sender.send")
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_inprocess_sender(self, m_mkdirs, m_ssm, m_caso, m_send):
+        self.conf.set_override("sender", "inprocess", group="accounting")
+        m_caso.return_value = {("p", "compute"): 0}
+        m_send.return_value = {"CENI": False}
+        results = acc.run(SiteRegistry({1: sample_site}))
+        m_ssm.assert_not_called()
+        m_send.assert_called_once_with([sample_site])
+        assert results == {"CENI": False}
+
+    @patch("fedcloud_catchall.ssm_sender.send")
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_inprocess_sender_error(self, m_mkdirs, m_ssm, m_caso, m_send):
+        self.conf.set_override("sender", "inprocess", group="accounting")
+        m_caso.return_value = {("p", "compute"): 0}
+        m_send.side_effect = OSError("boom")
+        with self.assertLogs(level="WARNING") as logs:
+            results = acc.run(SiteRegistry({1: sample_site}))
+        assert results == {"CENI": False}
+        assert "Accounting failed for sites: CENI" in logs.output[-1]
+
+    @patch("fedcloud_catchall.compaction.compact_site")
+    @patch("fedcloud_catchall.accounting.site_caso")
+    @patch("fedcloud_catchall.accounting.site_ssm")
+    @patch("os.makedirs")
+    def test_run_compact(self, m_mkdirs, m_ssm, m_caso, m_compact):
+        self.conf.set_override("spool_dir", "/foo", group="accounting")
+        m_caso.return_value = {("p", "compute"): 0}
+        acc.run(SiteRegistry({1: sample_site}))
+        m_compact.assert_not_called()
+        self.conf.set_override("compact", True, group="accounting")
+        acc.run(SiteRegistry({1: sample_site}))
+        m_compact.assert_called_once_with("/foo/CENI", ANY)
+        m_ssm.assert_called_with(sample_site, "/foo/CENI", ANY, ANY)
 
     @patch("fedcloud_catchall.accounting.ssm_config_template")
     def test_ssm_config(self, m_tpl):
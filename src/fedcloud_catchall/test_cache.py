@@ -0,0 +1,53 @@
+"""Tests for the local cache"""
+
+import os.path
+import time
+import unittest
+
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import cache
+
+
+class TestCache(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_disabled(self):
+        cache.store("foo.json", {"a": 1})
+        assert cache.load("foo.json") is None
+        assert os.listdir(self.cache_dir) == []
+
+    def test_store_and_load(self):
+        self.conf.set_override("cache_dir", self.cache_dir, group="cache")
+        cache.store("foo.json", {"a": 1})
+        entry = cache.load("foo.json")
+        assert entry["a"] == 1
+        assert cache.is_fresh(entry, 60)
+        assert os.listdir(self.cache_dir) == ["foo.json"]
+
+    def test_load_corrupted(self):
+        self.conf.set_override("cache_dir", self.cache_dir, group="cache")
+        with open(os.path.join(self.cache_dir, "foo.json"), "w") as f:
+            f.write("{not json")
+        assert cache.load("foo.json") is None
+
+    def test_is_fresh(self):
+        assert not cache.is_fresh(None, 60)
+        assert not cache.is_fresh({"timestamp": time.time() - 120}, 60)
+        assert cache.is_fresh({"timestamp": time.time() - 30}, 60)
+
+    def test_write_atomic_bytes(self):
+        path = os.path.join(self.cache_dir, "sub", "file")
+        cache.write_atomic(path, b"1234")
+        with open(path, "rb") as f:
+            assert f.read() == b"1234"
+        assert os.listdir(os.path.dirname(path)) == ["file"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,300 @@
+"""Tests for the in-process cASO extraction"""
+
+import copy
+import datetime
+import os.path
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, call, patch
+
+import fixtures
+import testtools
+from dateutil import tz
+from oslo_config import fixture
+
+from . import caso_engine as engine
+from . import checkpoints
+
+sample_site = {
+    "id": "15810G0",
+    "name": "CENI",
+    "url": "https://openstack.ceni.org.cn:5000/v3",
+    "hostname": "openstack.ceni.org.cn",
+    "projects": [
+        {"id": "90c0ce1b2f1545c0b9a05d9a8fd45102", "name": "ops"},
+        {"id": "b106744c783543518f505dda45632697", "name": "vo.access.egi.eu"},
+    ],
+    "static": {"accounting": {"enabled": True, "site_name": "CENI-SITE"}},
+}
+
+
+class TestSiteSessions(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.m_session = self.useFixture(
+            fixtures.MockPatch(f"{engine.__name__}.session.Session")
+        ).mock
+
+    @patch("keystoneauth1.identity.v3.Token")
+    @patch("keystoneauth1.identity.v3.OidcClientCredentials")
+    def test_oidc_login_once(self, m_oidc, m_token):
+        self.conf.set_override("client_id", "id", group="checkin")
+        self.m_session.return_value.get_token.return_value = "unscoped"
+        sessions = engine.SiteSessions(sample_site)
+        first = sessions.get("p1")
+        sessions.get("p2")
+        sessions.get(None, system_scope="all")
+        assert sessions.get("p1") is first
+        m_oidc.assert_called_once()
+        assert m_oidc.call_args.kwargs["client_id"] == "id"
+        assert "project_id" not in m_oidc.call_args.kwargs
+        m_token.assert_has_calls(
+            [
+                call(
+                    auth_url=sample_site["url"],
+                    token="unscoped",
+                    project_id="p1",
+                    system_scope=None,
+                ),
+                call(
+                    auth_url=sample_site["url"],
+                    token="unscoped",
+                    project_id="p2",
+                    system_scope=None,
+                ),
+                call(
+                    auth_url=sample_site["url"],
+                    token="unscoped",
+                    project_id=None,
+                    system_scope="all",
+                ),
+            ]
+        )
+        # one unscoped and three scoped sessions, all on the same pool
+        assert self.m_session.call_count == 4
+        pools = {c.kwargs["session"] for c in self.m_session.call_args_list}
+        assert pools == {sessions._http}
+
+    @patch("keystoneauth1.identity.v3.Token")
+    @patch("keystoneauth1.identity.v3.OidcClientCredentials")
+    def test_session_timeout(self, m_oidc, m_token):
+        self.conf.set_override("command_timeout", 600, group="accounting")
+        engine.SiteSessions(sample_site).get("p1")
+        assert self.m_session.call_args.kwargs["timeout"] == 600
+        # bounded by what is left of the site budget
+        sessions = engine.SiteSessions(sample_site, time.monotonic() + 60)
+        sessions.get("p1")
+        assert 55 < self.m_session.call_args.kwargs["timeout"] <= 60
+        sessions = engine.SiteSessions(sample_site, time.monotonic() - 60)
+        sessions.get("p1")
+        assert self.m_session.call_args.kwargs["timeout"] == 1
+
+    @patch("keystoneauth1.identity.v3.Token")
+    @patch("keystoneauth1.identity.v3.OidcClientCredentials")
+    def test_oidc_system_scope(self, m_oidc, m_token):
+        sessions = engine.SiteSessions(sample_site)
+        system = sessions.get("p1", system_scope="all")
+        assert sessions.get("p2", system_scope="all") is system
+        assert m_token.call_args.kwargs["project_id"] is None
+        assert m_token.call_args.kwargs["system_scope"] == "all"
+
+    @patch("keystoneauth1.identity.v3.Token")
+    @patch("keystoneauth1.identity.v3.OidcClientCredentials")
+    def test_oidc_system_scope_not_allowed(self, m_oidc, m_token):
+        system = MagicMock()
+        system.get_token.side_effect = engine.ks_exceptions.Unauthorized()
+        project = MagicMock()
+        self.m_session.side_effect = [MagicMock(), system, project]
+        sessions = engine.SiteSessions(sample_site)
+        assert sessions.get("p1", system_scope="all") is project
+        assert sessions.get("p1", system_scope="all") is project
+        system.get_token.assert_called_once()
+        assert m_token.call_args.kwargs["project_id"] == "p1"
+
+    @patch(f"{engine.__name__}.get_access_token")
+    @patch(f"{engine.__name__}.get_vo_secrets")
+    @patch("keystoneauth1.loading.get_plugin_loader")
+    def test_appcred_login_per_project(self, m_loader, m_secrets, m_token):
+        site = copy.deepcopy(sample_site)
+        site["static"]["auth"] = "v3applicationcredential"
+        site["projects"][0]["auth"] = {"application_credential_name": "foo"}
+        m_token.return_value = "token"
+        m_secrets.return_value = {"application_credential_secret": "secret"}
+        sessions = engine.SiteSessions(site)
+        first = sessions.get("90c0ce1b2f1545c0b9a05d9a8fd45102")
+        # no system scope for application credentials
+        assert (
+            sessions.get("90c0ce1b2f1545c0b9a05d9a8fd45102", system_scope="all")
+            is first
+        )
+        m_loader.assert_called_once_with("v3applicationcredential")
+        m_secrets.assert_called_once_with(site["url"], "ops", "token")
+        m_loader.return_value.load_from_options.assert_called_once_with(
+            auth_url=site["url"],
+            application_credential_secret="secret",
+            application_credential_name="foo",
+        )
+
+
+class TestSiteExtraction(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.site_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("spool_dir", self.site_dir, group="accounting")
+        self.store = checkpoints.get_store()
+        self.useFixture(fixtures.MockPatch(f"{engine.__name__}.SiteSessions"))
+        self.m_messenger = self.useFixture(
+            fixtures.MockPatch(f"{engine.__name__}.SSMMessenger")
+        ).mock
+        self.m_nova = MagicMock()
+        self.m_cinder = MagicMock()
+        self.useFixture(
+            fixtures.MockPatch(
+                f"{engine.__name__}.extractors",
+                {"nova": self.m_nova, "cinder": self.m_cinder},
+            )
+        )
+        self.useFixture(
+            fixtures.MockPatch(
+                f"{engine.__name__}.site_extractor", lambda cls, sessions: cls
+            )
+        )
+
+    def test_site_extract(self):
+        self.conf.set_override("extract_workers", 4, group="accounting")
+        messengers = {}
+
+        def new_messenger():
+            messengers[self.conf.ssm.output_path] = MagicMock()
+            return messengers[self.conf.ssm.output_path]
+
+        def extract(extract_from, extract_to):
+            # cASO needs valid names in the configuration to build the records
+            assert self.conf.site_name is not None
+            assert self.conf.service_name is not None
+            return [record]
+
+        record = MagicMock()
+        self.m_messenger.side_effect = new_messenger
+        self.m_nova.return_value.extract.side_effect = extract
+        self.m_cinder.return_value.extract.return_value = [record]
+        return_codes = engine.site_extract(sample_site, self.site_dir)
+        assert return_codes == {
+            ("90c0ce1b2f1545c0b9a05d9a8fd45102", "block"): 0,
+            ("90c0ce1b2f1545c0b9a05d9a8fd45102", "compute"): 0,
+            ("b106744c783543518f505dda45632697", "block"): 0,
+            ("b106744c783543518f505dda45632697", "compute"): 0,
+        }
+        self.m_nova.assert_any_call("90c0ce1b2f1545c0b9a05d9a8fd45102", "ops")
+        self.m_nova.assert_any_call(
+            "b106744c783543518f505dda45632697", "vo.access.egi.eu"
+        )
+        compute = messengers[os.path.join(self.site_dir, "compute", "outgoing")]
+        block = messengers[os.path.join(self.site_dir, "block", "outgoing")]
+        compute.push.assert_called_with([record])
+        assert compute.push.call_count == 2
+        block.push.assert_called_with([record])
+        assert record.site_name == "CENI-SITE"
+        assert record.compute_service == "openstack.ceni.org.cn"
+        for extractor in ("cinder", "nova"):
+            for project in sample_site["projects"]:
+                assert self.store.get("CENI", project["id"], extractor) is not None
+        # overrides are gone once done
+        assert self.conf.site_name is None
+
+    def test_site_extract_concurrent_sites(self):
+        self.conf.set_override("caso_runs", ["compute"], group="accounting")
+        self.conf.set_override("extract_workers", 1, group="accounting")
+        other = copy.deepcopy(sample_site)
+        other.update({"name": "OTHER", "hostname": "other.org"})
+        other["static"]["accounting"]["site_name"] = "OTHER-SITE"
+        # both sites must be extracting at the same time to get past this
+        barrier = threading.Barrier(2, timeout=5)
+        records = []
+
+        def extract(extract_from, extract_to):
+            barrier.wait()
+            record = MagicMock()
+            records.append(record)
+            return [record]
+
+        self.m_nova.return_value.extract.side_effect = extract
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(
+                executor.map(
+                    lambda site: engine.site_extract(site, self.site_dir),
+                    [sample_site, other],
+                )
+            )
+        assert [set(r.values()) for r in results] == [{0}, {0}]
+        assert sorted(r.site_name for r in records) == [
+            "CENI-SITE",
+            "CENI-SITE",
+            "OTHER-SITE",
+            "OTHER-SITE",
+        ]
+        assert self.conf.site_name is None
+
+    def test_site_extract_from_lastrun(self):
+        self.conf.set_override("caso_runs", ["compute"], group="accounting")
+        site = copy.deepcopy(sample_site)
+        site["projects"] = site["projects"][:1]
+        last = datetime.datetime.now(tz.tzutc()) - datetime.timedelta(hours=1)
+        self.store.set("CENI", "90c0ce1b2f1545c0b9a05d9a8fd45102", "nova", last)
+        engine.site_extract(site, self.site_dir)
+        extract_from, extract_to = self.m_nova.return_value.extract.call_args.args
+        assert extract_from == last
+        self.m_cinder.assert_not_called()
+        assert (
+            self.store.get("CENI", "90c0ce1b2f1545c0b9a05d9a8fd45102", "nova")
+            == extract_to
+        )
+
+    def test_site_extract_backfill(self):
+        self.conf.set_override("caso_runs", ["compute"], group="accounting")
+        site = copy.deepcopy(sample_site)
+        site["projects"] = site["projects"][:1]
+        last = datetime.datetime.now(tz.tzutc()) - datetime.timedelta(days=2, hours=1)
+        self.store.set("CENI", "90c0ce1b2f1545c0b9a05d9a8fd45102", "nova", last)
+        self.m_nova.return_value.extract.return_value = []
+        return_codes = engine.site_extract(site, self.site_dir, window=24 * 60 * 60)
+        assert return_codes == {("90c0ce1b2f1545c0b9a05d9a8fd45102", "compute"): 0}
+        windows = sorted(
+            c.args for c in self.m_nova.return_value.extract.call_args_list
+        )
+        assert len(windows) == 3
+        assert windows[0][0] == last
+        assert windows[0][1] == windows[1][0] == last + datetime.timedelta(days=1)
+        assert (
+            self.store.get("CENI", "90c0ce1b2f1545c0b9a05d9a8fd45102", "nova")
+            == windows[2][1]
+        )
+
+    def test_site_extract_deadline(self):
+        with self.assertLogs(level="WARNING"):
+            return_codes = engine.site_extract(
+                sample_site, self.site_dir, deadline=time.monotonic()
+            )
+        assert set(return_codes.values()) == {engine.TIMEOUT_RETURN_CODE}
+        self.m_nova.assert_not_called()
+        self.m_cinder.assert_not_called()
+
+    def test_site_extract_failure(self):
+        self.conf.set_override("caso_runs", ["compute"], group="accounting")
+        self.m_nova.return_value.extract.side_effect = [ValueError("boom"), []]
+        return_codes = engine.site_extract(sample_site, self.site_dir)
+        assert sorted(return_codes.values()) == [0, 1]
+        extract_from, extract_to = self.m_nova.return_value.extract.call_args.args
+        # the failed project keeps its checkpoint
+        assert sorted(
+            self.store.get("CENI", project["id"], "nova")
+            for project in sample_site["projects"]
+        ) == [extract_from, extract_to]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+"""Tests for the accounting checkpoints"""
+
+import datetime
+import os.path
+import unittest
+
+import fixtures
+import testtools
+from dateutil import tz
+from oslo_config import fixture
+
+from . import checkpoints
+
+sample_site = {
+    "name": "CENI",
+    "projects": [{"id": "p1", "name": "ops"}],
+}
+
+
+class TestCheckpoints(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.spool_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("spool_dir", self.spool_dir, group="accounting")
+        self.store = checkpoints.get_store()
+        self.now = datetime.datetime(2026, 1, 10, tzinfo=tz.tzutc())
+
+    def test_store_path(self):
+        self.store.register("CENI", [("p1", "nova")])
+        assert os.path.exists(os.path.join(self.spool_dir, "checkpoints.sqlite"))
+
+    def test_set_get(self):
+        assert self.store.get("CENI", "p1", "nova") is None
+        self.store.set("CENI", "p1", "nova", self.now)
+        assert self.store.get("CENI", "p1", "nova") == self.now
+        later = self.now + datetime.timedelta(hours=1)
+        self.store.set("CENI", "p1", "nova", later)
+        assert self.store.get("CENI", "p1", "nova") == later
+        assert self.store.get("CENI", "p1", "cinder") is None
+
+    def test_stale(self):
+        self.store.register("CENI", [("p1", "nova"), ("p2", "nova"), ("p3", "nova")])
+        self.store.set("CENI", "p1", "nova", self.now)
+        self.store.set("CENI", "p2", "nova", self.now - datetime.timedelta(days=5))
+        # registering again does not reset the checkpoint
+        self.store.register("CENI", [("p1", "nova")])
+        stale = self.store.stale(self.now - datetime.timedelta(days=2))
+        assert stale == [
+            ("CENI", "p3", "nova", None),
+            ("CENI", "p2", "nova", self.now - datetime.timedelta(days=5)),
+        ]
+
+    def test_oldest(self):
+        self.store.register("CENI", [("p1", "nova"), ("p2", "nova")])
+        self.store.register("OTHER", [("p1", "nova"), ("p1", "cinder")])
+        self.store.set("CENI", "p1", "nova", self.now)
+        self.store.set("OTHER", "p1", "nova", self.now)
+        self.store.set("OTHER", "p1", "cinder", self.now - datetime.timedelta(days=1))
+        assert self.store.oldest() == {
+            "CENI": None,
+            "OTHER": self.now - datetime.timedelta(days=1),
+        }
+
+    def test_extract_from_checkpoint(self):
+        last = self.now - datetime.timedelta(days=5)
+        self.store.set("CENI", "p1", "nova", last)
+        with self.assertLogs(level="WARNING"):
+            extract_from = checkpoints.extract_from(
+                self.store,
+                sample_site,
+                sample_site["projects"][0],
+                "compute",
+                "nova",
+                self.spool_dir,
+                self.now,
+            )
+        assert extract_from == last
+
+    def test_extract_from_lastrun(self):
+        os.makedirs(os.path.join(self.spool_dir, "compute"))
+        with open(os.path.join(self.spool_dir, "compute", "lastrun.p1"), "w") as f:
+            f.write("2026-01-09 12:00:00.123456+00:00")
+        extract_from = checkpoints.extract_from(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            self.now,
+        )
+        assert extract_from == datetime.datetime(
+            2026, 1, 9, 12, 0, 0, 123456, tzinfo=tz.tzutc()
+        )
+
+    def test_extract_from_nothing(self):
+        extract_from = checkpoints.extract_from(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            self.now,
+        )
+        assert extract_from == self.now - datetime.timedelta(days=1)
+
+    def test_complete_window_out_of_order(self):
+        day = datetime.timedelta(days=1)
+        start = self.now - 3 * day
+        self.store.set("CENI", "p1", "nova", start)
+        self.store.complete_window("CENI", "p1", "nova", start + day, start + 2 * day)
+        # there is a hole before it
+        assert self.store.get("CENI", "p1", "nova") == start
+        assert self.store.done_windows("CENI", "p1", "nova") == {
+            (start + day, start + 2 * day)
+        }
+        self.store.complete_window("CENI", "p1", "nova", start, start + day)
+        assert self.store.get("CENI", "p1", "nova") == start + 2 * day
+        assert self.store.done_windows("CENI", "p1", "nova") == set()
+
+    def test_complete_window_no_checkpoint(self):
+        self.store.complete_window(
+            "CENI", "p1", "nova", self.now - datetime.timedelta(days=1), self.now
+        )
+        assert self.store.get("CENI", "p1", "nova") == self.now
+
+    def test_pending_windows_single(self):
+        last = self.now - datetime.timedelta(days=3)
+        self.store.set("CENI", "p1", "nova", last)
+        windows = checkpoints.pending_windows(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            self.now,
+        )
+        assert windows == [(last, self.now)]
+
+    def test_pending_windows_resume(self):
+        day = datetime.timedelta(days=1)
+        hour = datetime.timedelta(hours=1)
+        # no checkpoint yet, starts yesterday and gets stored
+        windows = checkpoints.pending_windows(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            self.now,
+            size=6 * 60 * 60,
+        )
+        start = self.now - day
+        assert self.store.get("CENI", "p1", "nova") == start
+        assert windows == [
+            (start + i * 6 * hour, start + (i + 1) * 6 * hour) for i in range(4)
+        ]
+        # an interrupted backfill only did the second window
+        self.store.complete_window("CENI", "p1", "nova", *windows[1])
+        later = self.now + hour
+        windows = checkpoints.pending_windows(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            later,
+            size=6 * 60 * 60,
+        )
+        assert windows == [
+            (start, start + 6 * hour),
+            (start + 12 * hour, start + 18 * hour),
+            (start + 18 * hour, self.now),
+            (self.now, later),
+        ]
+
+    def test_pending_windows_after_partial(self):
+        hour = datetime.timedelta(hours=1)
+        start = self.now - 20 * hour
+        self.store.set("CENI", "p1", "nova", start)
+        # the first window failed, the partial last one was done
+        for window in [(6, 12), (12, 18), (18, 20)]:
+            self.store.complete_window(
+                "CENI", "p1", "nova", *(start + i * hour for i in window)
+            )
+        windows = checkpoints.pending_windows(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            self.now + 5 * hour,
+            size=6 * 60 * 60,
+        )
+        assert windows == [
+            (start, start + 6 * hour),
+            (self.now, self.now + 5 * hour),
+        ]
+
+    def test_pending_windows_single_after_backfill(self):
+        hour = datetime.timedelta(hours=1)
+        start = self.now - 20 * hour
+        self.store.set("CENI", "p1", "nova", start)
+        # an interrupted backfill left some windows done
+        for window in [(6, 12), (18, 20)]:
+            self.store.complete_window(
+                "CENI", "p1", "nova", *(start + i * hour for i in window)
+            )
+        windows = checkpoints.pending_windows(
+            self.store,
+            sample_site,
+            sample_site["projects"][0],
+            "compute",
+            "nova",
+            self.spool_dir,
+            self.now + hour,
+        )
+        assert windows == [
+            (start, start + 6 * hour),
+            (start + 12 * hour, start + 18 * hour),
+            (self.now, self.now + hour),
+        ]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -35,11 +35,13 @@ class TestCloudConfig(testtools.TestCase):
         super().setUp()
         self.conf = self.useFixture(fixture.Config()).conf
 
-    @patch("fedcloud_catchall.cloud_info_config.get_vo_secrets")
+    @patch("fedcloud_catchall.cloud_info_config.get_site_secrets")
     def test_secretize_app_cred_site(self, m_get_secrets):
         m_get_secrets.return_value = {
-            "username": "demo",
-            "password": "1234",
+            "ops": {
+                "username": "demo",
+                "password": "1234",
+            }
         }
         with patch("builtins.open", mock_open(read_data=app_cred_site)):
             r = secretize("site_config_file", "the_access_token")
@@ -59,7 +61,7 @@ class TestCloudConfig(testtools.TestCase):
             ],
         }
         m_get_secrets.assert_called_with(
-            "https://example.com:5000/v3", "ops", "the_access_token"
+            "https://example.com:5000/v3", ["ops"], "the_access_token"
         )
 
     def test_secretize_regular_site(self):
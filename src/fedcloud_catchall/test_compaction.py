@@ -0,0 +1,128 @@
+"""Tests for the compaction of accounting messages"""
+
+import json
+import os.path
+import unittest
+import xml.etree.ElementTree as ETree  # nosec
+
+import dirq.QueueSimple
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import compaction
+
+STORAGE_RECORD = (
+    "<sr:StorageUsageRecord><sr:RecordIdentity sr:recordId='{0}' />"
+    "<sr:Site>CENI</sr:Site></sr:StorageUsageRecord>"
+)
+
+
+def cloud_message(*uuids):
+    records = "\n%%\n".join(f"VMUUID: {uuid}\nSiteName: CENI" for uuid in uuids)
+    return f"APEL-cloud-message: v0.4\n{records}\n".encode()
+
+
+def storage_message(*ids):
+    records = "".join(STORAGE_RECORD.format(i) for i in ids)
+    return (
+        '<sr:StorageUsageRecords xmlns:sr="'
+        f'{compaction.STORAGE_NAMESPACE}">{records}</sr:StorageUsageRecords>'
+    ).encode()
+
+
+def json_message(*ips):
+    return json.dumps(
+        {
+            "Type": "APEL Public IP message",
+            "Version": "0.2",
+            "UsageRecords": [{"IPCount": ip} for ip in ips],
+        }
+    )
+
+
+class TestCompaction(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.site_dir = self.useFixture(fixtures.TempDir()).path
+
+    def queue(self, run_type, messages):
+        queue = dirq.QueueSimple.QueueSimple(
+            os.path.join(self.site_dir, run_type, "outgoing")
+        )
+        for message in messages:
+            queue.add(message)
+        return queue
+
+    def messages(self, queue):
+        messages = []
+        for name in queue:
+            assert queue.lock(name)
+            messages.append(queue.get(name))
+            queue.unlock(name)
+        return messages
+
+    def test_compact_cloud(self):
+        self.conf.set_override("compact_max_records", 3, group="accounting")
+        queue = self.queue(
+            "compute", [cloud_message(i) for i in range(4)] + [cloud_message(4, 5)]
+        )
+        assert compaction.compact_queue(queue.path) == (5, 2)
+        messages = self.messages(queue)
+        records = []
+        for message in messages:
+            group, message_records = compaction._parse(message)
+            assert group == ("cloud", "APEL-cloud-message: v0.4")
+            assert len(message_records) <= 3
+            records.extend(message_records)
+        assert sorted(records) == [f"VMUUID: {i}\nSiteName: CENI" for i in range(6)]
+        assert messages[0] == cloud_message(0, 1, 2)
+
+    def test_compact_storage(self):
+        queue = self.queue("block", [storage_message(1), storage_message(2, 3)])
+        assert compaction.compact_queue(queue.path) == (2, 1)
+        (message,) = self.messages(queue)
+        root = ETree.fromstring(message)  # nosec
+        assert root.tag == f"{{{compaction.STORAGE_NAMESPACE}}}StorageUsageRecords"
+        ids = [
+            record[0].get(f"{{{compaction.STORAGE_NAMESPACE}}}recordId")
+            for record in root
+        ]
+        assert ids == ["1", "2", "3"]
+
+    def test_compact_json(self):
+        queue = self.queue("compute", [json_message(1), json_message(2)])
+        assert compaction.compact_queue(queue.path) == (2, 1)
+        (message,) = self.messages(queue)
+        assert json.loads(message) == json.loads(json_message(1, 2))
+
+    def test_compact_max_bytes(self):
+        self.conf.set_override("compact_max_bytes", 1024, group="accounting")
+        big = "x" * 600
+        queue = self.queue("compute", [cloud_message(big) for i in range(3)])
+        # one record per message already
+        assert compaction.compact_queue(queue.path) == (3, 3)
+        assert len(self.messages(queue)) == 3
+
+    def test_compact_keeps_unknown_and_locked(self):
+        queue = self.queue("compute", [cloud_message(1), cloud_message(2), b"garbage"])
+        locked = next(iter(queue))
+        assert queue.lock(locked)
+        assert compaction.compact_queue(queue.path) == (1, 1)
+        queue.unlock(locked)
+        messages = self.messages(queue)
+        assert len(messages) == 3
+        assert b"garbage" in messages
+
+    def test_compact_site(self):
+        self.queue("compute", [cloud_message(1), cloud_message(2)])
+        self.queue("block", [storage_message(1), storage_message(2)])
+        assert compaction.compact_site(self.site_dir) == (4, 2)
+
+    def test_compact_site_no_queues(self):
+        assert compaction.compact_site(self.site_dir) == (0, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
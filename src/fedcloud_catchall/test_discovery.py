@@ -1,9 +1,14 @@
 """Tests for the discovery"""
 
 import copy
+import json
+import os
+import os.path
+import time
 import unittest
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import mock_open, patch
 
+import fixtures
 import httpx
 import respx
 import testtools
@@ -110,6 +115,12 @@ class TestDiscovery(testtools.TestCase):
     def setUp(self):
         super().setUp()
         self.conf = self.useFixture(fixture.Config()).conf
+        self.useFixture(
+            fixtures.MonkeyPatch(
+                f"{disco.__name__}.token_manager",
+                disco.TokenManager(disco._new_access_token),
+            )
+        )
 
     @respx.mock
     def test_fetch_site_info_ok(self):
@@ -124,6 +135,76 @@ class TestDiscovery(testtools.TestCase):
         assert sites == {}
         assert route.called
 
+    def _setup_site_info_cache(self, timestamp, etag="abc"):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("cache_dir", cache_dir, group="cache")
+        self.conf.set_override(
+            "fedcloud_info_system_url", "https://example.com", group="discovery"
+        )
+        cache_file = os.path.join(cache_dir, disco.SITE_INFO_CACHE)
+        with open(cache_file, "w") as f:
+            json.dump(
+                {
+                    "timestamp": timestamp,
+                    "etag": etag,
+                    "last_modified": None,
+                    "sites": [{"id": "1", "projects": []}],
+                },
+                f,
+            )
+        return cache_file
+
+    @respx.mock
+    def test_fetch_site_info_cached(self):
+        self._setup_site_info_cache(time.time())
+        route = respx.get("https://example.com/sites/")
+        sites = disco.fetch_site_info()
+        assert sites == [{"id": "1", "projects": [], "shares": {}}]
+        assert not route.called
+
+    @respx.mock
+    def test_fetch_site_info_not_modified(self):
+        cache_file = self._setup_site_info_cache(time.time() - 3600)
+        route = respx.get("https://example.com/sites/").mock(
+            return_value=httpx.Response(304)
+        )
+        sites = disco.fetch_site_info()
+        assert sites == [{"id": "1", "projects": [], "shares": {}}]
+        assert route.calls[0].request.headers["If-None-Match"] == "abc"
+        with open(cache_file) as f:
+            assert time.time() - json.load(f)["timestamp"] < 60
+
+    @respx.mock
+    def test_fetch_site_info_modified(self):
+        cache_file = self._setup_site_info_cache(time.time() - 3600)
+        respx.get("https://example.com/sites/").mock(
+            return_value=httpx.Response(
+                200, json=[{"id": "2", "projects": []}], headers={"ETag": "def"}
+            )
+        )
+        sites = disco.fetch_site_info()
+        assert sites == [{"id": "2", "projects": [], "shares": {}}]
+        with open(cache_file) as f:
+            cached = json.load(f)
+        assert cached["etag"] == "def"
+        assert cached["sites"] == [{"id": "2", "projects": []}]
+
+    @respx.mock
+    def test_fetch_site_info_stale_on_error(self):
+        self._setup_site_info_cache(time.time() - 3600)
+        respx.get("https://example.com/sites/").mock(return_value=httpx.Response(503))
+        sites = disco.fetch_site_info()
+        assert sites == [{"id": "1", "projects": [], "shares": {}}]
+
+    @respx.mock
+    def test_fetch_site_info_too_stale_on_error(self):
+        self._setup_site_info_cache(time.time() - 3600)
+        self.conf.set_override("site_info_max_stale", 60, group="discovery")
+        respx.get("https://example.com/sites/").mock(
+            side_effect=httpx.ConnectTimeout("timeout")
+        )
+        self.assertRaises(httpx.ConnectTimeout, disco.fetch_site_info)
+
     @patch("fedcloud_catchall.discovery.fetch_site_info")
     @patch("glob.iglob")
     def test_load_sites(self, m_glob, m_fetch):
@@ -144,30 +225,135 @@ class TestDiscovery(testtools.TestCase):
             sites = disco.load_sites()
             assert sites == {}
 
-    @patch("jwt.decode")
-    @patch("hvac.Client")
-    def test_get_vo_secrets(self, m_hvac, m_decode):
-        m_client = MagicMock()
-        m_hvac.return_value = m_client
-        m_client.auth.jwt.jwt_login.return_value = None
-        m_client.secrets.kv.v1.read_secret.return_value = {
-            "data": {
-                "username": "demo",
-                "password": "1234",
-            }
-        }
-        m_decode.return_value = {"sub": "user@egi.eu"}
-        r = disco.get_vo_secrets(
-            "https://example.com:5000/v3", "ops", "the_access_token"
+    def _setup_static_sites(self):
+        site_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("site_config_dir", site_dir, group="discovery")
+        self.conf.set_override(
+            "cache_dir", self.useFixture(fixtures.TempDir()).path, group="cache"
         )
-        assert r == {"password": "1234", "username": "demo"}
-        m_hvac.assert_called_once()
-        m_client.auth.jwt.jwt_login.assert_called_with(role="", jwt="the_access_token")
-        m_client.secrets.kv.v1.read_secret.assert_called_with(
-            path="users/user@egi.eu/cloudmon/example.com/ops",
-            mount_point="/secrets/",
+        site_file = os.path.join(site_dir, "TEST.yaml")
+        with open(site_file, "w") as f:
+            f.write(SAMPLE_SITE)
+        return site_file
+
+    def test_load_static_sites_snapshot(self):
+        self._setup_static_sites()
+        sites = disco.load_static_sites()
+        assert sites == {"TEST": LOADED_SITE["static"]}
+        with patch("fedcloud_catchall.discovery._load_site_file") as m_load:
+            assert disco.load_static_sites() == sites
+            m_load.assert_not_called()
+
+    def test_load_static_sites_changed(self):
+        site_file = self._setup_static_sites()
+        disco.load_static_sites()
+        with open(site_file, "w") as f:
+            f.write(SAMPLE_SITE.replace("TEST", "OTHER"))
+        sites = disco.load_static_sites()
+        assert list(sites.keys()) == ["OTHER"]
+
+    def test_load_static_sites_removed(self):
+        site_file = self._setup_static_sites()
+        disco.load_static_sites()
+        os.remove(site_file)
+        assert disco.load_static_sites() == {}
+
+    def test_load_static_sites_corrupt_snapshot(self):
+        self._setup_static_sites()
+        disco.load_static_sites()
+        snapshot_file = disco.cache.cache_file(disco.STATIC_SITES_CACHE)
+        with open(snapshot_file) as f:
+            assert json.load(f)["version"] == disco.STATIC_SITES_VERSION
+        for content in ("{broken", '{"version": 2, "files": []}', "[]"):
+            with open(snapshot_file, "w") as f:
+                f.write(content)
+            assert disco.load_static_sites() == {"TEST": LOADED_SITE["static"]}
+
+    def test_selected(self):
+        assert disco.selected("TEST", [])
+        assert disco.selected("TEST", ["TE*"])
+        assert disco.selected("TEST", ["FOO,TEST"])
+        assert disco.selected("TEST", ["FOO", "T?ST"])
+        assert not disco.selected("TEST", ["FOO"])
+        assert not disco.selected("TEST", ["test"])
+
+    @patch("fedcloud_catchall.discovery.fetch_site_info")
+    @patch("glob.iglob")
+    def test_load_sites_vo_selection(self, m_glob, m_fetch):
+        m_fetch.return_value = copy.deepcopy(SITES_INFO)
+        m_glob.return_value = ["TEST.yaml"]
+        with patch("builtins.open", mock_open(read_data=SAMPLE_SITE)):
+            sites = disco.load_sites(vo_patterns=["fake-*"])
+        assert list(sites["1"]["shares"].keys()) == ["fake-vo.example.com"]
+        assert sites["1"]["projects"] == [{"id": "def", "name": "fake-vo.example.com"}]
+
+    @patch("fedcloud_catchall.discovery.fetch_site_info")
+    @patch("glob.iglob")
+    def test_load_sites_no_vo_selected(self, m_glob, m_fetch):
+        m_fetch.return_value = copy.deepcopy(SITES_INFO)
+        m_glob.return_value = ["TEST.yaml"]
+        with patch("builtins.open", mock_open(read_data=SAMPLE_SITE)):
+            sites = disco.load_sites(vo_patterns=["foo"])
+        assert sites == {}
+
+    @patch("fedcloud_catchall.discovery.fetch_site_info")
+    @patch("glob.iglob")
+    def test_load_sites_site_selection(self, m_glob, m_fetch):
+        m_fetch.return_value = copy.deepcopy(SITES_INFO)
+        m_glob.return_value = ["TEST.yaml"]
+        self.conf.set_override("site", ["FOO"])
+        with patch("builtins.open", mock_open(read_data=SAMPLE_SITE)):
+            sites = disco.load_sites()
+        assert sites == {}
+
+    def test_load_static_sites_selection_file_name(self):
+        site_file = self._setup_static_sites()
+        os.rename(site_file, site_file.replace("TEST", "TEST-cloud"))
+        # same selection with a cold or a warm snapshot, and with no cache
+        for _ in range(2):
+            assert disco.load_static_sites(["TEST"]) == {"TEST": LOADED_SITE["static"]}
+            assert disco.load_static_sites(["TEST-cloud"]) == {}
+        self.conf.set_override("cache_dir", None, group="cache")
+        assert disco.load_static_sites(["TEST"]) == {"TEST": LOADED_SITE["static"]}
+
+    def test_load_static_sites_selection_snapshot(self):
+        site_file = self._setup_static_sites()
+        os.rename(site_file, site_file.replace("TEST", "renamed"))
+        disco.load_static_sites()
+        with patch("fedcloud_catchall.discovery._load_site_file") as m_load:
+            assert disco.load_static_sites(["TEST"]) == {"TEST": LOADED_SITE["static"]}
+            assert disco.load_static_sites(["FOO"]) == {}
+            m_load.assert_not_called()
+
+    @patch("fedcloud_catchall.discovery.generate_token")
+    @patch("fedcloud_catchall.discovery.fetch_broker_token")
+    def test_get_access_token_broker(self, m_broker, m_token):
+        m_broker.return_value = "broker_token"
+        assert disco.get_access_token() == "broker_token"
+        m_token.assert_not_called()
+
+    @patch("fedcloud_catchall.discovery.generate_token")
+    @patch("fedcloud_catchall.discovery.get_oidc_config")
+    @patch("fedcloud_catchall.discovery.prefetch_vo_secrets")
+    def test_prefetch_secrets(self, m_prefetch, m_oidc, m_token):
+        appcred_site = copy.deepcopy(LOADED_SITE)
+        appcred_site["static"]["auth"] = "v3applicationcredential"
+        disco.prefetch_secrets([LOADED_SITE, appcred_site])
+        m_prefetch.assert_called_once_with(
+            [
+                ("https://example.com:5000/v3", "fake-vo.example.com"),
+                ("https://example.com:5000/v3", "ops"),
+            ],
+            m_token.return_value,
         )
 
+    @patch("fedcloud_catchall.discovery.generate_token")
+    @patch("fedcloud_catchall.discovery.prefetch_vo_secrets")
+    def test_prefetch_secrets_no_appcred(self, m_prefetch, m_token):
+        disco.prefetch_secrets([LOADED_SITE])
+        m_prefetch.assert_not_called()
+        m_token.assert_not_called()
+
     def test_auth_config_oidc(self):
         site = LOADED_SITE
         config = [
@@ -0,0 +1,59 @@
+"""Tests for the shared HTTP clients"""
+
+import unittest
+from unittest.mock import patch
+
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import http_client
+
+
+class TestHttpClient(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.useFixture(fixtures.MonkeyPatch(f"{http_client.__name__}._clients", {}))
+
+    def test_get_client_shared(self):
+        client = http_client.get_client("checkin")
+        assert http_client.get_client("checkin") is client
+        assert http_client.get_client("registry") is not client
+
+    def test_get_client_unknown(self):
+        self.assertRaises(ValueError, http_client.get_client, "foo")
+
+    def test_client_timeouts(self):
+        self.conf.set_override("registry_timeout", 42, group="http")
+        self.conf.set_override("connect_timeout", 3, group="http")
+        client = http_client.get_client("registry")
+        assert client.timeout.read == 42
+        assert client.timeout.connect == 3
+
+    @patch("importlib.util.find_spec")
+    @patch("httpx.Client")
+    def test_http2(self, m_client, m_spec):
+        m_spec.return_value = None
+        http_client.get_client("checkin")
+        assert m_client.call_args.kwargs["http2"] is False
+        m_spec.return_value = object()
+        http_client.get_client("registry")
+        assert m_client.call_args.kwargs["http2"] is True
+
+    def test_new_client(self):
+        self.conf.set_override("ams_timeout", 7, group="http")
+        client = http_client.new_client("ams", verify=False)
+        assert client.timeout.read == 7
+        assert http_client.new_client("ams") is not client
+        assert http_client._clients == {}
+
+    def test_close_clients(self):
+        client = http_client.get_client("checkin")
+        http_client.close_clients()
+        assert client.is_closed
+        assert http_client.get_client("checkin") is not client
+
+
+if __name__ == "__main__":
+    unittest.main()
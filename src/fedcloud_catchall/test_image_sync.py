@@ -3,6 +3,7 @@
 import configparser
 from unittest.mock import MagicMock, mock_open, patch
 
+import fixtures
 import httpx
 import respx
 import testtools
@@ -10,6 +11,7 @@ import yaml
 from oslo_config import fixture
 
 from . import image_sync as sync
+from .registry import SiteRegistry
 
 sample_config = """
 [DEFAULT]
@@ -36,7 +38,7 @@ access_token_type = access_token
 [ssm]
 output_path = /var/outgoing"""
 
-disabled_sites = {1: {"id": 1, "name": "CENI", "static": {}}}
+disabled_sites = SiteRegistry({1: {"id": 1, "name": "CENI", "static": {}}})
 
 
 enabled_site = {
@@ -49,7 +51,7 @@ enabled_site = {
     "shares": {"vo1": {"id": "abc", "foo": "bar", "name": "vo1"}},
 }
 
-enabled_sites = {1: enabled_site}
+enabled_sites = SiteRegistry({1: enabled_site})
 
 
 class TestImageSync(testtools.TestCase):
@@ -81,6 +83,83 @@ class TestImageSync(testtools.TestCase):
         )
         assert sync.fetch_harbor_projects() == ["vo1", "vo2"]
 
+    def harbor_conf(self):
+        self.conf.set_override("registry_base_url", "https://example.com", group="sync")
+        self.conf.set_override("registry_user", "user", group="sync")
+        self.conf.set_override("registry_password", "1234", group="sync")
+        self.conf.set_override("registry_page_size", 2, group="sync")
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("cache_dir", cache_dir, group="cache")
+
+    def harbor_pages(self, names, etag=None):
+        def page(request):
+            if etag and request.headers.get("If-None-Match") == etag:
+                return httpx.Response(304)
+            number = int(request.url.params["page"])
+            size = int(request.url.params["page_size"])
+            first = (number - 1) * size
+            chunk = names[first:][:size]
+            headers = {"X-Total-Count": str(len(names))}
+            if etag:
+                headers["ETag"] = etag
+            return httpx.Response(
+                200,
+                json=[{"name": name} for name in chunk],
+                headers=headers,
+            )
+
+        return respx.get("https://example.com/api/v2.0/projects").mock(side_effect=page)
+
+    @respx.mock
+    def test_fetch_harbor_projects_pages(self):
+        self.harbor_conf()
+        names = ["vo1", "vo2", "vo3", "vo4", "vo5"]
+        route = self.harbor_pages(names)
+        assert sync.fetch_harbor_projects() == names
+        assert route.call_count == 3
+        # unchanged total and first page, nothing else is fetched
+        assert sync.fetch_harbor_projects() == names
+        assert route.call_count == 4
+        # a new project triggers a full fetch
+        self.harbor_pages(names + ["vo6"])
+        assert sync.fetch_harbor_projects() == names + ["vo6"]
+        assert route.call_count == 7
+
+    @respx.mock
+    def test_fetch_harbor_projects_ttl(self):
+        self.harbor_conf()
+        names = ["vo1", "vo2", "vo3"]
+        route = self.harbor_pages(names, etag='"v1"')
+        assert sync.fetch_harbor_projects() == names
+        # a project replaced past the first page is only seen once expired
+        self.harbor_pages(["vo1", "vo2", "vo4"], etag='"v1"')
+        assert sync.fetch_harbor_projects() == names
+        self.conf.set_override("registry_projects_ttl", 0, group="sync")
+        assert sync.fetch_harbor_projects() == ["vo1", "vo2", "vo4"]
+        assert route.call_count == 5
+        assert "If-None-Match" not in route.calls.last.request.headers
+
+    @respx.mock
+    def test_fetch_harbor_projects_single_page(self):
+        self.harbor_conf()
+        self.conf.set_override("registry_page_size", 100, group="sync")
+        self.conf.set_override("registry_projects_ttl", 0, group="sync")
+        route = self.harbor_pages(["vo1", "vo2"], etag='"v1"')
+        sync.fetch_harbor_projects()
+        # the ETag covers the whole list
+        assert sync.fetch_harbor_projects() == ["vo1", "vo2"]
+        assert route.calls.last.response.status_code == 304
+
+    @respx.mock
+    def test_fetch_harbor_projects_not_modified(self):
+        self.harbor_conf()
+        route = self.harbor_pages(["vo1", "vo2", "vo3"], etag='"v1"')
+        assert sync.fetch_harbor_projects() == ["vo1", "vo2", "vo3"]
+        assert route.call_count == 2
+        assert sync.fetch_harbor_projects() == ["vo1", "vo2", "vo3"]
+        assert route.call_count == 3
+        assert route.calls.last.response.status_code == 304
+
     def test_dump_vo_map(self):
         assert yaml.safe_load(sync.dump_vo_map(enabled_site)) == {
             "vo1": {"foo": "bar", "id": "abc", "project_id": "abc", "name": "vo1"}
@@ -0,0 +1,54 @@
+"""Tests for the record cleaner"""
+
+import os.path
+import unittest
+
+import dirq.QueueSimple
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import record_cleaner
+
+
+class TestRecordCleaner(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.spool_dir = self.useFixture(fixtures.TempDir()).path
+        self.queues = {}
+        for site_name in ("CENI", "OTHER"):
+            queue = dirq.QueueSimple.QueueSimple(
+                os.path.join(self.spool_dir, site_name, "compute", "outgoing")
+            )
+            queue.add(b"record")
+            self.queues[site_name] = queue
+
+    def test_remove_records(self):
+        self.conf.set_override("site", ["CEN*"])
+        record_cleaner.remove_records(self.spool_dir)
+        assert self.queues["CENI"].count() == 0
+        assert self.queues["OTHER"].count() == 1
+
+    def test_purge_records(self):
+        self.conf.set_override("site", ["CEN*"])
+        with self.assertLogs(level="INFO") as logs:
+            freed = record_cleaner.purge_records(self.spool_dir)
+        assert freed == {"CENI": (1, 6)}
+        assert logs.output == ["INFO:root:Removed 1 records (6 bytes) of site CENI"]
+        assert self.queues["CENI"].count() == 0
+        assert self.queues["OTHER"].count() == 1
+
+    def test_apply_retention(self):
+        self.conf.set_override("spool_dir", self.spool_dir, group="accounting")
+        assert not record_cleaner.retention_enabled()
+        self.conf.set_override("retention_site_bytes", 0, group="accounting")
+        assert record_cleaner.retention_enabled()
+        with self.assertLogs(level="INFO") as logs:
+            freed = record_cleaner.apply_retention(self.spool_dir)
+        assert freed == {"CENI": (1, 6), "OTHER": (1, 6)}
+        assert len(logs.output) == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
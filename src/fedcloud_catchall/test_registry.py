@@ -0,0 +1,99 @@
+"""Tests for the site registry"""
+
+import copy
+import unittest
+
+import testtools
+
+from .registry import SiteRegistry
+
+SITE = {
+    "id": "1",
+    "name": "TEST",
+    "url": "https://example.com:5000/v3",
+    "shares": {"ops": {"id": "abc", "name": "ops"}},
+    "static": {
+        "accounting": {"enabled": True},
+        "images": {"sync": False},
+    },
+}
+
+
+class TestRegistry(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        other = copy.deepcopy(SITE)
+        other.update(
+            {
+                "id": "2",
+                "name": "OTHER",
+                "url": "https://other.com:5000/v3",
+                "shares": {"vo1": {"id": "def", "name": "vo1"}},
+                "static": {
+                    "auth": "v3applicationcredential",
+                    "images": {"sync": True},
+                },
+            }
+        )
+        self.other = other
+        self.registry = SiteRegistry({"1": SITE, "2": other})
+
+    def test_mapping(self):
+        assert len(self.registry) == 2
+        assert self.registry["1"] is SITE
+        assert dict(self.registry.items()) == {"1": SITE, "2": self.other}
+
+    def test_get_by_name(self):
+        assert self.registry.get_by_name("OTHER") is self.other
+        assert self.registry.get_by_name("FOO") is None
+
+    def test_get_by_host(self):
+        assert self.registry.get_by_host("example.com") == [SITE]
+        assert self.registry.get_by_host("foo.com") == []
+
+    def test_sites_with_vo(self):
+        assert list(self.registry.sites_with_vo("vo1")) == [self.other]
+        assert list(self.registry.sites_with_vo("foo")) == []
+
+    def test_feature_sites(self):
+        assert list(self.registry.accounting_sites()) == [SITE]
+        assert list(self.registry.image_sync_sites()) == [self.other]
+        assert list(self.registry.appcred_sites()) == [self.other]
+
+    def test_add_again(self):
+        moved = copy.deepcopy(self.other)
+        moved.update(
+            {
+                "url": "https://moved.com:5000/v3",
+                "shares": {"vo2": {"id": "ghi", "name": "vo2"}},
+                "static": {"accounting": {"enabled": True}},
+            }
+        )
+        self.registry.add(moved)
+        assert len(self.registry) == 2
+        assert self.registry.get_by_name("OTHER") is moved
+        assert self.registry.get_by_host("other.com") == []
+        assert self.registry.get_by_host("moved.com") == [moved]
+        assert list(self.registry.sites_with_vo("vo1")) == []
+        assert list(self.registry.sites_with_vo("vo2")) == [moved]
+        assert list(self.registry.accounting_sites()) == [SITE, moved]
+        assert list(self.registry.image_sync_sites()) == []
+        assert list(self.registry.appcred_sites()) == []
+
+    def test_add_same_name(self):
+        renamed = copy.deepcopy(SITE)
+        renamed["id"] = "3"
+        self.registry.add(renamed)
+        assert list(self.registry) == ["2", "3"]
+        assert self.registry.get_by_host("example.com") == [renamed]
+        assert list(self.registry.accounting_sites()) == [renamed]
+
+    def test_entries(self):
+        entries = list(self.registry.entries())
+        assert [e.name for e in entries] == ["TEST", "OTHER"]
+        assert entries[0].keystone_host == "example.com"
+        assert not hasattr(entries[0], "__dict__")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+"""Tests for the accounting spool"""
+
+import os
+import os.path
+import sqlite3
+import time
+import unittest
+from unittest.mock import patch
+
+import dirq.QueueSimple
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import spool
+
+
+class TestSpool(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.spool_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("spool_dir", self.spool_dir, group="accounting")
+
+    def add_messages(self, site_name, run_type, count, granularity=60):
+        queue = dirq.QueueSimple.QueueSimple(
+            os.path.join(self.spool_dir, site_name, run_type, "outgoing"),
+            granularity=granularity,
+        )
+        for i in range(count):
+            queue.add(b"0123456789")
+        return queue
+
+    def test_site_queues(self):
+        self.add_messages("CENI", "compute", 1)
+        self.add_messages("CENI", "block", 1)
+        self.add_messages("OTHER", "compute", 1)
+        os.makedirs(os.path.join(self.spool_dir, "OTHER", "compute", "lock.p1"))
+        assert list(spool.site_queues(self.spool_dir)) == [
+            ("CENI", os.path.join(self.spool_dir, "CENI", "block", "outgoing")),
+            ("CENI", os.path.join(self.spool_dir, "CENI", "compute", "outgoing")),
+            ("OTHER", os.path.join(self.spool_dir, "OTHER", "compute", "outgoing")),
+        ]
+
+    def test_spool_stats(self):
+        self.conf.set_override("scan_workers", 2, group="accounting")
+        compute = self.add_messages("CENI", "compute", 3, granularity=1)
+        self.age(compute, 60)
+        self.add_messages("CENI", "block", 0)
+        self.add_messages("OTHER", "compute", 1)
+        name = next(iter(compute))
+        oldest = spool.element_time(os.path.basename(name))
+        # locking touches the element, the lock itself is not counted
+        assert compute.lock(name)
+        stats = spool.spool_stats(spool.site_queues(self.spool_dir))
+        assert stats[:2] == [
+            ("CENI", "block", 0, 0, None),
+            ("CENI", "compute", 3, 30, oldest),
+        ]
+        assert stats[2][:4] == ("OTHER", "compute", 1, 10)
+        # same from the index
+        assert (
+            spool.spool_stats(spool.site_queues(self.spool_dir), incremental=True)
+            == stats
+        )
+
+    def test_purge_queues(self):
+        self.conf.set_override("purge_workers", 4, group="accounting")
+        self.useFixture(fixtures.MockPatch(f"{spool.__name__}.PURGE_CHUNK", 3))
+        # one directory per element
+        compute = self.add_messages("CENI", "compute", 7, granularity=1)
+        block = self.add_messages("CENI", "block", 3)
+        other = self.add_messages("OTHER", "compute", 2)
+        # locked elements are removed once
+        name = next(iter(other))
+        assert other.lock(name)
+        freed = spool.purge_queues(spool.site_queues(self.spool_dir))
+        assert freed == {"CENI": (10, 100), "OTHER": (2, 20)}
+        for queue in (compute, block, other):
+            assert queue.count() == 0
+            assert os.listdir(queue.path) == []
+        # the queue is still usable
+        block.add(b"data")
+        assert block.count() == 1
+
+    def test_purge_interrupted(self):
+        queue = self.add_messages("CENI", "compute", 3)
+        trash = spool.set_aside(queue.path)
+        assert len(trash) == 1
+        assert queue.count() == 0
+        freed = spool.purge_queues(spool.site_queues(self.spool_dir))
+        assert freed == {"CENI": (3, 30)}
+        assert os.listdir(queue.path) == []
+
+    def age(self, queue, seconds):
+        # elements named as if added seconds ago, directories written then
+        for name in list(queue):
+            dir_name, element = name.split("/")
+            created = int(element[:8], 16) - seconds
+            os.rename(
+                os.path.join(queue.path, name),
+                os.path.join(queue.path, dir_name, f"{created:08x}{element[8:]}"),
+            )
+        then = time.time() - seconds
+        for name in os.listdir(queue.path):
+            os.utime(os.path.join(queue.path, name), (then, then))
+
+    def test_index_update_incremental(self):
+        queue = self.add_messages("CENI", "compute", 2)
+        self.age(queue, 60)
+        index = spool.get_index()
+        queues = list(spool.site_queues(self.spool_dir))
+        with patch.object(
+            spool.SpoolIndex, "_scan_dir", wraps=spool.SpoolIndex._scan_dir
+        ) as m_scan:
+            index.update(queues)
+            assert m_scan.call_count == 1
+            index.update(queues)
+            assert m_scan.call_count == 1
+            # a new directory and a recent change are scanned
+            self.add_messages("CENI", "compute", 1, granularity=1)
+            index.update(queues)
+            assert m_scan.call_count == 2
+            index.update(queues)
+            assert m_scan.call_count == 3
+        assert len(index.evictions(quota=0)) == 3
+
+    def test_index_rebuilt_on_version_change(self):
+        self.add_messages("CENI", "compute", 2)
+        index = spool.get_index()
+        # as left by a previous layout
+        with sqlite3.connect(index.path) as conn:
+            conn.execute("CREATE TABLE elements (queue TEXT, mtime REAL)")
+        index.update(spool.site_queues(self.spool_dir))
+        assert len(index.evictions(quota=0)) == 2
+
+    def test_index_forgets_removed_queues(self):
+        queue = self.add_messages("CENI", "compute", 2)
+        index = spool.get_index()
+        index.update(spool.site_queues(self.spool_dir))
+        spool.purge_queues(spool.site_queues(self.spool_dir))
+        os.rmdir(queue.path)
+        index.update([])
+        assert index.evictions(quota=0) == []
+
+    def test_retention_max_age(self):
+        self.conf.set_override("retention_max_age", 3600, group="accounting")
+        old = self.add_messages("CENI", "compute", 2)
+        self.age(old, 7200)
+        # failed sends lock and unlock the elements, touching them
+        for name in old:
+            assert old.lock(name)
+            old.unlock(name)
+        recent = self.add_messages("CENI", "block", 1)
+        freed = spool.enforce_retention(spool.site_queues(self.spool_dir))
+        assert freed == {"CENI": (2, 20)}
+        assert old.count() == 0
+        assert recent.count() == 1
+
+    def test_retention_site_bytes(self):
+        self.conf.set_override("retention_site_bytes", 25, group="accounting")
+        old = self.add_messages("CENI", "compute", 2)
+        self.age(old, 7200)
+        recent = self.add_messages("CENI", "block", 2)
+        other = self.add_messages("OTHER", "compute", 3)
+        self.age(other, 7200)
+        freed = spool.enforce_retention(spool.site_queues(self.spool_dir))
+        # the newest 20 bytes of every site are kept
+        assert freed == {"CENI": (2, 20), "OTHER": (1, 10)}
+        assert old.count() == 0
+        assert recent.count() == 2
+        assert other.count() == 2
+
+    def test_retention_quota(self):
+        self.conf.set_override("retention_quota", 30, group="accounting")
+        oldest = self.add_messages("CENI", "compute", 2)
+        self.age(oldest, 7200)
+        older = self.add_messages("OTHER", "compute", 2)
+        self.age(older, 3600)
+        recent = self.add_messages("CENI", "block", 2)
+        freed = spool.enforce_retention(spool.site_queues(self.spool_dir))
+        assert freed == {"CENI": (2, 20), "OTHER": (1, 10)}
+        assert oldest.count() == 0
+        assert older.count() == 1
+        assert recent.count() == 2
+        # nothing else to do
+        freed = spool.enforce_retention(spool.site_queues(self.spool_dir))
+        assert freed == {"CENI": (0, 0), "OTHER": (0, 0)}
+
+    def test_retention_keeps_locked(self):
+        self.conf.set_override("retention_quota", 0, group="accounting")
+        queue = self.add_messages("CENI", "compute", 2)
+        name = next(iter(queue))
+        assert queue.lock(name)
+        freed = spool.enforce_retention(spool.site_queues(self.spool_dir))
+        assert freed == {"CENI": (1, 10)}
+        assert queue.count() == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Tests for the accounting spool statistics"""
+
+import json
+import os.path
+import unittest
+
+import fixtures
+import testtools
+
+from . import spool_stats
+
+sample_stats = [
+    ("CENI", "block", 0, 0, None),
+    ("CENI", "compute", 3, 30, 1767225600.5),
+]
+
+
+class TestSpoolStats(testtools.TestCase):
+    def test_json_report(self):
+        assert json.loads(spool_stats.json_report(sample_stats)) == [
+            {
+                "site": "CENI",
+                "run_type": "block",
+                "records": 0,
+                "bytes": 0,
+                "oldest": None,
+            },
+            {
+                "site": "CENI",
+                "run_type": "compute",
+                "records": 3,
+                "bytes": 30,
+                "oldest": 1767225600.5,
+            },
+        ]
+
+    def test_prometheus_report(self):
+        report = spool_stats.prometheus_report(sample_stats).splitlines()
+        assert report[:4] == [
+            "# HELP egi_accounting_spool_records Records queued for sending",
+            "# TYPE egi_accounting_spool_records gauge",
+            'egi_accounting_spool_records{site="CENI",run_type="block"} 0',
+            'egi_accounting_spool_records{site="CENI",run_type="compute"} 3',
+        ]
+        assert 'egi_accounting_spool_bytes{site="CENI",run_type="compute"} 30' in report
+        oldest = [line for line in report if "oldest" in line and "{" in line]
+        assert oldest == [
+            "egi_accounting_spool_oldest_timestamp_seconds"
+            '{site="CENI",run_type="compute"} 1767225600.5'
+        ]
+
+    def test_prometheus_label_escaping(self):
+        report = spool_stats.prometheus_report([('a"b\\c', "compute", 1, 1, None)])
+        assert '{site="a\\"b\\\\c",run_type="compute"} 1' in report
+
+    def test_write_report(self):
+        output = os.path.join(self.useFixture(fixtures.TempDir()).path, "spool.prom")
+        spool_stats.write_report("report\n", output)
+        with open(output) as f:
+            assert f.read() == "report\n"
+        assert not os.path.exists(f"{output}.tmp")
+
+
+if __name__ == "__main__":
+    unittest.main()
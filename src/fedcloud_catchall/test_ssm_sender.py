@@ -0,0 +1,226 @@
+"""Tests for the in-process SSM sender"""
+
+import base64
+import copy
+import datetime
+import json
+import os.path
+import unittest
+from unittest.mock import patch
+
+import dirq.QueueSimple
+import fixtures
+import httpx
+import respx
+import testtools
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from oslo_config import fixture
+
+from . import ssm_sender
+
+sample_site = {
+    "id": "15810G0",
+    "name": "CENI",
+    "static": {"accounting": {"enabled": True}},
+}
+
+AUTHN_URL = (
+    "https://msg.argo.grnet.gr:8443/v1/service-types/ams/hosts/"
+    "msg.argo.grnet.gr:authx509"
+)
+CLOUD_URL = (
+    "https://msg.argo.grnet.gr/v1/projects/accounting/topics/"
+    "eu-egi-cloud-accounting:publish"
+)
+STORAGE_URL = (
+    "https://msg.argo.grnet.gr/v1/projects/accounting/topics/"
+    "eu-egi-storage-accounting:publish"
+)
+
+
+def write_host_cert(path):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "host.example.com")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = os.path.join(path, "hostcert.pem")
+    key_file = os.path.join(path, "hostkey.pem")
+    with open(cert_file, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_file, key_file
+
+
+class TestSSMSender(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.spool_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("spool_dir", self.spool_dir, group="accounting")
+        cert_file, key_file = write_host_cert(self.useFixture(fixtures.TempDir()).path)
+        self.conf.set_override("host_cert", cert_file, group="accounting")
+        self.conf.set_override("host_key", key_file, group="accounting")
+        self.other_site = copy.deepcopy(sample_site)
+        self.other_site["name"] = "OTHER"
+
+    def add_messages(self, site_name, run_type, count):
+        queue = dirq.QueueSimple.QueueSimple(
+            os.path.join(self.spool_dir, site_name, run_type, "outgoing")
+        )
+        for i in range(count):
+            queue.add(f"{site_name} {run_type} {i}".encode())
+        return queue
+
+    def test_outgoing_queues(self):
+        override_site = copy.deepcopy(sample_site)
+        override_site["name"] = "OVERRIDE"
+        override_site["static"]["accounting"]["ams_host"] = "example.com"
+        groups = ssm_sender.outgoing_queues([sample_site, override_site])
+        assert groups == {
+            ("msg.argo.grnet.gr", "eu-egi-storage-accounting"): [
+                ("CENI", os.path.join(self.spool_dir, "CENI/block/outgoing"))
+            ],
+            ("msg.argo.grnet.gr", "eu-egi-cloud-accounting"): [
+                ("CENI", os.path.join(self.spool_dir, "CENI/compute/outgoing"))
+            ],
+            ("example.com", "eu-egi-storage-accounting"): [
+                ("OVERRIDE", os.path.join(self.spool_dir, "OVERRIDE/block/outgoing"))
+            ],
+            ("example.com", "eu-egi-cloud-accounting"): [
+                ("OVERRIDE", os.path.join(self.spool_dir, "OVERRIDE/compute/outgoing"))
+            ],
+        }
+
+    def test_sign(self):
+        sender = ssm_sender.AmsSender(
+            self.conf.accounting.host_cert, self.conf.accounting.host_key
+        )
+        signed = sender.sign(b"APEL-cloud-message: v0.4\n").decode()
+        assert "multipart/signed" in signed
+        assert "APEL-cloud-message: v0.4" in signed
+
+    @respx.mock
+    def test_send(self):
+        self.conf.set_override("ams_batch_size", 2, group="accounting")
+        authn = respx.get(AUTHN_URL).mock(
+            return_value=httpx.Response(200, json={"token": "the_token"})
+        )
+        cloud = respx.post(CLOUD_URL).mock(
+            return_value=httpx.Response(200, json={"messageIds": ["1"]})
+        )
+        storage = respx.post(STORAGE_URL).mock(
+            return_value=httpx.Response(200, json={"messageIds": ["1"]})
+        )
+        compute_queue = self.add_messages("CENI", "compute", 3)
+        self.add_messages("OTHER", "compute", 1)
+        block_queue = self.add_messages("CENI", "block", 1)
+        results = ssm_sender.send([sample_site, self.other_site])
+        assert results == {"CENI": True, "OTHER": True}
+        # one token for the host, reused for every publish
+        assert authn.call_count == 1
+        assert cloud.call_count == 2
+        assert storage.call_count == 1
+        assert cloud.calls[0].request.headers["x-api-key"] == "the_token"
+        message = json.loads(cloud.calls[0].request.content)["messages"][0]
+        assert message["attributes"]["empaid"]
+        assert b"CENI compute" in base64.b64decode(message["data"])
+        assert compute_queue.count() == 0
+        assert block_queue.count() == 0
+
+    @respx.mock
+    def test_token_client(self):
+        self.conf.set_override("ams_timeout", 7, group="http")
+        respx.get(AUTHN_URL).mock(
+            return_value=httpx.Response(200, json={"token": "the_token"})
+        )
+        other = respx.get(
+            "https://example.com:8443/v1/service-types/ams/hosts/"
+            "example.com:authx509"
+        ).mock(return_value=httpx.Response(200, json={"token": "other_token"}))
+        sender = ssm_sender.AmsSender(
+            self.conf.accounting.host_cert, self.conf.accounting.host_key
+        )
+        assert sender.token("msg.argo.grnet.gr") == "the_token"
+        client = sender._authn_client
+        assert client.timeout.read == 7
+        assert sender.token("example.com") == "other_token"
+        assert other.call_count == 1
+        # one client for all the hosts
+        assert sender._authn_client is client
+        sender.close()
+        assert client.is_closed
+
+    @respx.mock
+    def test_send_failure(self):
+        respx.get(AUTHN_URL).mock(
+            return_value=httpx.Response(200, json={"token": "the_token"})
+        )
+        respx.post(CLOUD_URL).mock(return_value=httpx.Response(500))
+        respx.post(STORAGE_URL).mock(
+            return_value=httpx.Response(200, json={"messageIds": ["1"]})
+        )
+        compute_queue = self.add_messages("CENI", "compute", 2)
+        block_queue = self.add_messages("OTHER", "block", 1)
+        results = ssm_sender.send([sample_site, self.other_site])
+        assert results == {"CENI": False, "OTHER": True}
+        # kept for the next run
+        assert compute_queue.count() == 2
+        assert block_queue.count() == 0
+        for name in compute_queue:
+            assert compute_queue.lock(name)
+
+    def test_send_missing_cert(self):
+        self.conf.set_override("host_key", "/nonexistent", group="accounting")
+        self.add_messages("CENI", "compute", 1)
+        with self.assertLogs(level="ERROR"):
+            results = ssm_sender.send([sample_site, self.other_site])
+        assert results == {"CENI": False, "OTHER": False}
+
+    @respx.mock
+    def test_send_unreadable_queue(self):
+        respx.get(AUTHN_URL).mock(
+            return_value=httpx.Response(200, json={"token": "the_token"})
+        )
+        cloud = respx.post(CLOUD_URL).mock(
+            return_value=httpx.Response(200, json={"messageIds": ["1"]})
+        )
+        compute_queue = self.add_messages("CENI", "compute", 1)
+        self.add_messages("OTHER", "compute", 1)
+        get = dirq.QueueSimple.QueueSimple.get
+
+        def failing_get(queue, name):
+            if queue.path == compute_queue.path:
+                raise PermissionError("denied")
+            return get(queue, name)
+
+        with patch.object(dirq.QueueSimple.QueueSimple, "get", failing_get):
+            results = ssm_sender.send([sample_site, self.other_site])
+        assert results == {"CENI": False, "OTHER": True}
+        assert cloud.call_count == 1
+        # unlocked for the next run
+        assert compute_queue.count() == 1
+        for name in compute_queue:
+            assert compute_queue.lock(name)
+
+
+if __name__ == "__main__":
+    unittest.main()
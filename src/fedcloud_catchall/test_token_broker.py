@@ -0,0 +1,52 @@
+"""Tests for the token broker"""
+
+import os.path
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import token_broker as tb
+from .token_generator import TokenManager, fetch_broker_token
+
+
+class TestTokenBroker(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.conf.set_override("access_token_ttl", 600, group="checkin")
+        self.m_generate = MagicMock()
+        self.m_decode = self.useFixture(fixtures.MockPatch("jwt.decode")).mock
+        self.m_generate.return_value = "the_token"
+        self.m_decode.return_value = {"exp": time.time() + 3600}
+
+    def test_serve_token(self):
+        socket_path = os.path.join(self.useFixture(fixtures.TempDir()).path, "sock")
+        self.conf.set_override("broker_socket", socket_path, group="checkin")
+        token_manager = TokenManager(self.m_generate)
+        self.addCleanup(token_manager.stop)
+        server = tb.TokenBrokerServer(socket_path, token_manager)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        assert oct(os.stat(socket_path).st_mode & 0o777) == "0o600"
+        assert fetch_broker_token() == "the_token"
+        assert fetch_broker_token() == "the_token"
+        self.m_generate.assert_called_once()
+
+    def test_fetch_broker_token_not_configured(self):
+        assert fetch_broker_token() is None
+
+    def test_fetch_broker_token_no_broker(self):
+        socket_path = os.path.join(self.useFixture(fixtures.TempDir()).path, "sock")
+        self.conf.set_override("broker_socket", socket_path, group="checkin")
+        assert fetch_broker_token() is None
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,13 @@
 """Tests for the config generator"""
 
+import json
+import os.path
+import time
 import unittest
-from unittest.mock import mock_open, patch
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, MagicMock, mock_open, patch
 
+import fixtures
 import httpx
 import jwt
 import respx
@@ -21,6 +26,8 @@ class TokenGeneratorTest(testtools.TestCase):
     def setUp(self):
         super().setUp()
         self.conf = self.useFixture(fixture.Config()).conf
+        self.useFixture(fixtures.MonkeyPatch(f"{tg.__name__}._public_keys", {}))
+        self.useFixture(fixtures.MonkeyPatch(f"{tg.__name__}._oidc_config", None))
 
     @respx.mock
     def test_get_access_token(self):
@@ -111,6 +118,140 @@ class TokenGeneratorTest(testtools.TestCase):
         self._assert_valid_token_test(m_header, m_decode, m_alg)
         m_calendar.assert_not_called()
 
+    @respx.mock
+    @patch("jwt.algorithms.RSAAlgorithm.from_jwk")
+    def test_get_public_key_cached(self, m_alg):
+        route = respx.get("https://example.com").mock(
+            return_value=httpx.Response(200, json={"keys": [{"kid": "123"}]})
+        )
+        for _ in range(3):
+            key = tg.get_public_key(self.OIDC_CONFIG, "123")
+        assert key == m_alg.return_value
+        assert route.call_count == 1
+        m_alg.assert_called_once()
+
+    @respx.mock
+    @patch("jwt.algorithms.RSAAlgorithm.from_jwk")
+    def test_get_public_key_unknown_kid(self, m_alg):
+        route = respx.get("https://example.com").mock(
+            side_effect=[
+                httpx.Response(200, json={"keys": [{"kid": "123"}]}),
+                httpx.Response(200, json={"keys": [{"kid": "123"}, {"kid": "456"}]}),
+            ]
+        )
+        tg.get_public_key(self.OIDC_CONFIG, "123")
+        assert tg.get_public_key(self.OIDC_CONFIG, "456") == m_alg.return_value
+        assert route.call_count == 2
+
+    @respx.mock
+    @patch("jwt.algorithms.RSAAlgorithm.from_jwk")
+    def test_get_public_key_missing(self, m_alg):
+        respx.get("https://example.com").mock(
+            return_value=httpx.Response(200, json={"keys": [{"kid": "123"}]})
+        )
+        assert tg.get_public_key(self.OIDC_CONFIG, "456") is None
+
+    @respx.mock
+    @patch("jwt.algorithms.RSAAlgorithm.from_jwk")
+    def test_get_public_key_disk_cache(self, m_alg):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("cache_dir", cache_dir, group="cache")
+        with open(os.path.join(cache_dir, tg.JWKS_CACHE), "w") as f:
+            json.dump(
+                {
+                    "timestamp": time.time(),
+                    "jwks_uri": "https://example.com",
+                    "jwks": {"keys": [{"kid": "123"}]},
+                },
+                f,
+            )
+        route = respx.get("https://example.com")
+        assert tg.get_public_key(self.OIDC_CONFIG, "123") == m_alg.return_value
+        assert not route.called
+
+    @patch("fedcloud_catchall.token_generator.get_public_key")
+    @patch("jwt.get_unverified_header")
+    def test_valid_token_no_key(self, m_header, m_key):
+        m_header.return_value = {"kid": "123", "alg": "bar"}
+        m_key.return_value = None
+        self.assertEqual(tg.valid_token("foo", self.OIDC_CONFIG, 1), False)
+
+    def _setup_oidc_cache(self, timestamp, max_age=3600):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("cache_dir", cache_dir, group="cache")
+        self.conf.set_override(
+            "discovery_endpoint", "https://example.com/.well-known", group="checkin"
+        )
+        cache_file = os.path.join(cache_dir, tg.OIDC_CONFIG_CACHE)
+        with open(cache_file, "w") as f:
+            json.dump(
+                {
+                    "timestamp": timestamp,
+                    "max_age": max_age,
+                    "endpoint": "https://example.com/.well-known",
+                    "config": {"cached": True},
+                },
+                f,
+            )
+        return cache_file
+
+    @respx.mock
+    def test_get_oidc_config(self):
+        self.conf.set_override(
+            "discovery_endpoint", "https://example.com/.well-known", group="checkin"
+        )
+        route = respx.get("https://example.com/.well-known").mock(
+            return_value=httpx.Response(200, json={"foo": "bar"})
+        )
+        assert tg.get_oidc_config() == {"foo": "bar"}
+        assert tg.get_oidc_config() == {"foo": "bar"}
+        assert route.call_count == 1
+
+    @respx.mock
+    def test_get_oidc_config_fresh_cache(self):
+        self._setup_oidc_cache(time.time())
+        route = respx.get("https://example.com/.well-known")
+        assert tg.get_oidc_config() == {"cached": True}
+        assert not route.called
+
+    @respx.mock
+    def test_get_oidc_config_stale_cache(self):
+        cache_file = self._setup_oidc_cache(time.time() - 7200)
+        route = respx.get("https://example.com/.well-known").mock(
+            return_value=httpx.Response(
+                200, json={"foo": "bar"}, headers={"Cache-Control": "max-age=600"}
+            )
+        )
+        with patch("threading.Thread") as m_thread:
+            assert tg.get_oidc_config() == {"cached": True}
+            m_thread.assert_called_with(target=tg._revalidate_oidc_config)
+            m_thread.return_value.start.assert_called_once()
+        assert not route.called
+        tg._revalidate_oidc_config()
+        with open(cache_file) as f:
+            cached = json.load(f)
+        assert cached["config"] == {"foo": "bar"}
+        assert cached["max_age"] == 600
+
+    @respx.mock
+    def test_get_oidc_config_too_stale_cache(self):
+        self._setup_oidc_cache(time.time() - 7200)
+        self.conf.set_override("oidc_config_max_stale", 3600, group="checkin")
+        respx.get("https://example.com/.well-known").mock(
+            return_value=httpx.Response(503)
+        )
+        assert tg.get_oidc_config() == {"cached": True}
+
+    def test_max_age(self):
+        self.conf.set_override("oidc_config_ttl", 42, group="checkin")
+        for header, max_age in [
+            ({}, 42),
+            ({"Cache-Control": "public, max-age=100"}, 100),
+            ({"Cache-Control": "no-cache"}, 0),
+            ({"Cache-Control": "max-age=foo"}, 42),
+        ]:
+            assert tg._max_age(httpx.Response(200, headers=header)) == max_age
+
     @patch("fedcloud_catchall.token_generator.valid_token")
     @patch("os.path.exists")
     def test_check_token(self, m_exists, m_valid_token):
@@ -121,6 +262,127 @@ class TokenGeneratorTest(testtools.TestCase):
             m_valid_token.assert_called_with("data", self.OIDC_CONFIG, 23)
             m_exists.assert_called_with("foo")
 
+    @patch("fedcloud_catchall.token_generator.generate_token")
+    @patch("fedcloud_catchall.token_generator.check_token")
+    def test_refresh_token_file(self, m_check, m_generate):
+        token_file = os.path.join(self.useFixture(fixtures.TempDir()).path, "token")
+        m_check.return_value = False
+        m_generate.return_value = "new_token"
+        assert tg.refresh_token_file(token_file, self.OIDC_CONFIG, 23)
+        m_check.assert_called_with(token_file, self.OIDC_CONFIG, 23)
+        with open(token_file) as f:
+            assert f.read() == "new_token"
+        assert sorted(os.listdir(os.path.dirname(token_file))) == [
+            "token",
+            "token.lock",
+        ]
+
+    @patch("fedcloud_catchall.token_generator.generate_token")
+    @patch("fedcloud_catchall.token_generator.check_token")
+    def test_refresh_token_file_already_refreshed(self, m_check, m_generate):
+        token_file = os.path.join(self.useFixture(fixtures.TempDir()).path, "token")
+        # someone else refreshed while we were waiting for the lock
+        m_check.return_value = True
+        assert not tg.refresh_token_file(token_file, self.OIDC_CONFIG, 23)
+        m_generate.assert_not_called()
+        assert not os.path.exists(token_file)
+
+    @patch("fedcloud_catchall.token_generator.generate_token")
+    @patch("fedcloud_catchall.token_generator.valid_token")
+    def test_refresh_token_file_concurrent(self, m_valid, m_generate):
+        token_file = os.path.join(self.useFixture(fixtures.TempDir()).path, "token")
+        m_valid.side_effect = lambda token, *args: token == "new_token"
+        m_generate.return_value = "new_token"
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(
+                executor.map(
+                    lambda _: tg.refresh_token_file(token_file, self.OIDC_CONFIG, 23),
+                    range(8),
+                )
+            )
+        assert results.count(True) == 1
+        m_generate.assert_called_once()
+
+    @patch("jwt.decode")
+    def test_token_manager(self, m_decode):
+        m_source = MagicMock(return_value="the_token")
+        m_decode.return_value = {"exp": time.time() + 3600}
+        self.conf.set_override("access_token_ttl", 600, group="checkin")
+        manager = tg.TokenManager(m_source)
+        self.addCleanup(manager.stop)
+        assert manager.get() == "the_token"
+        assert manager.get() == "the_token"
+        m_source.assert_called_once()
+        assert manager._timer.interval > 2900
+
+    @patch("jwt.decode")
+    def test_token_manager_expiring(self, m_decode):
+        m_source = MagicMock(return_value="the_token")
+        m_decode.return_value = {"exp": time.time() + 300}
+        self.conf.set_override("access_token_ttl", 600, group="checkin")
+        manager = tg.TokenManager(m_source)
+        self.addCleanup(manager.stop)
+        with patch("threading.Timer"):
+            manager.get()
+            manager.get()
+        assert m_source.call_count == 2
+
+    @patch("jwt.decode")
+    def test_token_manager_background_refresh(self, m_decode):
+        m_source = MagicMock(side_effect=["first", "second"])
+        m_decode.return_value = {"exp": time.time() + 3600}
+        manager = tg.TokenManager(m_source)
+        self.addCleanup(manager.stop)
+        with patch("threading.Timer") as m_timer:
+            assert manager.get() == "first"
+            m_timer.assert_called_once_with(ANY, manager._background_refresh)
+            manager._background_refresh()
+        assert manager.get() == "second"
+
+    @patch("jwt.decode")
+    def test_token_manager_min_refresh_interval(self, m_decode):
+        m_source = MagicMock(return_value="the_token")
+        m_decode.return_value = {"exp": time.time() + 300}
+        self.conf.set_override("access_token_ttl", 600, group="checkin")
+        manager = tg.TokenManager(m_source)
+        self.addCleanup(manager.stop)
+        with patch("threading.Timer") as m_timer:
+            manager.get()
+        m_timer.assert_called_once_with(
+            tg.MIN_REFRESH_INTERVAL, manager._background_refresh
+        )
+
+    @patch("jwt.decode")
+    def test_token_manager_background_refresh_fails(self, m_decode):
+        m_source = MagicMock(side_effect=["first", httpx.ConnectError("error")])
+        m_decode.return_value = {"exp": time.time() + 3600}
+        manager = tg.TokenManager(m_source)
+        self.addCleanup(manager.stop)
+        with patch("threading.Timer") as m_timer:
+            manager.get()
+            manager._background_refresh()
+        # tried again later
+        m_timer.assert_called_with(tg.RETRY_INTERVAL, manager._background_refresh)
+        assert m_timer.call_count == 2
+
+    def test_token_manager_no_expiration(self):
+        m_source = MagicMock(return_value="not a jwt")
+        manager = tg.TokenManager(m_source)
+        assert manager.get() == "not a jwt"
+        assert manager.get() == "not a jwt"
+        m_source.assert_called_once()
+        assert manager._timer is None
+
+    @patch("jwt.decode")
+    def test_token_manager_set(self, m_decode):
+        m_source = MagicMock()
+        m_decode.return_value = {"exp": time.time() + 3600}
+        manager = tg.TokenManager(m_source)
+        self.addCleanup(manager.stop)
+        manager.set("the_token")
+        assert manager.get() == "the_token"
+        m_source.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,132 @@
+"""Tests for the accounting usage report"""
+
+import csv
+import datetime
+import os
+import os.path
+import unittest
+from unittest.mock import patch
+
+import dirq.QueueSimple
+import fixtures
+import testtools
+from oslo_config import fixture
+
+from . import usage_report
+from .spool import site_queues
+
+CLOUD_RECORD = """VMUUID: {0}
+SiteName: CENI
+FQAN: {1}
+WallDuration: {2}
+CpuCount: {3}
+Memory: 2048"""
+
+STORAGE_MESSAGE = (
+    '<sr:StorageUsageRecords xmlns:sr="http://eu-emi.eu/namespaces/2011/02/'
+    'storagerecord"><sr:StorageUsageRecord><sr:Site>CENI</sr:Site>'
+    "<sr:SubjectIdentity><sr:Group>ops</sr:Group></sr:SubjectIdentity>"
+    "<sr:ResourceCapacityUsed>{0}</sr:ResourceCapacityUsed>"
+    "</sr:StorageUsageRecord></sr:StorageUsageRecords>"
+)
+
+
+def cloud_message(*records):
+    entries = "\n%%\n".join(CLOUD_RECORD.format(i, *r) for i, r in enumerate(records))
+    return f"APEL-cloud-message: v0.4\n{entries}\n".encode()
+
+
+class TestUsageReport(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixture.Config())
+        self.spool_dir = self.useFixture(fixtures.TempDir()).path
+        self.day = datetime.date(2026, 1, 10)
+        self.add_message("compute", cloud_message(("ops", 100, 2), ("ops", 50, 4)))
+        self.add_message("compute", cloud_message(("vo.access.egi.eu", 10, 1)))
+        self.add_message("compute", b'{"Type": "APEL Public IP message"}')
+        self.add_message("block", STORAGE_MESSAGE.format(1024).encode())
+        self.add_message("block", STORAGE_MESSAGE.format(1024).encode(), days=1)
+
+    def add_message(self, run_type, message, days=0):
+        queue = dirq.QueueSimple.QueueSimple(
+            os.path.join(self.spool_dir, "CENI", run_type, "outgoing")
+        )
+        name = queue.add(message)
+        then = datetime.datetime.combine(
+            self.day + datetime.timedelta(days=days),
+            datetime.time(12),
+            datetime.timezone.utc,
+        ).timestamp()
+        # named as if added then, the day does not change with the mtime
+        dir_name, element = name.split("/")
+        os.rename(
+            os.path.join(queue.path, name),
+            os.path.join(queue.path, dir_name, f"{int(then):08x}{element[8:]}"),
+        )
+
+    def test_spool_usage(self):
+        rows = list(usage_report.spool_usage(site_queues(self.spool_dir)).rows())
+        assert rows == [
+            ("CENI", "ops", "2026-01-10", 3, 150, 400, 4096, 1024),
+            ("CENI", "ops", "2026-01-11", 1, 0, 0, 0, 1024),
+            ("CENI", "vo.access.egi.eu", "2026-01-10", 1, 10, 10, 2048, 0),
+        ]
+
+    def test_queue_usage_chunks(self):
+        self.useFixture(fixtures.MockPatch(f"{usage_report.__name__}.CHUNK_SIZE", 2))
+        summary = usage_report.UsageSummary()
+        for _, queue in site_queues(self.spool_dir):
+            summary.merge(usage_report.queue_usage(queue))
+        rows = list(summary.rows())
+        assert rows[0] == ("CENI", "ops", "2026-01-10", 3, 150, 400, 4096, 1024)
+        assert len(rows) == 3
+
+    def test_queue_usage_invalid_message(self):
+        self.add_message("block", b"<broken")
+        with self.assertLogs(level="WARNING"):
+            totals = usage_report.queue_usage(
+                os.path.join(self.spool_dir, "CENI", "block", "outgoing")
+            )
+        assert len(totals) == 2
+
+    def test_report_csv(self):
+        output = os.path.join(self.useFixture(fixtures.TempDir()).path, "usage.csv")
+        usage_report.report(site_queues(self.spool_dir), "csv", output)
+        with open(output) as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == ["site", "vo", "day", *usage_report.FIELDS]
+        assert rows[1] == [
+            "CENI",
+            "ops",
+            "2026-01-10",
+            "3",
+            "150",
+            "400",
+            "4096",
+            "1024",
+        ]
+        assert len(rows) == 4
+
+    @unittest.skipIf(usage_report.pyarrow is None, "needs pyarrow")
+    def test_report_parquet(self):
+        output = os.path.join(self.useFixture(fixtures.TempDir()).path, "usage.parquet")
+        usage_report.report(site_queues(self.spool_dir), "parquet", output)
+        table = usage_report.pyarrow.parquet.read_table(output)
+        assert table.column_names == ["site", "vo", "day", *usage_report.FIELDS]
+        assert table.num_rows == 3
+        assert table.column("day")[1].as_py() == datetime.date(2026, 1, 11)
+
+    @patch.object(usage_report, "pyarrow", None)
+    def test_report_parquet_without_pyarrow(self):
+        self.assertRaises(
+            SystemExit,
+            usage_report.report,
+            site_queues(self.spool_dir),
+            "parquet",
+            "usage.parquet",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,309 @@
+"""Tests for the Vault secrets"""
+
+import json
+import os
+import time
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+import fixtures
+import testtools
+from hvac.exceptions import Forbidden, InvalidPath
+from oslo_config import fixture
+
+from . import vault
+
+
+class TestVault(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.conf = self.useFixture(fixture.Config()).conf
+        self.useFixture(fixtures.MonkeyPatch(f"{vault.__name__}._hvac_client", None))
+        self.useFixture(fixtures.MonkeyPatch(f"{vault.__name__}._secrets", {}))
+        self.useFixture(fixtures.MonkeyPatch(f"{vault.__name__}._listings", {}))
+        self.useFixture(fixtures.MonkeyPatch(f"{vault.__name__}._unlistable", {}))
+        self.useFixture(
+            fixtures.MonkeyPatch(f"{vault.__name__}._token_expiration", None)
+        )
+        self.useFixture(
+            fixtures.MonkeyPatch(f"{vault.__name__}._token_renewable", False)
+        )
+        self.m_hvac = self.useFixture(fixtures.MockPatch("hvac.Client")).mock
+        self.m_client = MagicMock()
+        self.m_client.token = "vault_token"
+        self.m_hvac.return_value = self.m_client
+        self.m_login = self.m_client.auth.jwt.jwt_login
+        self.m_login.return_value = {
+            "auth": {"lease_duration": 3600, "renewable": True}
+        }
+        self.m_decode = self.useFixture(fixtures.MockPatch("jwt.decode")).mock
+        self.m_decode.return_value = {"sub": "user@egi.eu"}
+        self.m_read = self.m_client.secrets.kv.v1.read_secret
+        self.m_read.return_value = {
+            "data": {
+                "username": "demo",
+                "password": "1234",
+            },
+            "lease_duration": 2764800,
+        }
+        self.m_list = self.m_client.secrets.kv.v1.list_secrets
+        self.m_list.return_value = {"data": {"keys": ["ops", "vo1", "folder/"]}}
+
+    def test_get_vo_secrets(self):
+        self.m_login.return_value = None
+        r = vault.get_vo_secrets(
+            "https://example.com:5000/v3", "ops", "the_access_token"
+        )
+        assert r == {"password": "1234", "username": "demo"}
+        self.m_hvac.assert_called_once()
+        self.m_client.auth.jwt.jwt_login.assert_called_with(
+            role="", jwt="the_access_token"
+        )
+        self.m_read.assert_called_with(
+            path="users/user@egi.eu/cloudmon/example.com/ops",
+            mount_point="/secrets/",
+        )
+
+    def _setup_token_cache(self, expiration, renewable=False):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override("cache_dir", cache_dir, group="cache")
+        with open(os.path.join(cache_dir, vault.VAULT_TOKEN_CACHE), "w") as f:
+            json.dump(
+                {
+                    "token": "cached",
+                    "expiration": expiration,
+                    "renewable": renewable,
+                },
+                f,
+            )
+        return os.path.join(cache_dir, vault.VAULT_TOKEN_CACHE)
+
+    def test_get_client_cached_token(self):
+        self._setup_token_cache(time.time() + 3600)
+        client = vault.get_client("the_access_token")
+        assert client.token == "cached"
+        self.m_login.assert_not_called()
+
+    def test_get_client_expired_cached_token(self):
+        cache_file = self._setup_token_cache(time.time() + 10)
+
+        def login(role, jwt):
+            self.m_client.token = "vault_token"
+            return {"auth": {"lease_duration": 3600, "renewable": True}}
+
+        self.m_login.side_effect = login
+        client = vault.get_client("the_access_token")
+        self.m_login.assert_called_once_with(role="", jwt="the_access_token")
+        assert client.token == "vault_token"
+        with open(cache_file) as f:
+            cached = json.load(f)
+        assert cached["token"] == "vault_token"
+        assert cached["expiration"] - time.time() > 3000
+        assert oct(os.stat(cache_file).st_mode & 0o777) == "0o600"
+
+    def test_get_client_renew_cached_token(self):
+        self._setup_token_cache(time.time() + 10, renewable=True)
+        self.m_client.auth.token.renew_self.return_value = {
+            "auth": {"lease_duration": 3600, "renewable": True}
+        }
+        vault.get_client("the_access_token")
+        self.m_client.auth.token.renew_self.assert_called_once()
+        self.m_login.assert_not_called()
+
+    def test_get_client_renew(self):
+        vault.get_client("the_access_token")
+        vault._token_expiration = time.time() + 10
+        self.m_client.auth.token.renew_self.return_value = {
+            "auth": {"lease_duration": 3600, "renewable": True}
+        }
+        vault.get_client("the_access_token")
+        self.m_client.auth.token.renew_self.assert_called_once()
+        self.m_login.assert_called_once()
+        assert vault._token_expiration - time.time() > 3000
+
+    def test_get_client_renew_fails(self):
+        vault.get_client("the_access_token")
+        vault._token_expiration = time.time() + 10
+        self.m_client.auth.token.renew_self.side_effect = Forbidden()
+        vault.get_client("the_access_token")
+        assert self.m_login.call_count == 2
+
+    def test_get_client_valid_token(self):
+        vault.get_client("the_access_token")
+        vault.get_client("the_access_token")
+        self.m_client.auth.token.renew_self.assert_not_called()
+        self.m_login.assert_called_once()
+
+    def test_get_vo_secrets_forbidden_relogin(self):
+        self.m_read.side_effect = [Forbidden(), self.m_read.return_value]
+        self.m_client.auth.token.lookup_self.side_effect = Forbidden()
+        r = vault.get_vo_secrets(
+            "https://example.com:5000/v3", "ops", "the_access_token"
+        )
+        assert r == {"password": "1234", "username": "demo"}
+        assert self.m_login.call_count == 2
+
+    def test_get_vo_secrets_cached(self):
+        for _ in range(3):
+            r = vault.get_vo_secrets(
+                "https://example.com:5000/v3", "ops", "the_access_token"
+            )
+        assert r == {"password": "1234", "username": "demo"}
+        self.m_read.assert_called_once()
+
+    def test_get_vo_secrets_expired(self):
+        self.conf.set_override("secrets_ttl", 0, group="vault")
+        for _ in range(2):
+            vault.get_vo_secrets(
+                "https://example.com:5000/v3", "ops", "the_access_token"
+            )
+        assert self.m_read.call_count == 2
+
+    @patch("time.monotonic")
+    def test_get_vo_secrets_lease(self, m_time):
+        m_time.return_value = 100
+        self.m_read.return_value["lease_duration"] = 10
+        vault.get_vo_secrets("https://example.com:5000/v3", "ops", "the_access_token")
+        assert vault._secrets[("example.com", "ops")][0] == 110
+
+    def test_get_vo_secrets_not_found(self):
+        self.m_read.side_effect = InvalidPath()
+        for _ in range(2):
+            r = vault.get_vo_secrets(
+                "https://example.com:5000/v3", "ops", "the_access_token"
+            )
+            assert r == {}
+        self.m_read.assert_called_once()
+
+    def test_get_vo_secrets_error(self):
+        self.m_read.side_effect = Forbidden()
+        for _ in range(2):
+            r = vault.get_vo_secrets(
+                "https://example.com:5000/v3", "ops", "the_access_token"
+            )
+            assert r == {}
+        assert self.m_read.call_count == 2
+        # the token is still valid, no need to log in again
+        self.m_client.auth.token.lookup_self.assert_called()
+        self.m_login.assert_called_once()
+
+    def test_list_site_secrets(self):
+        for _ in range(2):
+            r = vault.list_site_secrets(
+                "https://example.com:5000/v3", "the_access_token"
+            )
+            assert r == {"ops", "vo1"}
+        self.m_list.assert_called_once_with(
+            path="users/user@egi.eu/cloudmon/example.com",
+            mount_point="/secrets/",
+        )
+
+    def test_list_site_secrets_not_found(self):
+        self.m_list.side_effect = InvalidPath()
+        r = vault.list_site_secrets("https://example.com:5000/v3", "the_access_token")
+        assert r == set()
+        r = vault.get_vo_secrets(
+            "https://example.com:5000/v3", "ops", "the_access_token"
+        )
+        assert r == {}
+        self.m_read.assert_not_called()
+
+    def test_list_site_secrets_error(self):
+        self.m_list.side_effect = Forbidden()
+        for _ in range(2):
+            r = vault.list_site_secrets(
+                "https://example.com:5000/v3", "the_access_token"
+            )
+            assert r is None
+        vault.get_vo_secrets("https://example.com:5000/v3", "ops", "the_access_token")
+        self.m_read.assert_called_once()
+        # listing is not allowed, not tried again nor a new token
+        self.m_list.assert_called_once()
+        self.m_login.assert_called_once()
+
+    def test_list_site_secrets_token_rejected(self):
+        self.m_list.side_effect = [Forbidden(), self.m_list.return_value]
+        self.m_client.auth.token.lookup_self.side_effect = Forbidden()
+        r = vault.list_site_secrets("https://example.com:5000/v3", "the_access_token")
+        assert r == {"ops", "vo1"}
+        assert self.m_login.call_count == 2
+
+    def test_get_site_secrets(self):
+        r = vault.get_site_secrets(
+            "https://example.com:5000/v3", ["ops", "vo2"], "the_access_token"
+        )
+        assert r == {"ops": {"password": "1234", "username": "demo"}, "vo2": {}}
+        self.m_list.assert_called_once()
+        self.m_read.assert_called_once_with(
+            path="users/user@egi.eu/cloudmon/example.com/ops",
+            mount_point="/secrets/",
+        )
+
+    def test_get_site_secrets_no_listing(self):
+        self.conf.set_override("list_secrets", False, group="vault")
+        vault.get_site_secrets(
+            "https://example.com:5000/v3", ["ops", "vo2"], "the_access_token"
+        )
+        self.m_list.assert_not_called()
+        assert self.m_read.call_count == 2
+
+    def test_prefetch_vo_secrets_listing(self):
+        vault.prefetch_vo_secrets(
+            [
+                ("https://example.com:5000/v3", "ops"),
+                ("https://example.com:5000/v3", "vo2"),
+                ("https://other.com:5000/v3", "ops"),
+            ],
+            "the_access_token",
+        )
+        assert self.m_list.call_count == 2
+        # vo2 is not listed, so not read
+        assert self.m_read.call_count == 2
+
+    def test_prefetch_vo_secrets(self):
+        self.conf.set_override("list_secrets", False, group="vault")
+        vault.prefetch_vo_secrets(
+            [
+                ("https://example.com:5000/v3", "ops"),
+                ("https://example.com:5000/v3", "vo1"),
+                ("https://example.com:5000/v3", "ops"),
+            ],
+            "the_access_token",
+        )
+        self.m_client.auth.jwt.jwt_login.assert_called_once()
+        assert self.m_read.call_count == 2
+        self.m_read.assert_has_calls(
+            [
+                call(
+                    path="users/user@egi.eu/cloudmon/example.com/ops",
+                    mount_point="/secrets/",
+                ),
+                call(
+                    path="users/user@egi.eu/cloudmon/example.com/vo1",
+                    mount_point="/secrets/",
+                ),
+            ],
+            any_order=True,
+        )
+        # all in cache now
+        vault.get_vo_secrets("https://example.com:5000/v3", "vo1", "the_access_token")
+        assert self.m_read.call_count == 2
+
+    def test_prefetch_vo_secrets_error(self):
+        self.conf.set_override("list_secrets", False, group="vault")
+        self.m_read.side_effect = [ConnectionError("down"), self.m_read.return_value]
+        with self.assertLogs(level="WARNING") as logs:
+            vault.prefetch_vo_secrets(
+                [("https://example.com:5000/v3", "ops")], "the_access_token"
+            )
+        assert "Unable to prefetch secrets of ops" in logs.output[0]
+        # not cached, read again when needed
+        r = vault.get_vo_secrets(
+            "https://example.com:5000/v3", "ops", "the_access_token"
+        )
+        assert r == {"password": "1234", "username": "demo"}
+        assert self.m_read.call_count == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
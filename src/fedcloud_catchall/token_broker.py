@@ -0,0 +1,68 @@
+"""
+Token broker
+
+Long running service that keeps a valid Check-in access token and serves
+it over a Unix socket to the other tools (see fetch_broker_token in the
+token generator), refreshing it before it gets below the access token TTL
+"""
+
+import logging
+import os
+import socketserver
+import sys
+
+import httpx
+
+from .config import CONF
+from .token_generator import TokenManager, generate_token, get_oidc_config
+
+
+class TokenRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            token = self.server.token_manager.get()
+        except (httpx.HTTPError, KeyError) as e:
+            logging.error(f"Unable to serve token: {e}")
+            return
+        self.wfile.write(f"{token}\n".encode())
+
+
+class TokenBrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, token_manager):
+        self.token_manager = token_manager
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # tokens are only for the owner of the socket
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, TokenRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def serve(socket_path):
+    token_manager = TokenManager(lambda: generate_token(get_oidc_config()))
+    # get the first token right away, it will be kept fresh in the background
+    token_manager.get()
+    with TokenBrokerServer(socket_path, token_manager) as server:
+        logging.info(f"Serving tokens at {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            token_manager.stop()
+            os.unlink(socket_path)
+
+
+def main():
+    CONF(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
+    if not CONF.checkin.broker_socket:
+        logging.error("No broker socket configured")
+        sys.exit(1)
+    serve(CONF.checkin.broker_socket)
+
+
+if __name__ == "__main__":
+    main()
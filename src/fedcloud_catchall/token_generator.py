@@ -9,34 +9,81 @@ ACCESS_TOKEN_TTL: Minimum TTL for the access token
 """
 
 import calendar
+import fcntl
 import json
 import logging
 import os
+import socket
 import sys
+import threading
+import time
 from datetime import datetime, timezone
 
 import httpx
 import jwt
 from oslo_config import cfg
 
+from . import cache
 from .config import CONF
+from .http_client import get_client
 
 _oidc_config = None
+OIDC_CONFIG_CACHE = "oidc-config.json"
+JWKS_CACHE = "jwks.json"
+# jwks uri -> (expiration, {kid: public key})
+_public_keys = {}
+_public_keys_lock = threading.Lock()
 
 
-def valid_token(token, oidc_config, min_time):
-    if not token:
-        return False
-    jwks_config = httpx.get(oidc_config["jwks_uri"]).json()
+def _fetch_jwks(jwks_uri, refresh=False):
+    if not refresh:
+        cached = cache.load(JWKS_CACHE)
+        if (
+            cache.is_fresh(cached, CONF.checkin.jwks_ttl)
+            and cached.get("jwks_uri") == jwks_uri
+        ):
+            return cached["jwks"]
+    logging.debug(f"Fetching JWKS from {jwks_uri}")
+    jwks = get_client("checkin").get(jwks_uri).json()
+    cache.store(
+        JWKS_CACHE, {"timestamp": time.time(), "jwks_uri": jwks_uri, "jwks": jwks}
+    )
+    return jwks
+
+
+def _build_public_keys(jwks_uri, refresh=False):
     # See https://stackoverflow.com/a/68891371
     public_keys = {}
-    for jwk in jwks_config["keys"]:
+    for jwk in _fetch_jwks(jwks_uri, refresh)["keys"]:
         kid = jwk["kid"]
         public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+    _public_keys[jwks_uri] = (time.monotonic() + CONF.checkin.jwks_ttl, public_keys)
+    return public_keys
+
+
+def get_public_key(oidc_config, kid):
+    jwks_uri = oidc_config["jwks_uri"]
+    with _public_keys_lock:
+        expiration, public_keys = _public_keys.get(jwks_uri, (0, {}))
+        if expiration <= time.monotonic():
+            public_keys = _build_public_keys(jwks_uri)
+        if kid not in public_keys:
+            # keys may have been rotated, get them again
+            logging.debug(f"Unknown key {kid}, refreshing JWKS")
+            public_keys = _build_public_keys(jwks_uri, refresh=True)
+        return public_keys.get(kid, None)
+
+
+def valid_token(token, oidc_config, min_time):
+    if not token:
+        return False
     try:
         headers = jwt.get_unverified_header(token)
         kid = headers["kid"]
-        key = public_keys[kid]
+        key = get_public_key(oidc_config, kid)
+        if not key:
+            logging.warning(f"No public key found for {kid}")
+            return False
         payload = jwt.decode(token, key=key, algorithms=[headers["alg"]])
         # this comes from JWT documentation
         # https://pyjwt.readthedocs.io/en/stable/usage.html#expiration-time-claim-exp
@@ -54,7 +101,7 @@ def generate_token(oidc_config):
         "client_secret": CONF.checkin.client_secret,
         "scope": CONF.checkin.scopes,
     }
-    r = httpx.post(oidc_config["token_endpoint"], data=payload)
+    r = get_client("checkin").post(oidc_config["token_endpoint"], data=payload)
     return r.json()["access_token"]
 
 
@@ -69,27 +116,196 @@ def check_token(token_file, oidc_config, ttl):
     return False
 
 
+def _max_age(response):
+    for directive in response.headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+        if name in ("no-cache", "no-store"):
+            return 0
+        if name == "max-age":
+            try:
+                return int(value)
+            except ValueError:
+                break
+    return CONF.checkin.oidc_config_ttl
+
+
+def _fetch_oidc_config():
+    logging.debug(f"Fetching OIDC configuration from {CONF.checkin.discovery_endpoint}")
+    r = get_client("checkin").get(CONF.checkin.discovery_endpoint)
+    r.raise_for_status()
+    oidc_config = r.json()
+    cache.store(
+        OIDC_CONFIG_CACHE,
+        {
+            "timestamp": time.time(),
+            "max_age": _max_age(r),
+            "endpoint": CONF.checkin.discovery_endpoint,
+            "config": oidc_config,
+        },
+    )
+    return oidc_config
+
+
+def _revalidate_oidc_config():
+    try:
+        _fetch_oidc_config()
+    except httpx.HTTPError as e:
+        logging.warning(f"Unable to refresh OIDC configuration: {e}")
+
+
 def get_oidc_config():
     global _oidc_config
-    if not _oidc_config:
-        _oidc_config = httpx.get(CONF.checkin.discovery_endpoint).json()
+    if _oidc_config:
+        return _oidc_config
+    cached = cache.load(OIDC_CONFIG_CACHE)
+    if not cached or cached.get("endpoint") != CONF.checkin.discovery_endpoint:
+        _oidc_config = _fetch_oidc_config()
+    elif cache.is_fresh(cached, cached.get("max_age", 0)):
+        _oidc_config = cached["config"]
+    elif cache.is_fresh(cached, CONF.checkin.oidc_config_max_stale):
+        # use what we have and get a new copy for the next runs
+        _oidc_config = cached["config"]
+        threading.Thread(target=_revalidate_oidc_config).start()
+    else:
+        try:
+            _oidc_config = _fetch_oidc_config()
+        except httpx.HTTPError as e:
+            logging.warning(f"Unable to fetch OIDC configuration, using cached: {e}")
+            _oidc_config = cached["config"]
     return _oidc_config
 
 
+# never refresh in the background more often than this, even if the source
+# gives tokens that are already expiring
+MIN_REFRESH_INTERVAL = 30
+# wait time before retrying a failed background refresh
+RETRY_INTERVAL = 30
+
+
+# Keeps an access token valid while the process runs, source is called to
+# get a new token, refreshed in the background before its expiration gets
+# below the access token TTL
+class TokenManager:
+    def __init__(self, source):
+        self.source = source
+        self.token = None
+        # None if the token expiration is unknown
+        self.expiration = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._stopped = False
+
+    def _expiring(self):
+        return self.expiration is not None and (
+            self.expiration - time.time() < CONF.checkin.access_token_ttl
+        )
+
+    def _cancel_refresh(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule_refresh(self, delay):
+        self._cancel_refresh()
+        if self._stopped:
+            return
+        self._timer = threading.Timer(
+            max(delay, MIN_REFRESH_INTERVAL), self._background_refresh
+        )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except (httpx.HTTPError, KeyError) as e:
+                logging.warning(f"Unable to refresh token in background: {e}")
+                self._schedule_refresh(RETRY_INTERVAL)
+
+    def _refresh(self):
+        logging.debug("Refreshing access token")
+        self._set(self.source())
+
+    def _set(self, token):
+        self.token = token
+        try:
+            payload = jwt.decode(token, options={"verify_signature": False})
+            self.expiration = payload.get("exp", None)
+        except jwt.PyJWTError as e:
+            logging.debug(f"Unable to get token expiration: {e}")
+            self.expiration = None
+        if self.expiration is None:
+            self._cancel_refresh()
+        else:
+            self._schedule_refresh(
+                self.expiration - time.time() - CONF.checkin.access_token_ttl
+            )
+
+    def set(self, token):
+        with self._lock:
+            self._set(token)
+
+    def get(self):
+        with self._lock:
+            if not self.token or self._expiring():
+                self._refresh()
+            return self.token
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._cancel_refresh()
+
+
+def fetch_broker_token():
+    # get a token from the token broker if there is one configured
+    if not CONF.checkin.broker_socket:
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(CONF.checkin.broker_timeout)
+            s.connect(CONF.checkin.broker_socket)
+            with s.makefile("r") as f:
+                return f.readline().strip() or None
+    except OSError as e:
+        logging.warning(f"Unable to get token from broker: {e}")
+        return None
+
+
+def refresh_token_file(token_file, oidc_config, ttl):
+    # only one process gets a new token, the rest wait for it and reuse it
+    with open(f"{token_file}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if check_token(token_file, oidc_config, ttl):
+                return False
+            logging.info("Token needs refreshing")
+            cache.write_atomic(token_file, generate_token(oidc_config))
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def main():
     logging.basicConfig()
     CONF.register_cli_opt(cfg.StrOpt("access_token_file", positional=True))
     CONF(sys.argv[1:])
 
+    broker_token = fetch_broker_token()
+    if broker_token:
+        cache.write_atomic(CONF.access_token_file, broker_token)
+        return
+
     oidc_config = get_oidc_config()
 
     if not check_token(
         CONF.access_token_file, oidc_config, CONF.checkin.access_token_ttl
     ):
-        logging.info("Token needs refreshing")
-        with open(CONF.access_token_file, "w+") as f:
-            new_token = generate_token(oidc_config)
-            f.write(new_token)
+        refresh_token_file(
+            CONF.access_token_file, oidc_config, CONF.checkin.access_token_ttl
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+"""
+Accounting usage report
+
+Summarises the cloud and storage records waiting in the outgoing queues per
+site, VO and day of extraction. Queues are parsed in parallel processes, in
+fixed size chunks of NumPy columns so the memory used does not grow with the
+spool
+"""
+
+import csv
+import datetime
+import logging
+import os.path
+import re
+import sys
+import xml.etree.ElementTree as ETree  # nosec
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .compaction import CLOUD_HEADER, CLOUD_SEPARATOR, STORAGE_NAMESPACE
+from .config import CONF
+from .spool import element_time, queue_elements
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # only needed for Parquet reports, in the report group
+    pyarrow = None
+
+# records parsed before aggregating them
+CHUNK_SIZE = 100_000
+
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH = datetime.date(1970, 1, 1)
+
+# only the fields used in the report are picked from the cloud records
+CLOUD_FIELDS = re.compile(
+    r"^(SiteName|FQAN|WallDuration|CpuCount|Memory): (.*)$", re.MULTILINE
+)
+
+# summed for every (site, VO, day)
+FIELDS = ["records", "wall_seconds", "core_seconds", "memory_mb", "storage_bytes"]
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _storage_text(record, path):
+    element = record.find(path.replace("sr:", f"{{{STORAGE_NAMESPACE}}}"))
+    return element.text if element is not None else None
+
+
+def message_records(data):
+    # (site, VO, wall seconds, CPUs, memory MB, storage bytes) of every cloud
+    # or storage record of a message, other messages have none
+    if data.startswith(CLOUD_HEADER):
+        _, _, body = data.decode("utf-8").partition("\n")
+        for entry in body.rstrip("\n").split(CLOUD_SEPARATOR):
+            record = dict(CLOUD_FIELDS.findall(entry))
+            yield (
+                record.get("SiteName"),
+                record.get("FQAN"),
+                _int(record.get("WallDuration")),
+                _int(record.get("CpuCount")),
+                _int(record.get("Memory")),
+                0,
+            )
+    elif data.startswith(b"<"):
+        # our own spool, written by cASO
+        for record in ETree.fromstring(data):  # nosec
+            yield (
+                _storage_text(record, "sr:Site"),
+                _storage_text(record, "sr:SubjectIdentity/sr:Group"),
+                0,
+                0,
+                0,
+                _int(_storage_text(record, "sr:ResourceCapacityUsed")),
+            )
+
+
+class UsageSummary:
+    def __init__(self):
+        self.totals = {}
+        self._chunk = []
+
+    def add(self, records, day):
+        for record in records:
+            self._chunk.append((*record, day))
+            if len(self._chunk) >= CHUNK_SIZE:
+                self.flush()
+
+    def flush(self):
+        if not self._chunk:
+            return
+        sites, vos, wall, cpus, memory, storage, days = zip(*self._chunk)
+        self._chunk = []
+        site_keys, site_codes = np.unique(
+            np.array(sites, dtype=str), return_inverse=True
+        )
+        vo_keys, vo_codes = np.unique(np.array(vos, dtype=str), return_inverse=True)
+        day_keys, day_codes = np.unique(
+            np.array(days, dtype=np.int64), return_inverse=True
+        )
+        wall = np.array(wall, dtype=np.int64)
+        values = np.column_stack(
+            [
+                np.ones(len(wall), dtype=np.int64),
+                wall,
+                wall * np.array(cpus, dtype=np.int64),
+                np.array(memory, dtype=np.int64),
+                np.array(storage, dtype=np.int64),
+            ]
+        )
+        groups = (site_codes * len(vo_keys) + vo_codes) * len(day_keys) + day_codes
+        group_keys, group_codes = np.unique(groups, return_inverse=True)
+        order = np.argsort(group_codes, kind="stable")
+        starts = np.searchsorted(group_codes[order], np.arange(len(group_keys)))
+        sums = np.add.reduceat(values[order], starts, axis=0)
+        for group, group_sums in zip(group_keys, sums):
+            group, day = divmod(int(group), len(day_keys))
+            site, vo = divmod(group, len(vo_keys))
+            key = (str(site_keys[site]), str(vo_keys[vo]), int(day_keys[day]))
+            self._merge(key, group_sums)
+
+    def _merge(self, key, sums):
+        if key in self.totals:
+            self.totals[key] = self.totals[key] + sums
+        else:
+            self.totals[key] = sums
+
+    def merge(self, totals):
+        for key, sums in totals.items():
+            self._merge(key, sums)
+
+    def rows(self):
+        # (site, VO, day, *FIELDS) sorted by site, VO and day
+        self.flush()
+        for (site, vo, day), sums in sorted(self.totals.items()):
+            day = EPOCH + datetime.timedelta(days=day)
+            yield (site, vo, day.isoformat(), *(int(value) for value in sums))
+
+
+def queue_usage(queue):
+    # totals of a queue, runs in a worker process
+    summary = UsageSummary()
+    for path, _ in queue_elements(queue):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # sent while reading
+            continue
+        day = int(element_time(os.path.basename(path)) // SECONDS_PER_DAY)
+        try:
+            summary.add(message_records(data), day)
+        except (ValueError, ETree.ParseError) as e:
+            logging.warning(f"Ignoring invalid message {path}: {e}")
+    summary.flush()
+    return summary.totals
+
+
+def spool_usage(queues):
+    # parsing is CPU bound, queues go to separate processes
+    summary = UsageSummary()
+    with ProcessPoolExecutor(max_workers=CONF.accounting.scan_workers) as executor:
+        for totals in executor.map(queue_usage, [queue for _, queue in queues]):
+            summary.merge(totals)
+    return summary
+
+
+def write_csv(rows, output=None):
+    f = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(["site", "vo", "day", *FIELDS])
+        writer.writerows(rows)
+    finally:
+        if output:
+            f.close()
+
+
+def write_parquet(rows, output):
+    columns = list(zip(*rows)) or [()] * (3 + len(FIELDS))
+    table = pyarrow.table(
+        {
+            "site": pyarrow.array(columns[0], pyarrow.string()),
+            "vo": pyarrow.array(columns[1], pyarrow.string()),
+            "day": pyarrow.array(
+                [datetime.date.fromisoformat(day) for day in columns[2]],
+                pyarrow.date32(),
+            ),
+            **{
+                field: pyarrow.array(column, pyarrow.int64())
+                for field, column in zip(FIELDS, columns[3:])
+            },
+        }
+    )
+    pyarrow.parquet.write_table(table, output)
+
+
+def report(queues, output_format="csv", output=None):
+    if output_format == "parquet":
+        if pyarrow is None:
+            sys.exit("Parquet reports need pyarrow (report dependency group)")
+        if output is None:
+            sys.exit("Parquet reports need an output file")
+        write_parquet(list(spool_usage(queues).rows()), output)
+    else:
+        write_csv(spool_usage(queues).rows(), output)
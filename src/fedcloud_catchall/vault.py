@@ -0,0 +1,289 @@
+"""
+Access to the site secrets stored in Vault
+
+Secrets are kept in memory for a limited time so the different tools can
+ask for them as many times as needed without going back to Vault, and can
+be prefetched concurrently before a run. The Vault token is kept in the
+local cache so the tools on the same host reuse it until it expires
+"""
+
+import logging
+import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import hvac
+import jwt
+from hvac.exceptions import Forbidden, InvalidPath, VaultError
+
+from . import cache
+from .config import CONF
+
+_hvac_client = None
+# expiration (epoch) of the client token, None if it does not expire
+_token_expiration = None
+_token_renewable = False
+_client_lock = threading.Lock()
+VAULT_URL = "https://vault.services.fedcloud.eu:8200"
+VAULT_TOKEN_CACHE = "vault-token.json"
+SECRETS_MOUNT_POINT = "/secrets/"
+
+# (keystone host, vo name) -> (expiration time, secret)
+_secrets = {}
+# keystone host -> (expiration time, set of vo names with secrets)
+_listings = {}
+# keystone host -> expiration time, for hosts the token cannot list
+_unlistable = {}
+_secrets_lock = threading.Lock()
+
+
+def keystone_host(endpoint: str):
+    return urlparse(endpoint).netloc.split(":", 1)[0]
+
+
+def _update_token(auth):
+    global _token_expiration, _token_renewable
+    lease_duration = auth.get("lease_duration", 0)
+    _token_expiration = time.time() + lease_duration if lease_duration else None
+    _token_renewable = auth.get("renewable", False)
+    cache.store(
+        VAULT_TOKEN_CACHE,
+        {
+            "token": _hvac_client.token,
+            "expiration": _token_expiration,
+            "renewable": _token_renewable,
+        },
+    )
+
+
+def _login(access_token: str):
+    logging.debug("Logging into Vault")
+    r = _hvac_client.auth.jwt.jwt_login(role="", jwt=access_token)
+    _update_token((r or {}).get("auth", {}))
+
+
+def _renew():
+    logging.debug("Renewing Vault token")
+    try:
+        r = _hvac_client.auth.token.renew_self()
+    except VaultError as e:
+        logging.debug(f"Unable to renew Vault token: {e}")
+        return False
+    _update_token(r.get("auth", {}))
+    return True
+
+
+def _token_expiring():
+    return (
+        _token_expiration is not None
+        and _token_expiration - time.time() < CONF.vault.token_min_ttl
+    )
+
+
+def _load_cached_token():
+    global _token_expiration, _token_renewable
+    cached = cache.load(VAULT_TOKEN_CACHE)
+    if not cached or not cached.get("token"):
+        return False
+    _hvac_client.token = cached["token"]
+    _token_expiration = cached.get("expiration")
+    _token_renewable = cached.get("renewable", False)
+    return True
+
+
+def invalidate_token(token=None):
+    # only if still using the given token, so a rejected token is replaced once
+    global _token_expiration, _token_renewable
+    with _client_lock:
+        if token is not None and _hvac_client and _hvac_client.token != token:
+            return
+        _token_expiration = 0
+        _token_renewable = False
+
+
+def _token_rejected(client):
+    try:
+        client.auth.token.lookup_self()
+    except Forbidden:
+        return True
+    except VaultError as e:
+        logging.debug(f"Unable to look up Vault token: {e}")
+    return False
+
+
+def _call(access_token, operation):
+    # Forbidden is also what Vault returns when the policy does not allow the
+    # operation, only get a new token when the current one is not valid
+    client = get_client(access_token)
+    token = client.token
+    try:
+        return operation(client)
+    except Forbidden:
+        if not _token_rejected(client):
+            raise
+    logging.debug("Vault token rejected, logging in again")
+    invalidate_token(token)
+    return operation(get_client(access_token))
+
+
+def get_client(access_token: str):
+    global _hvac_client
+    with _client_lock:
+        if not _hvac_client:
+            _hvac_client = hvac.Client(url=VAULT_URL)
+            if not _load_cached_token():
+                _login(access_token)
+        if _token_expiring():
+            if not (_token_renewable and _renew()):
+                _login(access_token)
+    return _hvac_client
+
+
+def _cache_secret(key, secret, lease_duration=0):
+    ttl = CONF.vault.secrets_ttl
+    if lease_duration and lease_duration > 0:
+        ttl = min(ttl, lease_duration)
+    with _secrets_lock:
+        _secrets[key] = (time.monotonic() + ttl, secret)
+
+
+def _cached_secret(key):
+    with _secrets_lock:
+        expiration, secret = _secrets.get(key, (0, None))
+    if expiration > time.monotonic():
+        return secret
+    return None
+
+
+def _site_path(access_token: str, host: str):
+    payload = jwt.decode(access_token, options={"verify_signature": False})
+    return os.path.join("users", payload.get("sub", ""), "cloudmon", host)
+
+
+def _listed_vos(host: str):
+    with _secrets_lock:
+        expiration, vo_names = _listings.get(host, (0, None))
+    if expiration > time.monotonic():
+        return vo_names
+    return None
+
+
+def list_site_secrets(endpoint: str, access_token: str):
+    host = keystone_host(endpoint)
+    vo_names = _listed_vos(host)
+    if vo_names is not None:
+        return vo_names
+    with _secrets_lock:
+        if _unlistable.get(host, 0) > time.monotonic():
+            return None
+    site_path = _site_path(access_token, host)
+    try:
+        r = _call(
+            access_token,
+            lambda client: client.secrets.kv.v1.list_secrets(
+                path=site_path,
+                mount_point=SECRETS_MOUNT_POINT,
+            ),
+        )
+    except InvalidPath:
+        logging.debug(f"No secrets at {site_path}")
+        r = {}
+    except Forbidden as e:
+        # the policy may allow reading but not listing, secrets are read
+        # without listing them first
+        logging.debug(f"Listing not allowed at {site_path}: {e}")
+        with _secrets_lock:
+            _unlistable[host] = time.monotonic() + CONF.vault.secrets_ttl
+        return None
+    except VaultError as e:
+        logging.debug(f"Unable to list secrets at {site_path}: {e}")
+        return None
+    # entries ending in / are folders, not secrets
+    vo_names = {k for k in r.get("data", {}).get("keys", []) if not k.endswith("/")}
+    with _secrets_lock:
+        _listings[host] = (time.monotonic() + CONF.vault.secrets_ttl, vo_names)
+    return vo_names
+
+
+def get_vo_secrets(endpoint: str, vo_name: str, access_token: str):
+    key = (keystone_host(endpoint), vo_name)
+    secret = _cached_secret(key)
+    if secret is not None:
+        return secret
+    vo_names = _listed_vos(key[0])
+    if vo_names is not None and vo_name not in vo_names:
+        # we know from the listing that there is nothing to read
+        return {}
+
+    secret_path = os.path.join(_site_path(access_token, key[0]), vo_name)
+    try:
+        r = _call(
+            access_token,
+            lambda client: client.secrets.kv.v1.read_secret(
+                path=secret_path,
+                mount_point=SECRETS_MOUNT_POINT,
+            ),
+        )
+    except InvalidPath as e:
+        # not there, no need to ask again
+        logging.debug(f"No secret at {secret_path}: {e}")
+        _cache_secret(key, {})
+        return {}
+    except VaultError as e:
+        logging.debug(f"Ouch {e}")
+        return {}
+    secret = r.get("data", {})
+    _cache_secret(key, secret, r.get("lease_duration", 0))
+    return secret
+
+
+def get_site_secrets(endpoint: str, vo_names, access_token: str):
+    # returns a map of vo name -> secret for the given VOs of a site
+    if CONF.vault.list_secrets:
+        list_site_secrets(endpoint, access_token)
+    return {
+        vo_name: get_vo_secrets(endpoint, vo_name, access_token) for vo_name in vo_names
+    }
+
+
+def prefetch_vo_secrets(secrets, access_token: str):
+    # secrets is an iterable of (endpoint, vo name)
+    pending = {
+        (endpoint, vo_name)
+        for endpoint, vo_name in secrets
+        if _cached_secret((keystone_host(endpoint), vo_name)) is None
+    }
+    if not pending:
+        return
+    logging.debug(f"Prefetching {len(pending)} secrets from Vault")
+    # login once before going concurrent
+    get_client(access_token)
+    with ThreadPoolExecutor(max_workers=CONF.vault.max_workers) as executor:
+        if CONF.vault.list_secrets:
+            # list every site first so only existing secrets are read
+            listings = {
+                executor.submit(list_site_secrets, endpoint, access_token): endpoint
+                for endpoint in {endpoint for endpoint, _ in pending}
+            }
+            for future, endpoint in listings.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.warning(f"Unable to list secrets of {endpoint}: {e}")
+        reads = {
+            executor.submit(get_vo_secrets, endpoint, vo_name, access_token): (
+                endpoint,
+                vo_name,
+            )
+            for endpoint, vo_name in pending
+        }
+        # failed reads are not cached, they are tried again when needed
+        for future, (endpoint, vo_name) in reads.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.warning(
+                    f"Unable to prefetch secrets of {vo_name} at {endpoint}: {e}"
+                )